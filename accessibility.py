@@ -0,0 +1,341 @@
+import argparse
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS
+from scipy.spatial import cKDTree
+
+import analysis
+import atlas
+import preprocessing
+import service_calendar
+import tracing
+
+# =============================
+# ACCESSIBILITY SCORES
+# =============================
+
+# Cumulative-opportunity scores for every cell of a square grid over Metro Vancouver
+# land: from the cell centre, within each budget,
+#   area_km2   land area reachable (what the isochrone polygon covers)
+#   stops      stops reachable
+#   points     total weight of reachable points from a CSV (jobs, schools...), optional
+#
+# Each origin is searched once, for the largest budget, and every budget is scored
+# from that one result. No polygons are built: the land is sampled on a finer grid
+# (SAMPLE_M), and the sample cells and points within walking distance of each stop are
+# found once for the whole run. A cell or point counts as reached when some reached
+# stop plus the walk to it fits the budget, and it is on a land piece that a reached
+# stop stands on, which are the same rules isochrone_polygon draws by. Origins are
+# scored in parallel across CPU cores.
+#
+#     python accessibility.py --date 2026-10-14 --time 08:00 --points jobs.csv
+#
+# writes output/accessibility_<graph key>.parquet (GeoParquet, one square per cell), or
+# with --format asc, one ESRI ASCII raster per score and budget.
+
+CELL_M = 500
+SAMPLE_M = analysis.PREVIEW_CELL_M
+BUDGETS = (15, 30, 45, 60)
+NODATA = -9999
+
+
+# =============================
+# GRIDS
+# =============================
+
+class LandGrid:
+    """Square cells of cell_m over the land pieces (BC Albers), keeping those whose centre is on land."""
+
+    def __init__(self, cell_m):
+        land = analysis.get_land_components()
+        min_x, min_y, max_x, max_y = land.total_bounds
+        self.cell_m = cell_m
+        self.n_cols = int(np.ceil((max_x - min_x) / cell_m))
+        self.n_rows = int(np.ceil((max_y - min_y) / cell_m))
+        self.min_x, self.max_y = min_x, max_y
+
+        # Row 0 at the top, as rasters are written
+        row, col = np.divmod(np.arange(self.n_rows * self.n_cols), self.n_cols)
+        x = min_x + (col + 0.5) * cell_m
+        y = max_y - (row + 0.5) * cell_m
+
+        land_id = land_ids_of(x, y)
+        on_land = land_id >= 0
+
+        self.row, self.col = row[on_land], col[on_land]
+        self.x, self.y = x[on_land], y[on_land]
+        self.land_id = land_id[on_land]
+
+    def __len__(self):
+        return len(self.x)
+
+    def squares(self):
+        half = self.cell_m / 2
+        return shapely.box(self.x - half, self.y - half, self.x + half, self.y + half)
+
+
+def land_ids_of(x, y):
+    """land_id of the land piece under each BC Albers point (-1 off land)."""
+    land = analysis.get_land_components()
+    land_id = np.full(len(x), -1, dtype=np.int64)
+
+    # One prepared piece at a time, tested only against the points in its bounds
+    for piece_id, geometry in zip(land.index, land.geometry):
+        min_x, min_y, max_x, max_y = geometry.bounds
+        candidates = np.flatnonzero((x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y) & (land_id < 0))
+        if len(candidates):
+            shapely.prepare(geometry)
+            land_id[candidates[shapely.contains_xy(geometry, x[candidates], y[candidates])]] = piece_id
+    return land_id
+
+
+def read_points(path, weight_column='weight'):
+    """BC Albers x, y and weights of the points in a CSV with lat, lon and optionally weight_column."""
+    df = pd.read_csv(path)
+    missing = {'lat', 'lon'} - set(df.columns)
+    if missing:
+        raise SystemExit(f"{path} needs columns {sorted(missing)}.")
+    weights = df[weight_column].to_numpy(dtype=float) if weight_column in df.columns else np.ones(len(df))
+    x, y = atlas.to_albers(df['lat'].to_numpy(), df['lon'].to_numpy())
+    return x, y, weights
+
+
+# =============================
+# WALK NEIGHBOURHOODS
+# =============================
+
+def within_walk(stop_x, stop_y, x, y, max_walk_m):
+    """
+    For every stop, the targets (x, y) within max_walk_m, as CSR arrays
+    (indptr, target index, distance in metres).
+    """
+    targets_xy = np.column_stack([x, y])
+    stops_xy = np.column_stack([stop_x, stop_y])
+    hits = cKDTree(targets_xy).query_ball_point(stops_xy, max_walk_m) if len(targets_xy) else [[] for _ in stops_xy]
+
+    lengths = np.array([len(h) for h in hits], dtype=np.int64)
+    targets = np.concatenate([np.asarray(h, dtype=np.int64) for h in hits]) if lengths.sum() else np.zeros(0, dtype=np.int64)
+    stop_of = np.repeat(np.arange(len(stops_xy)), lengths)
+    dist = np.hypot(targets_xy[targets, 0] - stops_xy[stop_of, 0], targets_xy[targets, 1] - stops_xy[stop_of, 1])
+
+    return np.concatenate([[0], np.cumsum(lengths)]), targets.astype(np.int32), dist
+
+
+def first_arrivals(neighbourhood, stops, minutes, walk_speed_mpm):
+    """(targets, minutes) of every target reached from the given stops, each at its earliest arrival."""
+    indptr, targets, dist = neighbourhood
+    starts = indptr[stops]
+    lengths = indptr[stops + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0)
+
+    # Positions of every stop's neighbours, laid end to end
+    offsets = np.arange(total) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    hit = targets[offsets]
+    arrival = np.repeat(minutes, lengths) + dist[offsets] / walk_speed_mpm
+
+    order = np.argsort(arrival, kind='stable')
+    hit, arrival = hit[order], arrival[order]
+    hit, first = np.unique(hit, return_index=True)
+    return hit, arrival[first]
+
+
+# =============================
+# SCORING
+# =============================
+
+# Worker state, set once per process so the graph and neighbourhoods are not resent with every origin
+_SCORER = {}
+
+
+def _init_scorer(G, settings):
+    _SCORER.update(settings, G=G)
+
+
+def _score_origin(point):
+    """Scores of one origin: array (3, len(budgets)) of area_km2, stops and points."""
+    lat, lon = point
+    s = _SCORER
+    budgets = s['budgets']
+    scores = np.zeros((3, len(budgets)))
+
+    best_times = analysis.isochrone_stop_times(s['G'], lat, lon, max(budgets), s['walk_speed_mps'], s['max_walk_km'])
+    if not best_times:
+        return scores
+
+    stops = np.fromiter((s['stop_index'][stop_id] for stop_id in best_times), dtype=np.int64, count=len(best_times))
+    minutes = np.fromiter(best_times.values(), dtype=float, count=len(best_times))
+    walk_speed_mpm = s['walk_speed_mps'] * 60.0
+
+    cells, cell_minutes = first_arrivals(s['cells'], stops, minutes, walk_speed_mpm)
+    points, point_minutes = first_arrivals(s['points'], stops, minutes, walk_speed_mpm)
+
+    for j, budget in enumerate(budgets):
+        reached = minutes <= budget
+        reached_land = np.unique(s['stop_land'][stops[reached]])
+
+        ok = (cell_minutes <= budget) & np.isin(s['cell_land'][cells], reached_land)
+        scores[0, j] = ok.sum() * s['sample_m'] ** 2 / 1e6
+        scores[1, j] = reached.sum()
+
+        ok = (point_minutes <= budget) & np.isin(s['point_land'][points], reached_land)
+        scores[2, j] = s['point_weights'][points[ok]].sum()
+
+    return scores
+
+
+@tracing.traced('accessibility')
+def accessibility_scores(G, budgets=BUDGETS, walk_speed_mps=1.2, max_walk_km=0.5, cell_m=CELL_M, sample_m=SAMPLE_M,
+                         points=None, workers=None):
+    """
+    GeoDataFrame (BC Albers) of every land cell of cell_m, with area_km2_<budget>,
+    stops_<budget> and, when points (x, y, weights) are given, points_<budget> columns.
+    """
+    budgets = tuple(sorted(budgets))
+    max_walk_m = max_walk_km * 1000
+
+    origins = LandGrid(cell_m)
+    samples = LandGrid(sample_m)
+    print(f"Accessibility: {len(origins)} cells of {cell_m:g} m, land sampled every {sample_m:g} m ({len(samples)} samples).")
+
+    stops = analysis.get_stops()
+    stop_ids = list(stops)
+    stop_lat = np.array([stops[s]['lat'] for s in stop_ids])
+    stop_lon = np.array([stops[s]['lon'] for s in stop_ids])
+    stop_x, stop_y = atlas.to_albers(stop_lat, stop_lon)
+
+    point_x, point_y, point_weights = points if points is not None else (np.zeros(0), np.zeros(0), np.zeros(0))
+
+    # As in the isochrone, stops just off the coastline stand on the nearest land piece
+    # (within preprocessing.LAND_SNAP_M; stops further out stay off land)
+    stop_land = np.array([-1 if stops[s]['land_id'] is None else stops[s]['land_id'] for s in stop_ids], dtype=np.int64)
+    offshore = np.flatnonzero(stop_land < 0)
+    if len(offshore):
+        nearest = analysis.nearest_land_ids(shapely.points(stop_x[offshore], stop_y[offshore]), max_distance=preprocessing.LAND_SNAP_M)
+        stop_land[offshore] = [-1 if land_id is None else land_id for land_id in nearest]
+    settings = {
+        'budgets': budgets,
+        'walk_speed_mps': walk_speed_mps,
+        'max_walk_km': max_walk_km,
+        'sample_m': sample_m,
+        'stop_index': {stop_id: i for i, stop_id in enumerate(stop_ids)},
+        'stop_land': stop_land,
+        'cells': within_walk(stop_x, stop_y, samples.x, samples.y, max_walk_m),
+        'cell_land': samples.land_id,
+        'points': within_walk(stop_x, stop_y, point_x, point_y, max_walk_m),
+        'point_land': land_ids_of(point_x, point_y),
+        'point_weights': point_weights,
+    }
+
+    # Cells with no stop in walking distance can't reach anything
+    lat, lon = atlas.to_latlon(origins.x, origins.y)
+    near = cKDTree(np.column_stack([stop_x, stop_y])).query(np.column_stack([origins.x, origins.y]), distance_upper_bound=max_walk_m)[0] < np.inf
+    searched = np.flatnonzero(near)
+    print(f"Searching from {len(searched)} cells with stops in walking distance.")
+
+    t0 = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    points_in = [(lat[i], lon[i]) for i in searched]
+    if workers == 1:
+        _init_scorer(G, settings)
+        results = [_score_origin(p) for p in points_in]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_scorer, initargs=(G, settings)) as pool:
+            chunksize = max(1, len(points_in) // (workers * 8))
+            results = list(pool.map(_score_origin, points_in, chunksize=chunksize))
+    print(f"Scored in {time.perf_counter() - t0:.1f} s.")
+
+    scores = np.zeros((len(origins), 3, len(budgets)))
+    if results:
+        scores[searched] = np.stack(results)
+
+    columns = {'row': origins.row, 'col': origins.col, 'lat': lat, 'lon': lon}
+    for j, budget in enumerate(budgets):
+        columns[f'area_km2_{budget:g}'] = scores[:, 0, j]
+        columns[f'stops_{budget:g}'] = scores[:, 1, j].astype(np.int64)
+        if points is not None:
+            columns[f'points_{budget:g}'] = scores[:, 2, j]
+
+    gdf = gpd.GeoDataFrame(columns, geometry=origins.squares(), crs="EPSG:3005")
+    gdf.attrs['grid'] = {'cell_m': cell_m, 'n_rows': origins.n_rows, 'n_cols': origins.n_cols,
+                         'min_x': origins.min_x, 'max_y': origins.max_y}
+    tracing.current().set(cells=len(origins), searched=len(searched))
+    return gdf
+
+
+# =============================
+# OUTPUT
+# =============================
+
+def write_rasters(gdf, out_dir):
+    """One ESRI ASCII grid (.asc with a .prj) per score column of gdf, cells off land as NODATA."""
+    grid = gdf.attrs['grid']
+    os.makedirs(out_dir, exist_ok=True)
+    prj = CRS.from_epsg(3005).to_wkt(version='WKT1_ESRI')
+    header = (
+        f"ncols {grid['n_cols']}\nnrows {grid['n_rows']}\n"
+        f"xllcorner {grid['min_x']}\nyllcorner {grid['max_y'] - grid['n_rows'] * grid['cell_m']}\n"
+        f"cellsize {grid['cell_m']}\nNODATA_value {NODATA}"
+    )
+
+    paths = []
+    for column in gdf.columns:
+        if not column.startswith(('area_km2_', 'stops_', 'points_')):
+            continue
+        raster = np.full((grid['n_rows'], grid['n_cols']), NODATA, dtype=float)
+        raster[gdf['row'].to_numpy(), gdf['col'].to_numpy()] = gdf[column].to_numpy()
+
+        path = f"{out_dir}/{column}.asc"
+        np.savetxt(path, raster, fmt='%.4g', header=header, comments='')
+        with open(f"{out_dir}/{column}.prj", 'w') as f:
+            f.write(prj)
+        paths.append(path)
+    return paths
+
+
+# ==========================
+# COMMAND LINE
+# ==========================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cumulative-opportunity accessibility scores for a grid over Metro Vancouver land.")
+    parser.add_argument('--date', type=datetime.date.fromisoformat, default=atlas.next_weekday(), help="service date (default: the next weekday)")
+    parser.add_argument('--time', default="08:00")
+    parser.add_argument('--toggles', nargs='*', default=["skytrain", "bridges"])
+    parser.add_argument('--frequency', type=float, default=1.0)
+    parser.add_argument('--walk-speed', type=float, default=1.2)
+    parser.add_argument('--max-walk', type=float, default=0.5)
+    parser.add_argument('--budgets', type=float, nargs='+', default=list(BUDGETS))
+    parser.add_argument('--cell-m', type=float, default=CELL_M, help="grid cell size in metres")
+    parser.add_argument('--sample-m', type=float, default=SAMPLE_M, help="land sampling step for reachable area, in metres")
+    parser.add_argument('--points', help="CSV of opportunities with lat, lon and optionally a weight column")
+    parser.add_argument('--weight-column', default='weight')
+    parser.add_argument('--format', choices=['parquet', 'asc'], default='parquet')
+    parser.add_argument('--out', help="output file (parquet) or folder (asc)")
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    G = service_calendar.graph_for_date(args.date, preprocessing.ordered_toggles(args.toggles), args.time, args.frequency)
+    if G is None:
+        raise SystemExit(f"No transit service on {args.date}.")
+
+    points = read_points(args.points, args.weight_column) if args.points else None
+    gdf = accessibility_scores(G, args.budgets, args.walk_speed, args.max_walk, args.cell_m, args.sample_m, points, args.workers)
+
+    name = f"output/accessibility_{G.graph['key']}"
+    if args.format == 'asc':
+        paths = write_rasters(gdf, args.out or name)
+        print(f"Wrote {len(paths)} rasters to '{args.out or name}'.")
+    else:
+        path = args.out or f"{name}.parquet"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        gdf.to_parquet(path)
+        print(f"Wrote {len(gdf)} cells to '{path}'.")
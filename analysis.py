@@ -1,12 +1,23 @@
-import pandas as pd
 import geopandas as gpd
-import networkx as nx
 import pickle
 import numpy as np
-import sys
+import os
+import time
+from collections.abc import Mapping
+from heapq import heappush, heappop
+from itertools import count
 from shapely.geometry import Point
 from shapely.geometry import LineString
-from sklearn.neighbors import BallTree
+import shapely
+from functools import lru_cache
+
+import graph_builder
+import hub_labels
+import isochrone_cache
+import memory
+import preprocessing
+import shared_graph
+import tracing
 
 # ===========================
 # HELPER FUNCTIONS
@@ -30,10 +41,11 @@ def get_geometry_for_edge(edge_data):
     dv = edge_data.get('dist_v')
     
     if not sh_id or du is None or dv is None: return None
-    if sh_id not in SHAPES_DB: return None
+    shapes_db = get_shapes()
+    if sh_id not in shapes_db: return None
     
     # Lookup
-    shape_entry = SHAPES_DB[sh_id]
+    shape_entry = shapes_db[sh_id]
     all_dists = shape_entry['distances']
     all_coords = shape_entry['coords']
     
@@ -41,35 +53,267 @@ def get_geometry_for_edge(edge_data):
     idx_start = np.searchsorted(all_dists, du, side='right')
     idx_end = np.searchsorted(all_dists, dv, side='right')
     
-    # Return Points
-    return all_coords[idx_start:idx_end]
+    # Return Points (memory-mapped shapes hold coords as an (n, 2) array)
+    segment = all_coords[idx_start:idx_end]
+    return segment.tolist() if isinstance(segment, np.ndarray) else segment
 
 
 # ===========================
 # SETUP & DATA LOADING
 # ===========================
 
-print("Initializing Analysis Engine...")
+# Everything below is loaded on first use and then cached, so importing this
+# module (and starting the app) doesn't wait on pickles or the spatial index.
+# The caches are memory.py components, so a memory budget can drop them.
 
-try:
-    with open('data/stops.pkl', 'rb') as f:
-        STOPS_DICT = pickle.load(f)
-    with open('data/shapes.pkl', 'rb') as f:
-        SHAPES_DB = pickle.load(f)
+SHAPE_POINTS_PATH = 'data/shapes_points.npy'
+SHAPE_INDEX_PATH = 'data/shapes_index.pkl'
+STOPS_TABLE_PATH = 'data/stops_table.npy'
 
-        
-    stops_df = pd.DataFrame.from_dict(STOPS_DICT, orient='index')
-    stops_df.index.name = 'stop_id'
-    stops_df = stops_df.reset_index()
+def _load_pickle(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        print(f"Error: Could not find '{path}'. Did you run preprocessing.py?")
+        raise
+
+
+def _use_mapped(path):
+    # Low-memory mode and processes sharing graphs read arrays from memory-mapped files
+    return (memory.low_memory() or shared_graph.enabled()) and os.path.exists(path)
+
+
+class MappedStops(Mapping):
+    """
+    The same {stop_id: {'lat', 'lon', 'name', 'land_id'}} as stops.pkl, read from the
+    memory-mapped table written by preprocessing.process_stops, so processes share
+    its pages. Only the stop id lookup is held per process.
+    """
+    mapped = True
+
+    def __init__(self, path=STOPS_TABLE_PATH):
+        self.table = np.load(path, mmap_mode='r')
+        self.index = {stop_id: i for i, stop_id in enumerate(self.table['stop_id'].tolist())}
+
+    def __getitem__(self, stop_id):
+        stop_id, name, lat, lon, land_id = self.table[self.index[stop_id]].tolist()
+        return {'lat': lat, 'lon': lon, 'name': name, 'land_id': None if land_id < 0 else land_id}
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def coords(self):
+        """(lat, lon) rows in iteration order, without building the stop dicts."""
+        return np.column_stack([self.table['lat'], self.table['lon']])
+
+
+@memory.component('stops')
+@lru_cache(maxsize=None)
+def get_stops():
+    """{stop_id: {'lat', 'lon', 'name', 'land_id'}} from stops.pkl (memory-mapped when shared or low on memory)."""
+    if _use_mapped(STOPS_TABLE_PATH):
+        return MappedStops()
+    return _load_pickle('data/stops.pkl')
+
+
+class MappedShapes(Mapping):
+    """
+    The same {shape_id: {'distances', 'coords'}} as shapes.pkl, read on demand from
+    the memory-mapped point array written by preprocessing.process_shapes, so only
+    the pages a route touches are resident.
+    """
+    mapped = True
+
+    def __init__(self, points_path=SHAPE_POINTS_PATH, index_path=SHAPE_INDEX_PATH):
+        # Rows of (shape_dist_traveled, lon, lat), one shape after another
+        self.points = np.load(points_path, mmap_mode='r')
+        self.index = _load_pickle(index_path)
+
+    def __getitem__(self, shape_id):
+        start, end = self.index[shape_id]
+        points = self.points[start:end]
+        return {'distances': points[:, 0], 'coords': points[:, 1:]}
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+@memory.component('shapes')
+@lru_cache(maxsize=None)
+def get_shapes():
+    """{shape_id: {'distances', 'coords'}} from shapes.pkl (memory-mapped when shared or low on memory)."""
+    if _use_mapped(SHAPE_POINTS_PATH):
+        return MappedShapes()
+    return _load_pickle('data/shapes.pkl')
+
+
+@memory.component('stop_index')
+@lru_cache(maxsize=None)
+def get_stop_index():
+    """(stop_ids, BallTree over stop coordinates in radians)."""
+    from sklearn.neighbors import BallTree
+
+    stops = get_stops()
+    stop_ids = np.array(list(stops), dtype=object)
+    coords = stops.coords() if isinstance(stops, MappedStops) else [[s['lat'], s['lon']] for s in stops.values()]
+    stops_rad = np.deg2rad(coords)
+    tree = BallTree(stops_rad, metric='haversine')
 
-    stops_rad = np.deg2rad(stops_df[['lat', 'lon']])
-    TREE = BallTree(stops_rad, metric='haversine')
-    
     print("Spatial Index built successfully.")
+    return stop_ids, tree
+
+
+@memory.component('land_components')
+@lru_cache(maxsize=None)
+def get_land_components():
+    """Separate land pieces (BC Albers), indexed by the land_id stored on each stop."""
+    return _load_pickle('data/land_components.pkl').set_index('land_id', drop=False)
 
-except Exception as e:
-    print(f"Error loading data: {e}")
-    sys.exit(1)
+
+def nearest_land_ids(points, max_distance=None):
+    """
+    land_id of the land piece nearest each BC Albers point, or None for points further
+    than max_distance metres from every piece.
+    """
+    land_components = get_land_components()
+    found, nearest = land_components.sindex.nearest(points, return_all=False, max_distance=max_distance)
+    land_ids = [None] * len(points)
+    for i, land_id in zip(found.tolist(), land_components.index[nearest].tolist()):
+        land_ids[i] = land_id
+    return land_ids
+
+
+# =================
+# SEARCH FUNCTIONS
+# =================
+
+@tracing.traced('snap')
+def snap_to_stops(start_lat, start_lon, walk_speed_mps=1.2, max_walk_km=1.0):
+    """
+    Finds every stop within walking distance of a point.
+    Returns a list of (stop_id, walk_time_min) pairs.
+    """
+    walk_speed_mpm = walk_speed_mps * 60.0
+
+    user_rad = np.deg2rad([[start_lat, start_lon]])
+    radius_rad = max_walk_km / 6371.0
+    all_stop_ids, tree = get_stop_index()
+    indices, distances = tree.query_radius(user_rad, r=radius_rad, return_distance=True)
+
+    stop_ids = all_stop_ids[indices[0]]
+    walk_times = distances[0] * 6371000 / walk_speed_mpm
+    tracing.current().set(stops=len(stop_ids))
+
+    return [(str(stop_id), walk_time) for stop_id, walk_time in zip(stop_ids, walk_times)]
+
+
+@tracing.traced('search')
+def search_tree(G, first_legs, time_budget_mins, removed_edges=None, last_legs=None, walk_speed_mps=None):
+    """
+    Multi-source Dijkstra from the walked-to stops, without touching G.
+    Follows transit edges in G, walk edges in its shared walk layer and, when
+    walk_speed_mps is given, generated footpaths timed at that speed.
+    Returns (dist, pred): minutes to every reached node, and the node it was reached from
+    (None for stops reached directly by the first walk).
+
+    With last_legs ({stop_id: walk_time_min}), the search stops as soon as no
+    remaining node can improve the best arrival at the destination.
+    """
+    dist = {}
+    pred = {}
+    best = {}
+    heap = []
+    tie = count()
+    best_arrival = float('inf')
+
+    for stop_id, walk_time in graph_builder.to_graph_stops(G, first_legs):
+        if walk_time < time_budget_mins and walk_time < best.get(stop_id, float('inf')):
+            best[stop_id] = walk_time
+            pred[stop_id] = None
+            heappush(heap, (walk_time, next(tie), stop_id))
+
+    while heap:
+        d, _, u = heappop(heap)
+        if u in dist:
+            continue
+        if d >= best_arrival:
+            break
+        dist[u] = d
+
+        if last_legs and u in last_legs:
+            best_arrival = min(best_arrival, d + last_legs[u])
+
+        for v, weight in graph_builder.out_edges(G, u, walk_speed_mps):
+            if v in dist:
+                continue
+            if removed_edges and (u, v) in removed_edges:
+                continue
+
+            vd = d + weight
+            if vd <= time_budget_mins and vd < best.get(v, float('inf')):
+                best[v] = vd
+                pred[v] = u
+                heappush(heap, (vd, next(tie), v))
+
+    tracing.current().set(settled=len(dist))
+    return dist, {n: pred[n] for n in dist}
+
+
+def physical_stop_times(reachable_nodes, clustered=False):
+    """
+    Collapses route nodes ({stop}_{route}) onto their street stop.
+    For clustered graphs, each station node's time is handed back to its member stops.
+    Returns {stop_id: shortest time found to this physical location}.
+    """
+    best_times = {}
+    stops = get_stops()
+    members = graph_builder.get_cluster_members() if clustered else None
+
+    for node, time_taken in reachable_nodes.items():
+        base_stop_id = str(node).split('_')[0]
+
+        if members and base_stop_id in members:
+            member_stops = members[base_stop_id]
+        else:
+            member_stops = [base_stop_id]
+
+        for stop_id in member_stops:
+            if stop_id not in stops:
+                continue
+
+            # Keep the shortest time found to this physical location
+            if stop_id not in best_times or time_taken < best_times[stop_id]:
+                best_times[stop_id] = time_taken
+
+    return best_times
+
+
+def measure_searches(G, origins, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0):
+    """
+    Runs one search per (lat, lon) origin.
+    Returns {'settled': average nodes settled, 'ms': average milliseconds per search}.
+    """
+    settled = 0
+    elapsed = 0.0
+
+    for lat, lon in origins:
+        first_legs = snap_to_stops(lat, lon, walk_speed_mps, max_walk_km)
+        t0 = time.perf_counter()
+        dist, _ = search_tree(G, first_legs, time_budget_mins, walk_speed_mps=walk_speed_mps)
+        elapsed += time.perf_counter() - t0
+        settled += len(dist)
+
+    return {
+        'settled': settled / max(len(origins), 1),
+        'ms': 1000 * elapsed / max(len(origins), 1)
+    }
 
 
 # =================
@@ -82,79 +326,117 @@ def get_isochrone(G, start_lat, start_lon, time_budget_mins=30, walk_speed_mps=1
     """
     Calculates the reachable area (Isochrone) from a specific point.
     """
+    best_times = isochrone_stop_times(G, start_lat, start_lon, time_budget_mins, walk_speed_mps, max_walk_km)
+    if not best_times:
+        return None
+
+    return isochrone_polygon(best_times, time_budget_mins, walk_speed_mps, max_walk_km)
+
+
+@tracing.traced('isochrone.stop_times')
+def isochrone_stop_times(G, start_lat, start_lon, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0):
+    """
+    Search half of get_isochrone: {stop_id: minutes} for every physical stop reached
+    within the budget, or None when there are none. Cached per snapped origin (see isochrone_cache).
+    """
+
+    # 1. SNAP TO NETWORK
     
-    # 1. PREPARE VARIABLES
-    
-    # FIX: Convert Meters/Second to Meters/Minute
-    # 1.0 m/s * 60 = 60 m/min
-    walk_speed_mpm = walk_speed_mps * 60.0  
-    
-    # 2. SNAP TO NETWORK
-    
-    user_rad = np.deg2rad([[start_lat, start_lon]])
-    radius_rad = max_walk_km / 6371.0
-    indices, distances = TREE.query_radius(user_rad, r=radius_rad, return_distance=True)
-    
-    nearby_indices = indices[0]
-    nearby_distances_rad = distances[0]
+    first_legs = snap_to_stops(start_lat, start_lon, walk_speed_mps, max_walk_km)
     
-    if len(nearby_indices) == 0:
+    if len(first_legs) == 0:
         print("Warning: No stops found within walking distance.")
         return None
 
-    user_node = "USER_START"
-    
-    # Add temporary edges from USER to nearby stops
-    for idx, dist_rad in zip(nearby_indices, nearby_distances_rad):
-        stop_id = str(stops_df.iloc[idx]['stop_id'])
-        dist_meters = dist_rad * 6371000
-        walk_time_min = dist_meters / walk_speed_mpm
-        
-        if walk_time_min < time_budget_mins:
-            # We add edges to Street Nodes (which are just the stop_id string)
-            G.add_edge(user_node, stop_id, weight=walk_time_min)
+    return stop_times_from_legs(G, first_legs, time_budget_mins, walk_speed_mps, max_walk_km)
 
-    # 3. RUN DIJKSTRA
-    
-    try:
-        reachable_nodes = nx.single_source_dijkstra_path_length(
-            G, 
-            source=user_node, 
-            cutoff=time_budget_mins, 
-            weight='weight'
-        )
-    except:
-        # Handle case where user_node isn't connected to anything
-        G.remove_node(user_node)
-        return None
-    
-    # DEBUG: Check if we boarded a bus
-    # Look for any node that has an underscore (e.g., "1001_99B")
-    route_nodes_reached = [n for n in reachable_nodes if "_" in str(n)]
-    print(f"DEBUG: Reached {len(reachable_nodes)} total nodes.")
-    print(f"DEBUG: Boarded {len(route_nodes_reached)} bus/train vehicles.")
+
+def stop_times_from_legs(G, first_legs, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0):
+    """
+    isochrone_stop_times from an origin already snapped with snap_to_stops, so one
+    snap can serve searches on several graphs.
+    """
+
+    # Clicks with the same first stops (and walk times to them) share one search
+    cache_key = isochrone_cache.search_key(G, first_legs, time_budget_mins, walk_speed_mps, max_walk_km)
+    if cache_key is not None:
+        found, best_times = isochrone_cache.get(cache_key)
+        if found:
+            return dict(best_times) if best_times else None
+
+    # 2. RUN DIJKSTRA
     
-    # Cleanup
-    G.remove_node(user_node)
+    reachable_nodes, _ = search_tree(G, first_legs, time_budget_mins, walk_speed_mps=walk_speed_mps)
     
-    if len(reachable_nodes) <= 1:
+    if len(reachable_nodes) == 0:
+        if cache_key is not None:
+            isochrone_cache.put(cache_key, None)
         return None
-        
-    
-    # 4. CREATE ISOCHRONE
-    best_times = {}
 
-    for node, time_taken in reachable_nodes.items():
-        base_stop_id = str(node).split('_')[0]
-        
-        if base_stop_id not in STOPS_DICT:
-            continue
-            
-        # Keep the shortest time found to this physical location
-        if base_stop_id not in best_times:
-            best_times[base_stop_id] = time_taken
-        else:
-            best_times[base_stop_id] = min(best_times[base_stop_id], time_taken)
+    best_times = physical_stop_times(reachable_nodes, clustered=G.graph.get('clustered', False))
+    if cache_key is not None:
+        isochrone_cache.put(cache_key, dict(best_times))
+
+    span = tracing.current()
+    if span.recording:
+        # Route nodes have an underscore (e.g., "1001_99B"): one per vehicle boarded
+        span.set(
+            nodes=len(reachable_nodes),
+            boarded=sum(1 for n in reachable_nodes if "_" in str(n)),
+            stops=len(best_times)
+        )
+
+    return best_times
+
+
+@tracing.traced('isochrone.geometry')
+def isochrone_polygon(best_times, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0):
+    """
+    Geometry half of get_isochrone: a walking circle around every reached stop sized by
+    its leftover time, merged and clipped to the land the stops stand on.
+    Polygons already drawn for the same stop times and settings come from isochrone_cache.
+    """
+
+    cache_key = isochrone_cache.geometry_key(best_times, time_budget_mins, walk_speed_mps, max_walk_km)
+    found, wkb = isochrone_cache.get(cache_key)
+    if found:
+        return None if wkb is None else gpd.GeoDataFrame(geometry=[shapely.from_wkb(wkb)], crs="EPSG:4326")
+
+    gdf_final = _build_isochrone_polygon(best_times, time_budget_mins, walk_speed_mps, max_walk_km)
+    isochrone_cache.put(cache_key, None if gdf_final is None else shapely.to_wkb(gdf_final.geometry.iloc[0]))
+    return gdf_final
+
+
+def _build_isochrone_polygon(best_times, time_budget_mins, walk_speed_mps, max_walk_km):
+    area = isochrone_area(best_times, time_budget_mins, walk_speed_mps, max_walk_km)
+    if area is None:
+        return None
+
+    return gpd.GeoDataFrame(geometry=[area], crs="EPSG:3005").to_crs("EPSG:4326")
+
+
+def project_stops(stop_ids):
+    """{stop_id: (x, y)} in BC Albers (EPSG:3005), projected in one pass."""
+    stops = get_stops()
+    stop_ids = list(stop_ids)
+    points = gpd.GeoSeries(
+        gpd.points_from_xy([stops[s]['lon'] for s in stop_ids], [stops[s]['lat'] for s in stop_ids]),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3005")
+    return dict(zip(stop_ids, zip(points.x, points.y)))
+
+
+def isochrone_area(best_times, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0, projected=None):
+    """
+    The isochrone polygon as a shapely geometry in BC Albers (EPSG:3005), or None.
+    projected ({stop_id: (x, y)} from project_stops) lets callers drawing several
+    isochrones over the same stops project them only once.
+    """
+
+    # FIX: Convert Meters/Second to Meters/Minute
+    # 1.0 m/s * 60 = 60 m/min
+    walk_speed_mpm = walk_speed_mps * 60.0  
+    stops = get_stops()
 
     # Generate Geometry
     results = []
@@ -169,45 +451,110 @@ def get_isochrone(G, start_lat, start_lon, time_budget_mins=30, walk_speed_mps=1
         
         # We only draw if the circle is meaningful (> 10 meters)
         if radius_meters > 10:
-            info = STOPS_DICT[stop_id]
+            info = stops[stop_id]
             results.append({
+                'stop_id': stop_id,
                 'geometry': Point(info['lon'], info['lat']),
-                'radius': radius_meters
+                'radius': radius_meters,
+                'land_id': info.get('land_id')
             })
 
     if not results:
         return None
 
-    # Create GeoDataFrame 
-    gdf_points = gpd.GeoDataFrame(results, crs="EPSG:4326")
-    
-    # Project to BC Albers (Meters) for accurate buffering
-    gdf_points_metric = gdf_points.to_crs("EPSG:3005")
-    
-    # Buffer the points into circles
-    gdf_points_metric['geometry'] = gdf_points_metric.geometry.buffer(gdf_points_metric['radius'])
+    with tracing.span('isochrone.buffer', circles=len(results)):
+        if projected is None:
+            # Project to BC Albers (Meters) for accurate buffering
+            centres = gpd.GeoDataFrame(results, crs="EPSG:4326").to_crs("EPSG:3005").geometry.values
+        else:
+            centres = shapely.points([projected[r['stop_id']] for r in results])
+
+        # Buffer the points into circles
+        circles = shapely.buffer(centres, [r['radius'] for r in results], quad_segs=16)
     
     # Merge all circles into one blob
-    blob_metric = gdf_points_metric.union_all()
-    
-    # convert to GDF
-    gdf_single = gpd.GeoDataFrame(geometry=[blob_metric], crs="EPSG:3005")
+    with tracing.span('isochrone.union'):
+        blob_metric = shapely.union_all(circles)
 
     # We must remove all parts of the polygon that are either on top of water, 
-    # or inaccessable by walking (e.g. islands)
-    gdf_land = gpd.read_file("data/metro_vancouver_land_poly.geojson")
-    gdf_land = gdf_land.to_crs("EPSG:3005")
+    # or inaccessable by walking (e.g. islands).
+    # Only land pieces that a reached stop stands on are kept, then the blob is clipped to them.
+    # Stops just off the coastline polygon (piers, ferry docks) count as standing on the nearest piece,
+    # if it is within preprocessing.LAND_SNAP_M.
+    with tracing.span('isochrone.island_filter') as span:
+        reached_land = {r['land_id'] for r in results if r['land_id'] is not None}
+        offshore = [i for i, r in enumerate(results) if r['land_id'] is None]
+        if offshore:
+            reached_land.update(nearest_land_ids(centres[offshore], max_distance=preprocessing.LAND_SNAP_M))
+            reached_land.discard(None)
+        land_components = get_land_components()
+        land_parts = land_components.loc[land_components.index.isin(reached_land)]
+        span.set(land_pieces=len(land_parts), offshore_stops=len(offshore))
+
+    with tracing.span('isochrone.land_clip'):
+        clipped = land_parts.geometry.intersection(blob_metric)
+        return clipped.union_all()
+
+
+# Cell size of the preview grid. Coarse enough that a whole region rasterizes in a
+# few milliseconds, fine enough that the shape matches the final polygon.
+PREVIEW_CELL_M = 150
+
+# Metres per degree of latitude (and of longitude at the equator)
+METRES_PER_DEGREE = 111_320
+
+
+@tracing.traced('isochrone.preview')
+def isochrone_preview(best_times, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0, cell_m=PREVIEW_CELL_M):
+    """
+    Quick stand-in for isochrone_polygon, for drawing while the exact polygon is made.
+    Marks every grid cell within each stop's walking radius and returns the marked
+    cells as one MultiPolygon (rows of cells merged into strips). No buffering,
+    union or land clipping, so it takes milliseconds instead of seconds.
+    """
+    stops = get_stops()
+    stop_ids = list(best_times)
 
-    gdf_intersection = gpd.overlay(gdf_single, gdf_land, how='intersection')
-    gdf_exploded = gdf_intersection.dissolve().explode(index_parts=False)
-    gdf_fixed = gpd.sjoin(gdf_exploded, gdf_points_metric, predicate="contains")
-    gdf_final = gdf_fixed.dissolve().to_crs("EPSG:4326")
+    lon = np.array([stops[s]['lon'] for s in stop_ids])
+    lat = np.array([stops[s]['lat'] for s in stop_ids])
+    remaining = time_budget_mins - np.array([best_times[s] for s in stop_ids], dtype=float)
+    radius = np.minimum(remaining * walk_speed_mps * 60.0, max_walk_km * 1000)
 
-    # Debug
-    # print(type(gdf_final))
-    return gdf_final
+    keep = radius > 10
+    if not keep.any():
+        return None
+    lon, lat, radius = lon[keep], lat[keep], radius[keep]
+
+    # Flat metres around the region's latitude: plenty accurate at city scale
+    lon_scale = METRES_PER_DEGREE * np.cos(np.radians(lat.mean()))
+    x = (lon - lon.min()) * lon_scale
+    y = (lat - lat.min()) * METRES_PER_DEGREE
+
+    reach = int(np.ceil(radius.max() / cell_m))
+    col = np.floor(x / cell_m).astype(int) + reach
+    row = np.floor(y / cell_m).astype(int) + reach
+    grid = np.zeros((row.max() + reach + 1, col.max() + reach + 1), dtype=bool)
+
+    # Stamp one cell offset at a time onto every stop whose radius covers it
+    for d_row in range(-reach, reach + 1):
+        for d_col in range(-reach, reach + 1):
+            covered = radius >= np.hypot(d_row, d_col) * cell_m
+            grid[row[covered] + d_row, col[covered] + d_col] = True
+
+    # Runs of marked cells along each row become one rectangle
+    padded = np.pad(grid, ((0, 0), (1, 1))).astype(np.int8)
+    edges = np.diff(padded, axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)
+
+    to_lon = lambda c: lon.min() + (c - reach) * cell_m / lon_scale
+    to_lat = lambda r: lat.min() + (r - reach) * cell_m / METRES_PER_DEGREE
+
+    cells = shapely.box(to_lon(start_cols), to_lat(start_rows), to_lon(end_cols), to_lat(start_rows + 1))
+    return gpd.GeoDataFrame(geometry=[shapely.multipolygons(cells)], crs="EPSG:4326")
 
 # ROUTING FUNCTION
+@tracing.traced('route')
 def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max_walk_km=1.0):
     """
     Calculates the shortest path between two points.
@@ -218,75 +565,65 @@ def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max
     
     # 1. PREPARE VARIABLES
     walk_speed_mpm = walk_speed_mps * 60.0
+    stops = get_stops()
     
     # 2. SNAP START POINT (First Mile)
-    start_rad = np.deg2rad([[start_lat, start_lon]])
-    radius_rad = max_walk_km / 6371.0
-    
-    s_indices, s_dists = TREE.query_radius(start_rad, r=radius_rad, return_distance=True)
+    first_legs = snap_to_stops(start_lat, start_lon, walk_speed_mps, max_walk_km)
     
-    if len(s_indices[0]) == 0:
+    if len(first_legs) == 0:
         print("Error: Start point too far from transit.")
         return None
 
-    # Create Virtual Start Node
-    start_node = "USER_START"
-    
-    for idx, dist_rad in zip(s_indices[0], s_dists[0]):
-        stop_id = str(stops_df.iloc[idx]['stop_id'])
-        dist_meters = dist_rad * 6371000
-        walk_time = dist_meters / walk_speed_mpm
-        
-        # Add edge: Start -> Stop
-        G.add_edge(start_node, stop_id, weight=walk_time, type='walk')
-
     # 3. SNAP END POINT (Last Mile)
-    end_rad = np.deg2rad([[end_lat, end_lon]])
-    e_indices, e_dists = TREE.query_radius(end_rad, r=radius_rad, return_distance=True)
+    last_legs = {}
+    for stop_id, walk_time in snap_to_stops(end_lat, end_lon, walk_speed_mps, max_walk_km):
+        last_legs[stop_id] = min(walk_time, last_legs.get(stop_id, float('inf')))
     
-    if len(e_indices[0]) == 0:
+    if len(last_legs) == 0:
         print("Error: End point too far from transit.")
-        G.remove_node(start_node)
         return None
 
-    # Create Virtual End Node
-    end_node = "USER_END"
-    
-    for idx, dist_rad in zip(e_indices[0], e_dists[0]):
-        stop_id = str(stops_df.iloc[idx]['stop_id'])
-        dist_meters = dist_rad * 6371000
-        walk_time = dist_meters / walk_speed_mpm
-        
-        # Add edge: Stop -> End
-        G.add_edge(stop_id, end_node, weight=walk_time, type='walk')
+    last_legs = dict(graph_builder.to_graph_stops(G, last_legs.items()))
 
     # 4. RUN SHORTEST PATH
-    try:
-        node_path = nx.shortest_path(G, source=start_node, target=end_node, weight='weight')
-        total_time = nx.shortest_path_length(G, source=start_node, target=end_node, weight='weight')
-    except nx.NetworkXNoPath:
+    # Saved hub labels give the exact travel time up front, which caps how far the search goes
+    bound = float('inf')
+    labels = hub_labels.load_hub_labels(G, walk_speed_mps)
+    if labels is not None:
+        bound = hub_labels.label_travel_time(labels, graph_builder.to_graph_stops(G, first_legs), last_legs.items()) + 1e-3
+
+    dist, pred = search_tree(G, first_legs, bound, last_legs=last_legs, walk_speed_mps=walk_speed_mps)
+    
+    arrivals = [(dist[stop_id] + walk_time, stop_id) for stop_id, walk_time in last_legs.items() if stop_id in dist]
+    if not arrivals:
         print("No path found between points.")
-        G.remove_node(start_node)
-        G.remove_node(end_node)
         return None
 
-    # 5. CLEANUP GRAPH
-    G.remove_node(start_node)
-    G.remove_node(end_node)
+    total_time, last_stop = min(arrivals)
+
+    # 5. WALK BACK THE TREE
+    node_path = ["USER_END"]
+    node = last_stop
+    while node is not None:
+        node_path.append(node)
+        node = pred[node]
+    node_path.append("USER_START")
+    node_path.reverse()
 
 # 6. PRINT TEXT INSTRUCTIONS 
     print(f"\n--- PATH FOUND ({total_time:.1f} mins) ---")
     
     step_count = 1
     steps = []
+
+    # Contracted graphs unfold their shortcut edges back into single legs here
+    legs = graph_builder.expand_path(G, node_path, walk_speed_mps)
     
-    for i in range(len(node_path) - 1):
-        u = node_path[i]
-        v = node_path[i+1]
+    for u, v, edge_data in legs:
         
         # 1. (User -> First Stop)
         if u == "USER_START":
-            stop_name = STOPS_DICT.get(v, {}).get('name', v)
+            stop_name = stops.get(v, {}).get('name', v)
             steps.append(f"{step_count}. Walk to {stop_name}")
             step_count += 1
             continue
@@ -298,14 +635,12 @@ def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max
             continue
 
         # 3. Handle Internal Graph Edges
-        edge_data = G.get_edge_data(u, v)
-        
         if edge_data:
             move_type = edge_data.get('type', 'unknown')
             weight = edge_data.get('weight', 0)
             
             if move_type == 'walk':
-                stop_name_v = STOPS_DICT.get(str(v), {}).get('name', v)
+                stop_name_v = stops.get(str(v), {}).get('name', v)
                 steps.append(f"{step_count}. Walk to {stop_name_v} ({weight:.1f} min)")
 
                 step_count += 1
@@ -318,7 +653,7 @@ def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max
                 
             elif move_type == 'travel':
                 base_v = v.split('_')[0]
-                stop_name_v = STOPS_DICT.get(base_v, {}).get('name', base_v)
+                stop_name_v = stops.get(base_v, {}).get('name', base_v)
                 steps.append(f"   -> Ride to {stop_name_v} ({weight:.1f} min)")
                 
             elif move_type == 'deboard':
@@ -329,15 +664,12 @@ def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max
     
     coords.append((start_lon, start_lat))
     
-    for i in range(len(node_path) - 1):
-        u = node_path[i]
-        v = node_path[i+1]
+    for u, v, edge_data in legs:
         
         if u in ["USER_START", "USER_END"]: continue
         
         # Check Edge
-        if G.has_edge(u, v):
-            edge_data = G.edges[u, v]
+        if edge_data is not None:
             
             # Try to get curves
             curves = get_geometry_for_edge(edge_data)
@@ -348,8 +680,8 @@ def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max
                 # Straight Line Fallback
                 # (Strip route ID to get stop lat/lon)
                 base_v = str(v).split('_')[0]
-                if base_v in STOPS_DICT:
-                    info = STOPS_DICT[base_v]
+                if base_v in stops:
+                    info = stops[base_v]
                     coords.append((info['lon'], info['lat']))
                     
     # Add End
@@ -358,25 +690,88 @@ def get_route(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max
     line = LineString(coords)
     return gpd.GeoDataFrame({'geometry': [line], 'time_min': [total_time]}, crs="EPSG:4326"), steps
 
+# TRAVEL TIME FUNCTION
+def get_travel_time(G, start_lat, start_lon, end_lat, end_lon, walk_speed_mps=1.0, max_walk_km=1.0):
+    """
+    Door-to-door travel time in minutes, or None when there is no path.
+    Merges saved hub labels when the graph has them (see hub_labels.py),
+    otherwise runs the same search as get_route.
+    """
+    first_legs = graph_builder.to_graph_stops(G, snap_to_stops(start_lat, start_lon, walk_speed_mps, max_walk_km))
+    last_legs = dict(graph_builder.to_graph_stops(G, snap_to_stops(end_lat, end_lon, walk_speed_mps, max_walk_km)))
+
+    if not first_legs or not last_legs:
+        return None
+
+    labels = hub_labels.load_hub_labels(G, walk_speed_mps)
+    if labels is not None:
+        total_time = hub_labels.label_travel_time(labels, first_legs, last_legs.items())
+    else:
+        dist, _ = search_tree(G, first_legs, float('inf'), last_legs=last_legs, walk_speed_mps=walk_speed_mps)
+        total_time = min((dist[n] + walk_time for n, walk_time in last_legs.items() if n in dist), default=float('inf'))
+
+    return None if total_time == float('inf') else total_time
+
+
+@tracing.traced('matrix')
+def travel_time_matrix(G, origins, destinations, walk_speed_mps=1.0, max_walk_km=1.0, max_minutes=None):
+    """
+    Door-to-door minutes from every (lat, lon) in origins to every one in destinations,
+    as one row per origin (None where there is no path within max_minutes). Each origin
+    and destination is snapped once, and each origin needs one search (or label merges).
+    """
+    budget = float('inf') if max_minutes is None else max_minutes
+    labels = hub_labels.load_hub_labels(G, walk_speed_mps)
+    destination_legs = [
+        dict(graph_builder.to_graph_stops(G, snap_to_stops(lat, lon, walk_speed_mps, max_walk_km)))
+        for lat, lon in destinations
+    ]
+
+    rows = []
+    for lat, lon in origins:
+        first_legs = graph_builder.to_graph_stops(G, snap_to_stops(lat, lon, walk_speed_mps, max_walk_km))
+        if not first_legs:
+            rows.append([None] * len(destinations))
+            continue
+
+        if labels is None:
+            dist, _ = search_tree(G, first_legs, budget, walk_speed_mps=walk_speed_mps)
+
+        row = []
+        for last_legs in destination_legs:
+            if not last_legs:
+                total_time = float('inf')
+            elif labels is not None:
+                total_time = hub_labels.label_travel_time(labels, first_legs, last_legs.items())
+            else:
+                total_time = min((dist[n] + walk_time for n, walk_time in last_legs.items() if n in dist), default=float('inf'))
+            row.append(None if total_time == float('inf') or total_time > budget else total_time)
+        rows.append(row)
+
+    tracing.current().set(origins=len(origins), destinations=len(destinations))
+    return rows
+
 # ==========================================
 # TEST SCRIPT
 # ==========================================
 if __name__ == "__main__":
-    import graph_builder
     
     TEST_LAT = 49.26259
     TEST_LON = -123.0768
     TEST_TIME = "08:00"
     BUDGET = 30
+    TEST_NETWORK = 'data/network_edges_1_skytrain_bridges.pkl'
     
     print(f"--- Running Test ---")
     print("Building Graph...")
-    G = graph_builder.build_graph(TEST_TIME, window_mins=60)
+    with open(TEST_NETWORK, 'rb') as f:
+        network_edges = pickle.load(f)
+    G = graph_builder.build_graph(network_edges, TEST_TIME, window_mins=60)
 
     print("Calculating Isochrone...")
     final_gdf = get_isochrone(G, TEST_LAT, TEST_LON, time_budget_mins=BUDGET)
     
-    if not final_gdf.empty:
+    if final_gdf is not None and not final_gdf.empty:
         print("Saving 'test_isochrone.geojson'...")
         final_gdf.to_file("data/test_isochrone.geojson", driver="GeoJSON")
         print("Done! Check file in QGIS.")
@@ -390,9 +785,10 @@ if __name__ == "__main__":
     DEST_LAT = 49.2858
     DEST_LON = -123.1115
     
-    route_gdf = get_route(G, TEST_LAT, TEST_LON, DEST_LAT, DEST_LON)
+    route = get_route(G, TEST_LAT, TEST_LON, DEST_LAT, DEST_LON)
     
-    if route_gdf is not None:
+    if route is not None:
+        route_gdf, steps = route
         print("Saving 'test_route.geojson'...")
         route_gdf.to_file("data/test_route.geojson", driver="GeoJSON")
         print("Done! Drag 'test_route.geojson' into QGIS.")
\ No newline at end of file
@@ -5,17 +5,188 @@ from ipyleaflet import AwesomeIcon
 from shapely.geometry import Point, shape
 import ipyleaflet as L
 import geopandas as gpd
-import json
-import pickle
 import os
 import re
+import asyncio
+import contextvars
+import numpy as np
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 # Import modules
 import analysis
-import preprocessing
-import graph_builder
+import atlas
+import comparison
+import isochrone_cache
+import memory
+import service_calendar
+import tracing
 
-LAND_GDF = gpd.read_file("data/metro_vancouver_land_poly.geojson")
+@memory.component('land')
+@lru_cache(maxsize=None)
+def get_land():
+    """Land polygon for the origin check, read on the first click rather than at startup."""
+    return gpd.read_file("data/metro_vancouver_land_poly.geojson")
+
+
+# =====================
+# BACKGROUND WORK
+# =====================
+
+# Shared by all sessions, so concurrent users queue here instead of freezing each other
+WORKERS = ThreadPoolExecutor(max_workers=max(2, min(4, os.cpu_count() or 1)))
+
+# Spans feed each session's latency panel; TRANSIT_TRACE_LOG=path also logs them as
+# JSON lines, and TRANSIT_TRACE=0 switches tracing off
+if os.environ.get('TRANSIT_TRACE') != '0':
+    tracing.enable(os.environ.get('TRANSIT_TRACE_LOG'))
+
+
+async def in_background(func, *args):
+    """Runs func(*args) on the worker pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    # The worker inherits this context, so its spans nest and reach the session's collectors
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(WORKERS, context.run, partial(func, *args))
+
+
+@tracing.traced('request.graph')
+def load_graph(selected_date, selected_toggles, time_str, freq_mod):
+    """
+    Graph for the services running on selected_date (None when nothing runs).
+    Dates running the same services share one cached network file.
+    """
+    return service_calendar.graph_for_date(selected_date, selected_toggles, time_str, freq_mod)
+
+
+@tracing.traced('request.isochrone_search')
+def isochrone_search(G, coords, budget, speed, max_walk):
+    """
+    Reached stops for the isochrone at coords, a coarse preview of its area and, when
+    the click is answered from the atlas, the exact polygon, with the settings used
+    (None off land or with no stops).
+    """
+    if not get_land().contains(Point(coords[1], coords[0])).any():
+        return None
+
+    # Precomputed clicks (see atlas.py) need neither the search nor the preview
+    hit = atlas.lookup(G, coords[0], coords[1], budget, speed, max_walk)
+    if hit is not None:
+        best_times, polygon = hit
+        preview = None if polygon is not None else analysis.isochrone_preview(best_times, budget, speed, max_walk)
+        return best_times, preview, polygon, budget, speed, max_walk
+
+    best_times = analysis.isochrone_stop_times(
+        G=G,
+        start_lat=coords[0],
+        start_lon=coords[1],
+        time_budget_mins=budget,
+        walk_speed_mps=speed,
+        max_walk_km=max_walk
+    )
+    if not best_times:
+        return None
+
+    preview = analysis.isochrone_preview(best_times, budget, speed, max_walk)
+    return best_times, preview, None, budget, speed, max_walk
+
+
+def isochrone_geometry(best_times, polygon, budget, speed, max_walk):
+    """The exact polygon: the atlas's when the search came from there, otherwise built now."""
+    if polygon is not None:
+        return polygon
+    return analysis.isochrone_polygon(best_times, budget, speed, max_walk)
+
+
+# Scenarios are compared against the full network at normal frequency
+BASELINE_TOGGLES = ("skytrain", "bridges")
+
+
+@tracing.traced('request.compare')
+def isochrone_comparison(G_base, G, coords, budget, speed, max_walk):
+    """comparison.compare_isochrones from coords, or None off land or with no stops."""
+    if not get_land().contains(Point(coords[1], coords[0])).any():
+        return None
+
+    return comparison.compare_isochrones(G_base, G, coords[0], coords[1], budget, speed, max_walk)
+
+
+def comparison_summary(summary):
+    """One line on what the scenario loses (or gains) against the baseline."""
+    text = (f"{summary['lost_km2']:.1f} km² lost of {summary['baseline_km2']:.1f} km², "
+            f"{summary['stops_lost']} stops out of reach, {summary['stops_slower']} slower "
+            f"(+{summary['minutes_added']:.0f} min in total)")
+    if summary['gained_km2'] >= 0.05:
+        text += f", {summary['gained_km2']:.1f} km² and {summary['stops_gained']} stops gained"
+    return text + "."
+
+
+def route_search(G, orig, dest, speed, walk):
+    """(route_gdf, steps), or (None, None) when routing fails."""
+    try:
+        # SAFETY CHECK: Handle if analysis.get_route returns 1 or 2 values
+        result = analysis.get_route(
+            G=G,
+            start_lat=orig[0], start_lon=orig[1],
+            end_lat=dest[0], end_lon=dest[1],
+            walk_speed_mps=speed, max_walk_km=walk
+        )
+        
+        # If function returns tuple (gdf, steps)
+        if isinstance(result, tuple) and len(result) == 2:
+            return result[0], result[1]
+        
+        # If function returns just gdf (fallback)
+        return result, ["Route calculated (Update analysis.py for steps)"]
+
+    except Exception as e:
+        print(f"Routing Error: {e}")
+        return None, None
+
+
+# =====================
+# MAP PAYLOADS
+# =====================
+
+# Every layer crosses the widget comm as GeoJSON, so geometry is cut down to what
+# the current zoom can show before it is sent. Leaflet tiles are 256 px wide, so at
+# zoom z one pixel spans 360 / (256 * 2**z) degrees.
+SIMPLIFY_PIXELS = 0.5
+
+
+def pixel_degrees(zoom):
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def geojson_payload(gdf, zoom, layer_name):
+    """
+    GeoJSON dict of gdf for an L.GeoJSON layer viewed at zoom: simplified without
+    breaking topology to within SIMPLIFY_PIXELS of a pixel, and coordinates rounded
+    to the decimals that still resolve it. Built straight from the shapely
+    geometries, with no to_json/loads round trip. The map.serialize span records how
+    long that took and how many features and vertices are sent.
+    """
+    with tracing.span('map.serialize', layer=layer_name, zoom=zoom) as span:
+        tolerance = SIMPLIFY_PIXELS * pixel_degrees(zoom)
+        decimals = max(0, int(np.ceil(-np.log10(tolerance))))
+
+        geoms = shapely.simplify(gdf.geometry.values, tolerance, preserve_topology=True)
+        geoms = shapely.set_precision(geoms, 10.0 ** -decimals)
+        geoms = shapely.transform(geoms, lambda coords: np.round(coords, decimals))
+
+        attributes = gdf.drop(columns=gdf.geometry.name)
+        properties = attributes.to_dict('records') if len(attributes.columns) else [{}] * len(gdf)
+        payload = {
+            'type': 'FeatureCollection',
+            'features': [
+                {'type': 'Feature', 'properties': props, 'geometry': shapely.geometry.mapping(geom)}
+                for geom, props in zip(geoms, properties) if not geom.is_empty
+            ]
+        }
+        span.set(features=len(payload['features']), vertices=int(shapely.get_num_coordinates(geoms).sum()))
+
+    return payload
 
 # =====================
 # UI
@@ -25,7 +196,7 @@ app_ui = ui.page_sidebar(
     
     ui.sidebar(
         ui.h4("Settings", style="margin-top: 0; font-weight: bold;"),
-        ui.input_select("day", "Select Day", choices=["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]),
+        ui.input_date("date", "Select Date"),
         ui.input_text(
             "start_time", 
             "Select Start Time:", 
@@ -43,6 +214,7 @@ app_ui = ui.page_sidebar(
                                     selected=["skytrain", "bridges"]),
             style="margin-bottom: -10px;" 
         ),
+        ui.input_checkbox("compare", "Show loss against the full network", False),
         
         ui.hr(style="margin-top: 5px; margin-bottom: 10px;"), 
         
@@ -51,6 +223,21 @@ app_ui = ui.page_sidebar(
             ui.div(style="height: 5px;"), 
             ui.input_action_button("clear_map", "Clear Map", class_="btn-danger w-100"),
         ),
+
+        # Timings of this session's requests, from the tracing spans
+        ui.tags.details(
+            ui.tags.summary("Latency", style="font-size: 13px; color: #666; cursor: pointer;"),
+            ui.output_ui("latency_panel"),
+            ui.input_action_link("profile_next", "Profile next request"),
+            style="margin-top: 10px;"
+        ),
+
+        # What the cached data and graphs hold, against TRANSIT_MEMORY_BUDGET_MB if set
+        ui.tags.details(
+            ui.tags.summary("Memory", style="font-size: 13px; color: #666; cursor: pointer;"),
+            ui.output_ui("memory_panel"),
+            style="margin-top: 5px;"
+        ),
     ),
 
     ui.head_content(
@@ -108,6 +295,9 @@ app_ui = ui.page_sidebar(
         # We use a standard absolute div to ensure it doesn't block the map
         ui.output_ui("itinerary_panel"),
 
+        # 3. BACKGROUND WORK IN PROGRESS
+        ui.output_ui("status_panel"),
+
         style="padding: 0; height: 90vh; position: relative;" # relative needed for absolute child
     )
 )
@@ -125,7 +315,15 @@ def server(input, output, session):
     current_iso_geom = reactive.Value(None)
     # Store route steps here
     current_steps = reactive.Value(None)
-    cache_state = {"last_day": None}
+    # Whether clicks compare the settings with the full network (see start_graph)
+    comparing = reactive.Value(False)
+    cache_state = {"last_date": None}
+    # Full-detail geometry behind each drawn layer, re-simplified when the zoom changes
+    drawn_layers = {}
+    # Everything one click draws, cleared by the next
+    isochrone_layers = ['isochrone', 'isochrone_preview', 'isochrone_baseline', 'isochrone_loss']
+    # Spans finished on behalf of this session
+    latency = tracing.LatencySummary()
 
     # Initialize Map
     map_obj = L.Map(center=(49.21340119048903, -122.93785360348627), zoom=11, layout=Layout(height='100%'), scroll_wheel_zoom=True)
@@ -153,13 +351,13 @@ def server(input, output, session):
 
             if active_poly is not None and active_poly.contains(click_point):
                 # === CLICK INSIDE: SET DESTINATION ===
-                print(f"📍 Destination Clicked: {coords}")
+                tracing.event('click.destination', lat=coords[0], lon=coords[1])
                 dest_marker.location = coords
                 dest_marker.visible = True
                 destination_coords.set(coords)
             else:
                 # === CLICK OUTSIDE: NEW ORIGIN ===
-                print(f"📍 New Origin Clicked: {coords}")
+                tracing.event('click.origin', lat=coords[0], lon=coords[1])
                 
                 # Update UI Markers
                 user_marker.location = coords
@@ -174,6 +372,9 @@ def server(input, output, session):
             
     map_obj.on_interaction(handle_click)
 
+    map_zoom = reactive.Value(round(map_obj.zoom))
+    map_obj.observe(lambda change: map_zoom.set(round(change['new'])), names='zoom')
+
     @render_widget
     def map_display():
         return map_obj
@@ -184,7 +385,12 @@ def server(input, output, session):
     @reactive.Effect
     @reactive.event(input.clear_map)
     def clear_all():
-        print("🗑️ Clearing Map")
+        tracing.event('clear_map')
+        search_task.cancel()
+        polygon_task.cancel()
+        compare_task.cancel()
+        route_task.cancel()
+
         origin_coords.set(None)
         destination_coords.set(None)
         current_iso_geom.set(None)
@@ -193,126 +399,228 @@ def server(input, output, session):
         user_marker.visible = False
         dest_marker.visible = False
         
-        for layer in map_obj.layers:
-            if getattr(layer, 'name', '') in ['isochrone', 'route_path']:
-                map_obj.remove_layer(layer)
+        clear_layers(isochrone_layers + ['route_path'])
 
     # ---------------------------------------------------------
     # DATA & GRAPH
     # ---------------------------------------------------------
-    @reactive.Calc
-    def get_network_data():
-        input.submit() 
+    # Every heavy step runs as an extended task on the worker pool, so the session
+    # keeps responding while it works. Starting a new request cancels the previous
+    # one: its remaining steps never run and its result is never drawn.
+    @reactive.extended_task
+    async def graph_task(selected_date, selected_toggles, time_str, freq_mod):
+        with tracing.collect(latency):
+            return await in_background(load_graph, selected_date, selected_toggles, time_str, freq_mod)
+
+    # With "Show loss" on, the full network at the same date and time is loaded too
+    @reactive.extended_task
+    async def baseline_task(selected_date, time_str):
+        with tracing.collect(latency):
+            return await in_background(load_graph, selected_date, BASELINE_TOGGLES, time_str, 1.0)
+
+    @reactive.Effect
+    @reactive.event(input.submit, ignore_none=False)
+    def start_graph():
         with reactive.isolate():
-            selected_day = input.day()
+            selected_date = input.date()
             selected_toggles = input.toggles()
+            time_str = input.start_time()
+            freq_mod = input.frequency()
+            compare = input.compare()
 
-        day_map = {
-                "Monday": 1, "Tuesday": 1, "Wednesday": 1, "Thursday": 1, "Friday": 1, "Saturday": 2, "Sunday": 3
-            }
-        
-        # CACHE CHECK
-        path = f'data/network_edges_{day_map[selected_day]}_{"_".join(selected_toggles)}.pkl'
-
-        # RUN PREPROCESSING IF NETWORK IS NEW
-        if not os.path.exists(path):
-            preprocessing.process_network(day_id=day_map[selected_day], toggles = selected_toggles)
-            print(f"Generating network with day={selected_day} and toggles={selected_toggles}")
-            cache_state["last_day"] = selected_day                
-            cache_state["last_toggles"] = selected_toggles
-
-            with open(path, 'rb') as f:
-                return pickle.load(f)
-        
-        # OTHERWISE RETRIEVE NETWORK
-        else:
-            print(f"Accessing network with day={selected_day} and toggles={selected_toggles}")
-            with open(path, 'rb') as f:
-                return pickle.load(f)
+        if not re.match(r"^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$", time_str):
+            return
+
+        cache_state["last_date"] = selected_date
+        cache_state["last_toggles"] = selected_toggles
 
+        graph_task.cancel()
+        graph_task.invoke(selected_date, selected_toggles, time_str, freq_mod)
+
+        # Nothing to compare when the settings are the baseline already
+        baseline_task.cancel()
+        comparing.set(compare and (set(selected_toggles), freq_mod) != (set(BASELINE_TOGGLES), 1.0))
+        if comparing.get():
+            baseline_task.invoke(selected_date, time_str)
 
     @reactive.Calc
     def current_graph():
-        network_data = get_network_data()
-        req(network_data)
-        with reactive.isolate():
-            time_str = input.start_time()
-            freq_mod = input.frequency()
+        G = graph_task.result()
+        req(G)
+        return G
 
-        if not re.match(r"^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$", time_str):
-            return None
-        
-        return graph_builder.build_graph(
-            network_edges = network_data,
-            current_time_str=time_str,
-            window_mins=60,
-            frequency_modifier=freq_mod
-        )
+    @reactive.Calc
+    def baseline_graph():
+        G = baseline_task.result()
+        req(G)
+        return G
+
+    @reactive.Effect
+    def report_no_service():
+        if graph_task.result() is None:
+            ui.notification_show(f"No transit service found on {cache_state['last_date']}.", type="warning")
 
     # ---------------------------------------------------------
     # ISOCHRONE CALCULATION
     # ---------------------------------------------------------
-    @reactive.Calc
-    def isochrone_data():
-        G = current_graph()
+    # Two steps: the search (fast) comes back with a coarse grid preview of the
+    # area, then the exact land-clipped polygon (slow) replaces it.
+    @reactive.extended_task
+    async def search_task(G, coords, budget, speed, max_walk):
+        with tracing.collect(latency):
+            return await in_background(isochrone_search, G, coords, budget, speed, max_walk)
+
+    @reactive.extended_task
+    async def polygon_task(best_times, polygon, budget, speed, max_walk):
+        with tracing.collect(latency):
+            return await in_background(isochrone_geometry, best_times, polygon, budget, speed, max_walk)
+
+    # Comparing runs both searches and polygons in one step, and replaces the two above
+    @reactive.extended_task
+    async def compare_task(G_base, G, coords, budget, speed, max_walk):
+        with tracing.collect(latency):
+            return await in_background(isochrone_comparison, G_base, G, coords, budget, speed, max_walk)
+
+    @reactive.Effect
+    def start_isochrone():
         coords = origin_coords.get()
-        req(coords, G)
-        
+
+        # A new origin (or graph) supersedes whatever is still running
+        search_task.cancel()
+        polygon_task.cancel()
+        compare_task.cancel()
+
+        req(coords)
+        G = current_graph()
+
         with reactive.isolate():
             budget = input.budget()
             speed = input.walk_speed()
             max_walk = input.max_walk()
 
-        if not LAND_GDF.contains(Point(coords[1], coords[0])).any():
-            return None
-        
-        print("Calculating Isochrone...")
-        gdf = analysis.get_isochrone(
-            G=G,
-            start_lat=coords[0],
-            start_lon=coords[1],
-            time_budget_mins=budget,
-            walk_speed_mps=speed,
-            max_walk_km=max_walk
-        )
-        return gdf
+        if comparing.get():
+            compare_task.invoke(baseline_graph(), G, coords, budget, speed, max_walk)
+        else:
+            search_task.invoke(G, coords, budget, speed, max_walk)
 
     # ---------------------------------------------------------
     # ROUTE CALCULATION
     # ---------------------------------------------------------
-    @reactive.Calc
-    def route_data():
+    @reactive.extended_task
+    async def route_task(G, orig, dest, speed, walk):
+        with tracing.collect(latency):
+            return await in_background(route_search, G, orig, dest, speed, walk)
+
+    @reactive.Effect
+    def start_route():
         orig = origin_coords.get()
         dest = destination_coords.get()
+
+        route_task.cancel()
         req(orig, dest)
         
         with reactive.isolate():
             G = current_graph()
             speed = input.walk_speed()
             walk = input.max_walk()
-            req(G)
 
-        print(f"Calculating Route from {orig} to {dest}")
-        
-        try:
-            # SAFETY CHECK: Handle if analysis.get_route returns 1 or 2 values
-            result = analysis.get_route(
-                G=G,
-                start_lat=orig[0], start_lon=orig[1],
-                end_lat=dest[0], end_lon=dest[1],
-                walk_speed_mps=speed, max_walk_km=walk
-            )
-            
-            # If function returns tuple (gdf, steps)
-            if isinstance(result, tuple) and len(result) == 2:
-                return result[0], result[1]
-            
-            # If function returns just gdf (fallback)
-            return result, ["Route calculated (Update analysis.py for steps)"]
+        route_task.invoke(G, orig, dest, speed, walk)
+
+    # ---------------------------------------------------------
+    # UI: STATUS
+    # ---------------------------------------------------------
+    @render.ui
+    def status_panel():
+        running = [
+            label for task, label in [
+                (graph_task, "Building network..."),
+                (baseline_task, "Building baseline network..."),
+                (search_task, "Searching..."),
+                (compare_task, "Comparing with the full network..."),
+                (polygon_task, "Drawing isochrone..."),
+                (route_task, "Routing...")
+            ]
+            if task.status() == "running"
+        ]
+
+        if not running:
+            return None
 
-        except Exception as e:
-            print(f"Routing Error: {e}")
-            return None, None
+        return ui.HTML(f"""
+            <div style="
+                position: absolute;
+                bottom: 20px;
+                left: 10px;
+                z-index: 1000;
+                padding: 8px 14px;
+                background-color: rgba(0, 0, 0, 0.7);
+                color: white;
+                border-radius: 8px;
+                font-family: -apple-system, sans-serif;
+                font-size: 13px;
+            ">{" ".join(running)}</div>
+        """)
+
+    # ---------------------------------------------------------
+    # UI: LATENCY
+    # ---------------------------------------------------------
+    @render.ui
+    def latency_panel():
+        # Refresh whenever a task starts or finishes, or the map is redrawn
+        for task in (graph_task, baseline_task, search_task, polygon_task, compare_task, route_task):
+            task.status()
+        map_zoom.get()
+
+        rows = latency.rows()
+        if not rows:
+            return ui.p("No requests yet.", style="font-size: 12px; color: #888;")
+
+        cells = "".join(
+            f"<tr><td>{r['name']}</td><td>{r['count']}</td>"
+            f"<td>{r['last_ms']:.0f}</td><td>{r['p50_ms']:.0f}</td><td>{r['p95_ms']:.0f}</td></tr>"
+            for r in rows
+        )
+        return ui.HTML(f"""
+            <table style="font-size: 11px; width: 100%;">
+                <tr><th>span</th><th>n</th><th>last</th><th>p50</th><th>p95</th></tr>
+                {cells}
+            </table>
+            <div style="font-size: 11px; color: #888;">milliseconds</div>
+        """)
+
+    # ---------------------------------------------------------
+    # UI: MEMORY
+    # ---------------------------------------------------------
+    @render.ui
+    def memory_panel():
+        for task in (graph_task, baseline_task, search_task, polygon_task, compare_task, route_task):
+            task.status()
+
+        totals = memory.process()
+        budget = f"{totals['budget_mb']:.0f} MB" if totals['budget_mb'] is not None else "none"
+        cache = isochrone_cache.stats()
+        cells = "".join(
+            f"<tr><td>{r['component']}{' (mapped)' if r['mapped'] else ''}</td>"
+            f"<td>{r['held_mb']:.1f}</td><td>{r['rss_mb']:.1f}</td><td>{r['evictions']}</td></tr>"
+            for r in memory.report()
+        )
+        return ui.HTML(f"""
+            <table style="font-size: 11px; width: 100%;">
+                <tr><th>component</th><th>held</th><th>rss</th><th>evicted</th></tr>
+                {cells}
+            </table>
+            <div style="font-size: 11px; color: #888;">
+                MB. Process RSS {totals['rss_mb']:.0f} (peak {totals['peak_rss_mb']:.0f}), budget {budget}.
+                Isochrone cache: {cache['entries']} results, {cache['hit_rate']:.0%} hit rate.
+            </div>
+        """)
+
+    @reactive.Effect
+    @reactive.event(input.profile_next)
+    def arm_profiler():
+        engine = os.environ.get('TRANSIT_PROFILER', 'cprofile')
+        tracing.profile_next(engine)
+        ui.notification_show(f"The next request will be profiled with {engine} into ./profiles.", type="message")
 
     # ---------------------------------------------------------
     # UI: ITINERARY PANEL (Rendered via CSS Overlay)
@@ -375,16 +683,66 @@ def server(input, output, session):
     # ---------------------------------------------------------
     # DRAW EFFECTS
     # ---------------------------------------------------------
+    def clear_layers(names):
+        for layer in map_obj.layers:
+            if getattr(layer, 'name', '') in names:
+                map_obj.remove_layer(layer)
+        for name in names:
+            drawn_layers.pop(name, None)
+
+    def add_geojson_layer(gdf, name, **style):
+        with reactive.isolate():
+            zoom = map_zoom.get()
+        with tracing.collect(latency):
+            layer = L.GeoJSON(data=geojson_payload(gdf, zoom, name), name=name, **style)
+        drawn_layers[name] = gdf
+        map_obj.add_layer(layer)
+
     @reactive.Effect
-    def draw_isochrone():
-        gdf = isochrone_data()
-        
+    @reactive.event(map_zoom)
+    def redraw_at_zoom():
+        for layer in map_obj.layers:
+            gdf = drawn_layers.get(getattr(layer, 'name', ''))
+            if gdf is not None:
+                with tracing.collect(latency):
+                    layer.data = geojson_payload(gdf, map_zoom.get(), layer.name)
+
+    def raise_marker(marker):
+        if marker in map_obj.layers:
+            map_obj.remove_layer(marker)
+            map_obj.add_layer(marker)
+
+    @reactive.Effect
+    def draw_preview():
+        result = search_task.result()
+
         # Clear existing
         current_steps.set(None) # Hides the panel
+        clear_layers(isochrone_layers + ['route_path'])
+
+        if result is None:
+            current_iso_geom.set(None)
+            return
+
+        best_times, preview, polygon, budget, speed, max_walk = result
+
+        # Preliminary result, shown until the exact polygon is ready
+        if preview is not None:
+            add_geojson_layer(
+                preview,
+                'isochrone_preview',
+                style={'color': '#2b8cbe', 'fillOpacity': 0.25, 'weight': 0}
+            )
+            raise_marker(user_marker)
+
+        polygon_task.invoke(best_times, polygon, budget, speed, max_walk)
+
+    @reactive.Effect
+    def draw_isochrone():
+        gdf = polygon_task.result()
         
-        for layer in map_obj.layers:
-            if layer.name in ['isochrone', 'route_path']:
-                map_obj.remove_layer(layer)
+        # Clear existing
+        clear_layers(isochrone_layers + ['route_path'])
 
         if gdf is None or gdf.empty:
             current_iso_geom.set(None)
@@ -392,46 +750,70 @@ def server(input, output, session):
 
         current_iso_geom.set(gdf.geometry.union_all())
 
-        geo_data = json.loads(gdf.to_json())
-        new_layer = L.GeoJSON(
-            data=geo_data, 
-            name='isochrone',
+        add_geojson_layer(
+            gdf,
+            'isochrone',
             style={'color': '#2b8cbe', 'fillOpacity': 0.4, 'weight': 2}
         )
-        
-        map_obj.add_layer(new_layer)
-        if user_marker in map_obj.layers:
-            map_obj.remove_layer(user_marker)
-            map_obj.add_layer(user_marker)
+        raise_marker(user_marker)
         
         dest_marker.visible = False
 
+    @reactive.Effect
+    def draw_comparison():
+        result = compare_task.result()
+
+        current_steps.set(None)
+        clear_layers(isochrone_layers + ['route_path'])
+
+        if result is None:
+            current_iso_geom.set(None)
+            return
+
+        # Baseline as an outline, the scenario's area in blue, and what it loses in red
+        scenario = result['scenario'].geometry.iloc[0]
+        current_iso_geom.set(None if scenario.is_empty else scenario)
+
+        add_geojson_layer(
+            result['baseline'],
+            'isochrone_baseline',
+            style={'color': '#636363', 'fillOpacity': 0, 'weight': 2, 'dashArray': '6 4'}
+        )
+        if not scenario.is_empty:
+            add_geojson_layer(
+                result['scenario'],
+                'isochrone',
+                style={'color': '#2b8cbe', 'fillOpacity': 0.4, 'weight': 2}
+            )
+        if not result['lost'].geometry.iloc[0].is_empty:
+            add_geojson_layer(
+                result['lost'],
+                'isochrone_loss',
+                style={'color': '#de2d26', 'fillOpacity': 0.45, 'weight': 0}
+            )
+        raise_marker(user_marker)
+        dest_marker.visible = False
+
+        ui.notification_show(comparison_summary(result['summary']), type="message", duration=8)
+
     @reactive.Effect
     def draw_route():
-        route_gdf, steps = route_data()
+        route_gdf, steps = route_task.result()
 
         # Update Steps State (Triggers Panel Render)
         current_steps.set(steps)
 
         # Clear existing route
-        for layer in map_obj.layers:
-            if layer.name == 'route_path':
-                map_obj.remove_layer(layer)
+        clear_layers(['route_path'])
 
         if route_gdf is None or route_gdf.empty:
             return
 
-        geo_data = json.loads(route_gdf.to_json())
-        route_layer = L.GeoJSON(
-            data=geo_data,
-            name='route_path',
+        add_geojson_layer(
+            route_gdf,
+            'route_path',
             style={'color': '#d95f0e', 'weight': 5, 'opacity': 0.8}
         )
-        
-        map_obj.add_layer(route_layer)
-        
-        if dest_marker in map_obj.layers:
-            map_obj.remove_layer(dest_marker)
-            map_obj.add_layer(dest_marker)
+        raise_marker(dest_marker)
 
 app = App(app_ui, server)
\ No newline at end of file
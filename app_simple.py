@@ -1,164 +1,407 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
 import re
 import sys
-import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import mapping
+
 import analysis
 import preprocessing
-import graph_builder
-import pickle
+import service_calendar
 # only run on acquiring new GTFS Data
 # import txt_to_csv
 
 output_dir = 'output'
-os.makedirs(output_dir, exist_ok=True)
-
-# DAY SELECTION
-while True:
-    day_options = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
-    day_map = {"monday": 1, "tuesday": 1, "wednesday": 1, "thursday": 1, "friday": 1, "saturday": 2, "sunday": 3}
-
-    day_input = input("Please enter a day of the week or press Enter to exit program:\n").strip().lower()
-
-    if not day_input:
-        print("Exiting program...")
-        sys.exit()
-
-    if day_input not in day_options:
-        print("Invalid entry. Please try again.")
-        continue
-    
-    preprocessing.process_network(day_id = day_map[day_input])
-    # preprocessing.process_transfers()
-    # preprocessing.process_stops()
-    # preprocessing.str_check()
-    break # Move to the next loop
-
-# TIME SELECTION
-while True:
-    time_input = input("Please enter a time of day in format HH:MM or press Enter to exit:\n").strip()
-
-    if not time_input:
-        print("Exiting program...")
-        sys.exit()
-
-    if not re.match(r"^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$", time_input):
-        print("Invalid format or time. Please use HH:MM (e.g., 14:30).")
-        continue
-
-    if os.path.exists('data/network_edges.pkl'):
-            with open('data/network_edges.pkl', 'rb') as f:
-                network_edges = pickle.load(f)
-            
-    current_graph = graph_builder.build_graph(
-        network_edges=network_edges,
-        current_time_str=time_input, 
-        window_mins=60,
-    )
-    break # Move to the next loop
 
-# COORDINATE SELECTION
-while True:
-    coords_input = input("Enter Lat, Lon (e.g., 49.2, -123.1) or press Enter to exit:\n").strip()
+# Service day of each weekday in the TransLink feed
+DAY_IDS = {"monday": 1, "tuesday": 1, "wednesday": 1, "thursday": 1, "friday": 1, "saturday": 2, "sunday": 3}
 
-    if not coords_input:
-        print("Exiting program...")
-        sys.exit()
+# In the dashboard's order, so both use the same network files
+TOGGLES = ("skytrain", "bridges")
 
-    if "," not in coords_input:
-        print("Invalid format. Use 'Lat, Lon'.")
-        continue
 
-    try:
-        start_lat_str, start_lon_str = coords_input.split(",")
-        start_lat, start_lon = float(start_lat_str.strip()), float(start_lon_str.strip())
+def load_graph(day_id, time_str, toggles=TOGGLES, frequency=1.0):
+    """Graph for a service day, reusing the network saved for it when there is one."""
+    path = preprocessing.network_path(day_id, toggles)
+    if not os.path.exists(path):
+        preprocessing.process_network(day_id=day_id, toggles=toggles)
+
+    network_key = os.path.splitext(os.path.basename(path))[0]
+    return service_calendar.graph_for_network(network_key, path, time_str, frequency)
+
+
+# ==========================
+# INTERACTIVE MODE
+# ==========================
+
+def interactive():
+    os.makedirs(output_dir, exist_ok=True)
+
+    # DAY SELECTION
+    while True:
+        day_input = input("Please enter a day of the week or press Enter to exit program:\n").strip().lower()
 
-        if not analysis.check_is_in((start_lon, start_lat), "data/metro_vancouver_land_poly.geojson"):
-            print("Error: Those coordinates are outside Metro Vancouver or not on land.")
+        if not day_input:
+            print("Exiting program...")
+            sys.exit()
+
+        if day_input not in DAY_IDS:
+            print("Invalid entry. Please try again.")
             continue
-        else: 
-            break        
-    except ValueError:
-        print("Invalid input. Please enter numeric degrees.")
-        continue
-
-# BUDGET SELECTION
-while True:
-    budget_raw = input("Enter your time budget (an integer between 1 and 60, inclusive.) or press Enter to exit:\n").strip()
-    
-    if not budget_raw:
-        print("Exiting program...")
-        sys.exit()
 
-    try:
-        budget_input = int(budget_raw)
-        budget_min, budget_max = 1, 60
+        day_id = DAY_IDS[day_input]
+        # preprocessing.process_transfers()
+        # preprocessing.process_stops()
+        # preprocessing.str_check()
+        break # Move to the next loop
+
+    # TIME SELECTION
+    while True:
+        time_input = input("Please enter a time of day in format HH:MM or press Enter to exit:\n").strip()
+
+        if not time_input:
+            print("Exiting program...")
+            sys.exit()
 
-        if not (budget_min <= budget_input <= budget_max):
-            print("Invalid budget. Please try again.")
+        if not re.match(r"^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$", time_input):
+            print("Invalid format or time. Please use HH:MM (e.g., 14:30).")
             continue
 
-        final_gdf = analysis.get_isochrone(
-            G=current_graph,
-            start_lat = start_lat, 
-            start_lon = start_lon, 
-            time_budget_mins = budget_input, 
-        )
+        current_graph = load_graph(day_id, time_input)
+        break # Move to the next loop
+
+    # COORDINATE SELECTION
+    while True:
+        coords_input = input("Enter Lat, Lon (e.g., 49.2, -123.1) or press Enter to exit:\n").strip()
+
+        if not coords_input:
+            print("Exiting program...")
+            sys.exit()
+
+        if "," not in coords_input:
+            print("Invalid format. Use 'Lat, Lon'.")
+            continue
 
         try:
-            if not final_gdf.empty:
-                print("Saving 'isochrone.geojson'...")
-                final_gdf.to_file("output/isochrone.geojson", driver="GeoJSON")
+            start_lat_str, start_lon_str = coords_input.split(",")
+            start_lat, start_lon = float(start_lat_str.strip()), float(start_lon_str.strip())
+
+            if not analysis.check_is_in((start_lon, start_lat), "data/metro_vancouver_land_poly.geojson"):
+                print("Error: Those coordinates are outside Metro Vancouver or not on land.")
+                continue
+            else: 
+                break        
+        except ValueError:
+            print("Invalid input. Please enter numeric degrees.")
+            continue
 
-                print("A geojson file has been generated for input to GIS in 'output/'.")
-                break
-            else:
-                print("Failed to generate polygon.")
+    # BUDGET SELECTION
+    while True:
+        budget_raw = input("Enter your time budget (an integer between 1 and 60, inclusive.) or press Enter to exit:\n").strip()
 
-        except AttributeError:
+        if not budget_raw:
+            print("Exiting program...")
             sys.exit()
 
-    except ValueError:
-        print("Error: Try again.")
-        continue
-        
-# DJIKSTRA ROUTING
-while True:
-    coords_input = input("If you would like to find the route to somewhere within your isochrone, please enter the coordinates. Otherwise, press Enter to exit.\n")
+        try:
+            budget_input = int(budget_raw)
+            budget_min, budget_max = 1, 60
 
-    if not coords_input:
-        print("Exiting program...")
-        sys.exit()
+            if not (budget_min <= budget_input <= budget_max):
+                print("Invalid budget. Please try again.")
+                continue
 
-    if "," not in coords_input:
-        print("Invalid format. Use 'Lat, Lon'.")
-        continue
+            final_gdf = analysis.get_isochrone(
+                G=current_graph,
+                start_lat = start_lat, 
+                start_lon = start_lon, 
+                time_budget_mins = budget_input, 
+            )
 
-    try:
-        end_lat_str, end_lon_str = coords_input.split(",")
-        end_lat, end_lon = float(end_lat_str.strip()), float(end_lon_str.strip())
+            try:
+                if not final_gdf.empty:
+                    print("Saving 'isochrone.geojson'...")
+                    final_gdf.to_file(f"{output_dir}/isochrone.geojson", driver="GeoJSON")
+
+                    print("A geojson file has been generated for input to GIS in 'output/'.")
+                    break
+                else:
+                    print("Failed to generate polygon.")
 
-        if not analysis.check_is_in((end_lon, end_lat), "data/isochrone.geojson"):
-            print("Error: Those coordinates are not within the isochrone.")
+            except AttributeError:
+                sys.exit()
+
+        except ValueError:
+            print("Error: Try again.")
             continue
-        else: 
-            break        
-    except ValueError:
-        print("Invalid input. Please enter numeric degrees.")
-        continue
-
-route_line, steps = analysis.get_route(
-    G = current_graph,
-    start_lat = start_lat,
-    start_lon = start_lon,
-    end_lat = end_lat,
-    end_lon = end_lon,
-    walk_speed_mps=1.0, 
-    max_walk_km=1.0
-)
-
-if route_line is None or route_line.empty:
-    print("Error. Please try again.")
-else:
-    route_line.to_file("output/route.geojson", driver="GeoJSON")
-    for step in steps:
-        print(step)
-    print("A geojson file has been generated in 'output/' detailing the route.")
\ No newline at end of file
+
+    # DJIKSTRA ROUTING
+    while True:
+        coords_input = input("If you would like to find the route to somewhere within your isochrone, please enter the coordinates. Otherwise, press Enter to exit.\n")
+
+        if not coords_input:
+            print("Exiting program...")
+            sys.exit()
+
+        if "," not in coords_input:
+            print("Invalid format. Use 'Lat, Lon'.")
+            continue
+
+        try:
+            end_lat_str, end_lon_str = coords_input.split(",")
+            end_lat, end_lon = float(end_lat_str.strip()), float(end_lon_str.strip())
+
+            if not analysis.check_is_in((end_lon, end_lat), f"{output_dir}/isochrone.geojson"):
+                print("Error: Those coordinates are not within the isochrone.")
+                continue
+            else: 
+                break        
+        except ValueError:
+            print("Invalid input. Please enter numeric degrees.")
+            continue
+
+    route = analysis.get_route(
+        G = current_graph,
+        start_lat = start_lat,
+        start_lon = start_lon,
+        end_lat = end_lat,
+        end_lon = end_lon,
+        walk_speed_mps=1.0, 
+        max_walk_km=1.0
+    )
+
+    if route is None or route[0].empty:
+        print("Error. Please try again.")
+    else:
+        route_line, steps = route
+        route_line.to_file(f"{output_dir}/route.geojson", driver="GeoJSON")
+        for step in steps:
+            print(step)
+        print("A geojson file has been generated in 'output/' detailing the route.")
+
+# ==========================
+# BATCH MODE
+# ==========================
+
+# For scripted runs, e.g. every night:
+#     python app_simple.py --origins origins.csv --day monday --time 08:00 --budgets 15 30 45
+# origins.csv has lat and lon columns, and optionally id, and dest_lat and dest_lon for
+# a route from each origin. Each origin is searched once for the largest budget; the
+# smaller budgets reuse that search. Rows run in parallel across CPU cores, and results
+# are written as they come in to isochrones.geojson and routes.geojson (or .parquet,
+# GeoParquet) in --out.
+
+ISOCHRONE_SCHEMA = pa.schema([('id', pa.string()), ('budget', pa.float64()), ('stops', pa.int64()), ('geometry', pa.binary())])
+ROUTE_SCHEMA = pa.schema([('id', pa.string()), ('minutes', pa.float64()), ('steps', pa.string()), ('geometry', pa.binary())])
+
+# Worker state, set once per process so the graph is not resent with every row
+_BATCH = {}
+
+
+def _init_batch(G, budgets, walk_speed_mps, max_walk_km, verbose):
+    _BATCH.update({'G': G, 'budgets': budgets, 'walk_speed_mps': walk_speed_mps, 'max_walk_km': max_walk_km, 'verbose': verbose})
+
+
+def _batch_row(row):
+    """([isochrone records], route record or None, error or None) for one origin row."""
+    row_id, lat, lon, destination = row
+    G, budgets, speed, max_walk = _BATCH['G'], _BATCH['budgets'], _BATCH['walk_speed_mps'], _BATCH['max_walk_km']
+    quiet = contextlib.nullcontext() if _BATCH['verbose'] else contextlib.redirect_stdout(io.StringIO())
+
+    try:
+        with quiet:
+            isochrones = []
+            best_times = analysis.isochrone_stop_times(G, lat, lon, max(budgets), speed, max_walk) or {}
+            for budget in budgets:
+                within = {s: t for s, t in best_times.items() if t <= budget}
+                gdf = analysis.isochrone_polygon(within, budget, speed, max_walk) if within else None
+                if gdf is not None and not gdf.empty:
+                    isochrones.append({'id': row_id, 'budget': budget, 'stops': len(within), 'geometry': shapely.to_wkb(gdf.geometry.iloc[0])})
+
+            route = None
+            if destination is not None:
+                result = analysis.get_route(G, lat, lon, *destination, speed, max_walk)
+                if result is None:
+                    route = {'id': row_id, 'minutes': None, 'steps': None, 'geometry': None}
+                else:
+                    gdf, steps = result
+                    route = {'id': row_id, 'minutes': float(gdf['time_min'].iloc[0]), 'steps': "\n".join(steps), 'geometry': shapely.to_wkb(gdf.geometry.iloc[0])}
+
+        return isochrones, route, None
+    except Exception as e:
+        return [], None, f"row {row_id}: {e!r}"
+
+
+class GeoJSONWriter:
+    """Writes records (WKB geometry) as a GeoJSON FeatureCollection, feature by feature."""
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.count = 0
+
+    def write(self, records):
+        for record in records:
+            geometry = record['geometry']
+            feature = {
+                'type': 'Feature',
+                'properties': {k: v for k, v in record.items() if k != 'geometry'},
+                'geometry': None if geometry is None else mapping(shapely.from_wkb(geometry))
+            }
+            self.file.write((",\n" if self.count else "") + json.dumps(feature))
+            self.count += 1
+
+    def close(self):
+        self.file.write("\n]}\n")
+        self.file.close()
+
+
+class GeoParquetWriter:
+    """Writes records (WKB geometry in WGS84) to a GeoParquet file, a row group at a time."""
+    ROW_GROUP = 256
+
+    def __init__(self, path, schema, geometry_types):
+        geo = {
+            'version': '1.1.0',
+            'primary_column': 'geometry',
+            'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': geometry_types}}
+        }
+        self.schema = schema.with_metadata({'geo': json.dumps(geo)})
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = []
+        self.count = 0
+
+    def write(self, records):
+        self.rows.extend(records)
+        self.count += len(records)
+        if len(self.rows) >= self.ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+def read_origins(path):
+    """[(id, lat, lon, (dest_lat, dest_lon) or None)] from a CSV with lat and lon columns."""
+    df = pd.read_csv(path, dtype={'id': str})
+    missing = {'lat', 'lon'} - set(df.columns)
+    if missing:
+        raise SystemExit(f"{path} needs columns {sorted(missing)}.")
+
+    ids = df['id'] if 'id' in df.columns else df.index.astype(str)
+    has_destinations = {'dest_lat', 'dest_lon'} <= set(df.columns)
+
+    rows = []
+    for i, (row_id, lat, lon) in enumerate(zip(ids, df['lat'], df['lon'])):
+        destination = None
+        if has_destinations and pd.notna(df['dest_lat'].iat[i]) and pd.notna(df['dest_lon'].iat[i]):
+            destination = (float(df['dest_lat'].iat[i]), float(df['dest_lon'].iat[i]))
+        rows.append((str(row_id), float(lat), float(lon), destination))
+    return rows
+
+
+def report_progress(done, total, t0):
+    elapsed = time.perf_counter() - t0
+    rate = done / elapsed if elapsed else 0.0
+    left = (total - done) / rate if rate else 0.0
+    print(f"  {done}/{total} origins ({done / total:.0%}), {rate:.1f}/s, about {left:.0f} s left", flush=True)
+
+
+def batch(args):
+    rows = read_origins(args.origins)
+    budgets = sorted(args.budgets)
+    print(f"{len(rows)} origins from '{args.origins}', budgets {budgets} min.")
+
+    # In preprocessing.TOGGLE_SETS order, which names the network files
+    toggles = next(t for t in preprocessing.TOGGLE_SETS if set(t) == set(args.toggles))
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        if args.date is not None:
+            G = service_calendar.graph_for_date(args.date, toggles, args.time, args.frequency)
+        else:
+            G = load_graph(DAY_IDS[args.day], args.time, toggles, args.frequency)
+    if G is None:
+        raise SystemExit(f"No transit service on {args.date}.")
+    print(f"Graph {G.graph.get('key')} ready.")
+
+    os.makedirs(args.out, exist_ok=True)
+    if args.format == 'parquet':
+        isochrone_out = GeoParquetWriter(f"{args.out}/isochrones.parquet", ISOCHRONE_SCHEMA, ['Polygon', 'MultiPolygon'])
+        route_out = GeoParquetWriter(f"{args.out}/routes.parquet", ROUTE_SCHEMA, ['LineString'])
+    else:
+        isochrone_out = GeoJSONWriter(f"{args.out}/isochrones.geojson")
+        route_out = GeoJSONWriter(f"{args.out}/routes.geojson")
+
+    settings = (G, budgets, args.walk_speed, args.max_walk, args.verbose)
+    workers = args.workers or os.cpu_count() or 1
+    every = max(1, len(rows) // 20)
+    errors = []
+    t0 = time.perf_counter()
+
+    # Results come back in row order as they finish, and go straight to the files
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            _init_batch(*settings)
+            results = map(_batch_row, rows)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=_init_batch, initargs=settings))
+            results = pool.map(_batch_row, rows, chunksize=max(1, min(16, len(rows) // (workers * 4))))
+
+        for done, (isochrones, route, error) in enumerate(results, start=1):
+            isochrone_out.write(isochrones)
+            if route is not None:
+                route_out.write([route])
+            if error is not None:
+                errors.append(error)
+            if done % every == 0 or done == len(rows):
+                report_progress(done, len(rows), t0)
+
+    isochrone_out.close()
+    route_out.close()
+
+    print(f"Wrote {isochrone_out.count} isochrones and {route_out.count} routes to '{args.out}' in {time.perf_counter() - t0:.1f} s.")
+    for error in errors:
+        print(f"Failed: {error}")
+    return 1 if errors else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Isochrones and routes for a CSV of origins, without prompts. Run with no arguments for the interactive mode.")
+    parser.add_argument('--origins', required=True, help="CSV with lat, lon and optionally id, dest_lat, dest_lon")
+    when = parser.add_mutually_exclusive_group()
+    when.add_argument('--day', choices=list(DAY_IDS), default='monday', help="service day (default: monday)")
+    when.add_argument('--date', type=datetime.date.fromisoformat, help="service date instead of a day, using the feed's calendar")
+    parser.add_argument('--time', default="08:00")
+    parser.add_argument('--budgets', type=float, nargs='+', default=[30.0], help="minutes")
+    parser.add_argument('--walk-speed', type=float, default=1.2, help="m/s")
+    parser.add_argument('--max-walk', type=float, default=1.0, help="km")
+    parser.add_argument('--toggles', nargs='*', choices=TOGGLES, default=list(TOGGLES))
+    parser.add_argument('--frequency', type=float, default=1.0)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--out', default=output_dir)
+    parser.add_argument('--format', choices=['geojson', 'parquet'], default='geojson')
+    parser.add_argument('--verbose', action='store_true', help="show the search and routing output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(batch(parse_args()))
+    interactive()
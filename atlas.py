@@ -0,0 +1,339 @@
+import argparse
+import datetime
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import analysis
+import graph_builder
+import memory
+import preprocessing
+import service_calendar
+import tracing
+
+# =============================
+# ISOCHRONE ATLAS
+# =============================
+
+# Precomputed isochrones for the scenario most dashboard visitors look at. Land is
+# tiled into pointy-top hexagons in BC Albers, and for every cell centre with stops
+# in walking distance the atlas stores the reached stops' travel times and the exact
+# polygon for a few budgets. Clicks inside a stored cell are answered from the atlas
+# instead of a search; anything else (another scenario, a bigger budget, a cell with
+# no entry) is computed live.
+#
+# One folder per (graph key, walk speed, max walk), holding flat arrays that are
+# memory-mapped, so an atlas costs page cache rather than heap:
+#   meta.json         scenario, budgets, hex size
+#   cell_keys.npy     sorted hex keys, the index searched on every click
+#   stop_ids.npy      stop ids the travel times refer to
+#   time_offsets.npy  travel times of cell i: rows time_offsets[i]:time_offsets[i+1] of
+#   time_stops.npy    ... stop_ids index
+#   time_minutes.npy  ... minutes from the cell centre
+#   geom_offsets.npy  polygon of cell i, budget j: geoms[geom_offsets[k]:geom_offsets[k+1]]
+#   geoms.npy         ... WKB bytes, k = i * len(budgets) + j (empty when nothing is reached)
+#
+# Build it with: python atlas.py --date 2026-10-14 --time 17:00
+
+ATLAS_DIR = 'data/atlas'
+HEX_M = 300
+BUDGETS = (15, 30, 45, 60)
+
+SQRT3 = np.sqrt(3.0)
+# Keeps hex coordinates positive inside the 64-bit cell key
+KEY_OFFSET = 1 << 24
+
+
+def atlas_path(graph_key, walk_speed_mps, max_walk_km):
+    return f"{ATLAS_DIR}/{graph_key}_{round(walk_speed_mps, 2):g}_{round(max_walk_km, 2):g}"
+
+
+# =============================
+# HEX GRID
+# =============================
+
+def hex_keys(x, y, hex_m):
+    """Keys of the hexagons (circumradius hex_m) holding BC Albers points x, y."""
+    q = (SQRT3 / 3 * x - y / 3) / hex_m
+    r = (2 / 3 * y) / hex_m
+
+    # Cube rounding: round all three coordinates, then fix the one that moved most
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+
+    return (rq.astype(np.int64) + KEY_OFFSET) * (1 << 32) + (rr.astype(np.int64) + KEY_OFFSET)
+
+
+def hex_centres(keys, hex_m):
+    """BC Albers centre x, y of each hexagon key."""
+    q = keys // (1 << 32) - KEY_OFFSET
+    r = keys % (1 << 32) - KEY_OFFSET
+    return hex_m * SQRT3 * (q + r / 2), hex_m * 1.5 * r
+
+
+def land_cells(land_path="data/metro_vancouver_land_poly.geojson", hex_m=HEX_M):
+    """Keys of every hexagon whose centre is on land."""
+    land = gpd.read_file(land_path).to_crs("EPSG:3005").union_all()
+    min_x, min_y, max_x, max_y = land.bounds
+
+    # Centres every half row / column over the bounds, keyed, then deduplicated
+    xs = np.arange(min_x, max_x + hex_m * SQRT3, hex_m * SQRT3 / 2)
+    ys = np.arange(min_y, max_y + hex_m * 1.5, hex_m * 0.75)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    keys = np.unique(hex_keys(grid_x.ravel(), grid_y.ravel(), hex_m))
+
+    x, y = hex_centres(keys, hex_m)
+    shapely.prepare(land)
+    return keys[shapely.contains_xy(land, x, y)]
+
+
+def to_latlon(x, y):
+    """BC Albers x, y to (lat, lon) arrays."""
+    points = gpd.GeoSeries(gpd.points_from_xy(x, y), crs="EPSG:3005").to_crs("EPSG:4326")
+    return points.y.to_numpy(), points.x.to_numpy()
+
+
+def to_albers(lat, lon):
+    """(lat, lon) scalars or arrays to BC Albers x, y arrays."""
+    point = gpd.GeoSeries(gpd.points_from_xy(np.atleast_1d(lon), np.atleast_1d(lat)), crs="EPSG:4326").to_crs("EPSG:3005")
+    return point.x.to_numpy(), point.y.to_numpy()
+
+
+# =============================
+# BUILDING
+# =============================
+
+# Worker state, set once per process so the graph is not resent with every cell
+_ATLAS = {}
+
+
+def _init_atlas(G, walk_speed_mps, max_walk_km, budgets):
+    _ATLAS.update({'G': G, 'walk_speed_mps': walk_speed_mps, 'max_walk_km': max_walk_km, 'budgets': budgets})
+
+
+def _atlas_cell(point):
+    """(best_times, [WKB per budget]) from one cell centre, or None when nothing is reached."""
+    lat, lon = point
+    G, speed, max_walk, budgets = _ATLAS['G'], _ATLAS['walk_speed_mps'], _ATLAS['max_walk_km'], _ATLAS['budgets']
+
+    best_times = analysis.isochrone_stop_times(G, lat, lon, max(budgets), speed, max_walk)
+    if not best_times:
+        return None
+
+    polygons = []
+    for budget in budgets:
+        within = {s: t for s, t in best_times.items() if t <= budget}
+        gdf = analysis.isochrone_polygon(within, budget, speed, max_walk) if within else None
+        polygons.append(b'' if gdf is None or gdf.empty else shapely.to_wkb(gdf.geometry.iloc[0]))
+    return best_times, polygons
+
+
+def build_atlas(G, walk_speed_mps=1.2, max_walk_km=0.5, budgets=BUDGETS, hex_m=HEX_M, workers=None):
+    """
+    Computes every land cell with stops in walking distance, in parallel, and writes
+    the atlas for G (built with a network_key) to atlas_path(). Returns the path.
+    """
+    graph_key = G.graph.get('key')
+    if graph_key is None:
+        raise ValueError("The atlas needs a graph built with a network_key.")
+    budgets = tuple(sorted(budgets))
+
+    keys = land_cells(hex_m=hex_m)
+    lat, lon = to_latlon(*hex_centres(keys, hex_m))
+
+    # Cells with no stop in walking distance can't reach anything
+    stop_ids, tree = analysis.get_stop_index()
+    near = tree.query_radius(np.deg2rad(np.column_stack([lat, lon])), r=max_walk_km / 6371.0, count_only=True) > 0
+    keys, points = keys[near], list(zip(lat[near], lon[near]))
+    print(f"Atlas: {len(points)} cells of {hex_m} m with stops in walking distance.")
+
+    t0 = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_atlas(G, walk_speed_mps, max_walk_km, budgets)
+        results = [_atlas_cell(p) for p in points]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_atlas,
+            initargs=(G, walk_speed_mps, max_walk_km, budgets)
+        ) as pool:
+            chunksize = max(1, len(points) // (workers * 8))
+            results = list(pool.map(_atlas_cell, points, chunksize=chunksize))
+
+    kept = [i for i, result in enumerate(results) if result is not None]
+    print(f"Computed in {time.perf_counter() - t0:.1f} s, {len(kept)} cells reach stops. Saving...")
+
+    stop_index = {s: i for i, s in enumerate(analysis.get_stops())}
+    time_offsets, time_stops, time_minutes = [0], [], []
+    geom_offsets, geoms = [0], []
+    for i in kept:
+        best_times, polygons = results[i]
+        time_stops.extend(stop_index[s] for s in best_times)
+        time_minutes.extend(best_times.values())
+        time_offsets.append(len(time_stops))
+        for wkb in polygons:
+            geoms.append(wkb)
+            geom_offsets.append(geom_offsets[-1] + len(wkb))
+
+    path = atlas_path(graph_key, walk_speed_mps, max_walk_km)
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        'cell_keys': keys[kept],
+        'stop_ids': np.array(list(stop_index), dtype=str),
+        'time_offsets': np.array(time_offsets, dtype=np.int64),
+        'time_stops': np.array(time_stops, dtype=np.int32),
+        'time_minutes': np.array(time_minutes, dtype=np.float32),
+        'geom_offsets': np.array(geom_offsets, dtype=np.int64),
+        'geoms': np.frombuffer(b''.join(geoms), dtype=np.uint8)
+    }
+    for name, array in arrays.items():
+        np.save(f'{path}/{name}.npy', array)
+
+    with open(f'{path}/meta.json', 'w') as f:
+        json.dump({
+            'graph_key': graph_key,
+            'walk_speed_mps': walk_speed_mps,
+            'max_walk_km': max_walk_km,
+            'budgets': list(budgets),
+            'hex_m': hex_m,
+            'cells': len(kept)
+        }, f, indent=2)
+
+    # A fresh build replaces whatever this process had mapped
+    load_atlas.cache_clear()
+    print(f"Atlas saved to '{path}'.")
+    return path
+
+
+# =============================
+# LOOKUPS
+# =============================
+
+class Atlas:
+    """Read-only view of one atlas folder, with every array memory-mapped."""
+    mapped = True
+
+    def __init__(self, path):
+        with open(f'{path}/meta.json') as f:
+            self.meta = json.load(f)
+        self.budgets = tuple(self.meta['budgets'])
+        self.hex_m = self.meta['hex_m']
+
+        for name in ['cell_keys', 'stop_ids', 'time_offsets', 'time_stops', 'time_minutes', 'geom_offsets', 'geoms']:
+            setattr(self, name, np.load(f'{path}/{name}.npy', mmap_mode='r'))
+
+    def cell(self, lat, lon):
+        """Index of the stored cell holding (lat, lon), or None."""
+        key = hex_keys(*to_albers(lat, lon), self.hex_m)[0]
+        i = int(np.searchsorted(self.cell_keys, key))
+        if i < len(self.cell_keys) and self.cell_keys[i] == key:
+            return i
+        return None
+
+    def stop_times(self, i, budget):
+        """{stop_id: minutes} reached from cell i within budget."""
+        start, end = self.time_offsets[i], self.time_offsets[i + 1]
+        minutes = self.time_minutes[start:end]
+        within = minutes <= budget
+        stop_ids = self.stop_ids[self.time_stops[start:end][within]]
+        return dict(zip(stop_ids.tolist(), minutes[within].astype(float).tolist()))
+
+    def polygon(self, i, budget):
+        """The stored isochrone of cell i for budget (a GeoDataFrame), or None if budget wasn't stored."""
+        if budget not in self.budgets:
+            return None
+        k = i * len(self.budgets) + self.budgets.index(budget)
+        wkb = bytes(self.geoms[self.geom_offsets[k]:self.geom_offsets[k + 1]])
+        if not wkb:
+            return None
+        return gpd.GeoDataFrame(geometry=[shapely.from_wkb(wkb)], crs="EPSG:4326")
+
+
+@memory.component('atlas')
+@lru_cache(maxsize=None)
+def load_atlas(path):
+    return Atlas(path)
+
+
+def find_atlas(G, walk_speed_mps, max_walk_km):
+    """The atlas built for G and these walking settings, or None."""
+    graph_key = G.graph.get('key')
+    if graph_key is None:
+        return None
+    path = atlas_path(graph_key, walk_speed_mps, max_walk_km)
+    if not os.path.exists(f'{path}/meta.json'):
+        return None
+    return load_atlas(path)
+
+
+@tracing.traced('atlas.lookup')
+def lookup(G, lat, lon, time_budget_mins, walk_speed_mps, max_walk_km):
+    """
+    (best_times, polygon) for a click answered by the atlas, or None to compute it live.
+    polygon is None when the budget is not one the atlas stores.
+    """
+    atlas = find_atlas(G, walk_speed_mps, max_walk_km)
+    if atlas is None or time_budget_mins > max(atlas.budgets):
+        return None
+
+    i = atlas.cell(lat, lon)
+    tracing.current().set(hit=i is not None)
+    if i is None:
+        return None
+
+    best_times = atlas.stop_times(i, time_budget_mins)
+    if not best_times:
+        return None
+    return best_times, atlas.polygon(i, time_budget_mins)
+
+
+# ==========================
+# COMMAND LINE
+# ==========================
+
+def next_weekday(day=None):
+    day = day or datetime.date.today()
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    return day
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute isochrones for a hex grid of origins over Metro Vancouver land.")
+    parser.add_argument('--date', type=datetime.date.fromisoformat, default=next_weekday(), help="service date (default: the next weekday)")
+    parser.add_argument('--time', default="17:00")
+    parser.add_argument('--toggles', nargs='*', default=["skytrain", "bridges"])
+    parser.add_argument('--frequency', type=float, default=1.0)
+    parser.add_argument('--walk-speed', type=float, default=1.2)
+    parser.add_argument('--max-walk', type=float, default=0.5)
+    parser.add_argument('--budgets', type=int, nargs='+', default=list(BUDGETS))
+    parser.add_argument('--hex-m', type=float, default=HEX_M, help="hexagon circumradius in metres")
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    network = service_calendar.network_for_date(args.date, toggles=preprocessing.ordered_toggles(args.toggles))
+    if network is None:
+        raise SystemExit(f"No transit service on {args.date}.")
+
+    # Built exactly like the dashboard's graph, so its key matches
+    network_key, path = network
+    with open(path, 'rb') as f:
+        network_edges = pickle.load(f)
+    G = graph_builder.build_graph(network_edges, args.time, window_mins=60, frequency_modifier=args.frequency,
+                                  use_clusters=service_calendar.STOP_CLUSTERS, network_key=network_key)
+    del network_edges
+
+    build_atlas(G, args.walk_speed, args.max_walk, args.budgets, args.hex_m, args.workers)
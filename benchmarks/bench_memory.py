@@ -0,0 +1,142 @@
+import argparse
+import contextlib
+import gc
+import io
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+# ==============================
+#  MEMORY BUDGET CHECK
+# ==============================
+
+# Runs a standard query workload in low-memory mode (see memory.py) on a synthetic
+# feed and fails if its peak traced allocation goes over the budget:
+#   python benchmarks/bench_memory.py --scale medium --budget 150
+# The workload loads two networks in turn, and on each builds the graph and answers
+# isochrone (search, preview and exact polygon) and route queries from fixed origins.
+# Everything Python allocates is traced, including what the caches hold and what
+# a query needs while it runs; memory-mapped files are not, since they cost page
+# cache rather than heap.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import bench_pipeline
+
+# Default budget for each scale, in MB
+BUDGETS = {'small': 16, 'medium': 64, 'large': 256}
+
+NETWORKS = [("skytrain", "bridges"), ()]
+TEST_TIME = "08:00"
+BUDGET_MINS = 30
+QUERIES = 5
+
+
+def workload(seed=0):
+    """The standard queries, run against data/ in the working directory."""
+    import preprocessing
+    import graph_builder
+    import analysis
+
+    rng = np.random.default_rng(seed)
+    stops = analysis.get_stops()
+    stop_ids = list(stops)
+    picks = rng.choice(len(stop_ids), size=2 * QUERIES, replace=False)
+    points = [(stops[stop_ids[i]]['lat'], stops[stop_ids[i]]['lon']) for i in picks]
+    origins, destinations = points[:QUERIES], points[QUERIES:]
+
+    for toggles in NETWORKS:
+        path = preprocessing.network_path(1, toggles)
+        with open(path, 'rb') as f:
+            network_edges = pickle.load(f)
+        G = graph_builder.build_graph(network_edges, TEST_TIME, window_mins=60, network_key=os.path.basename(path)[:-4])
+        del network_edges
+
+        for lat, lon in origins:
+            best_times = analysis.isochrone_stop_times(G, lat, lon, BUDGET_MINS)
+            if best_times:
+                analysis.isochrone_preview(best_times, BUDGET_MINS)
+                analysis.isochrone_polygon(best_times, BUDGET_MINS)
+
+        for (o_lat, o_lon), (d_lat, d_lon) in zip(origins, destinations):
+            analysis.get_route(G, o_lat, o_lon, d_lat, d_lon)
+
+        del G
+
+
+def run(scale='medium', budget_mb=None, seed=0, work_dir=None, verbose=False):
+    """Peak traced MB of the workload with the memory budget set to budget_mb."""
+    budget_mb = budget_mb or BUDGETS[scale]
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='bench_memory_')
+    start_dir = os.getcwd()
+
+    counts = bench_pipeline.prepare_workspace(work_dir, scale, seed)
+    print(f"Synthetic feed ({scale}): {counts['stops']} stops, {counts['trips']} trips, {counts['stop_times']} stop_times.")
+
+    os.chdir(work_dir)
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    try:
+        import preprocessing
+        import graph_builder
+        import analysis
+        import memory
+
+        # Inputs, not traced
+        with quiet:
+            preprocessing.process_land_components()
+            preprocessing.process_stops()
+            preprocessing.process_transfers()
+            preprocessing.process_shapes()
+            for toggles in NETWORKS:
+                preprocessing.process_network(day_id=1, toggles=toggles)
+            preprocessing.load_gtfs.cache_clear()
+
+        # Imports are a fixed cost the budget can't evict, so they happen before tracing
+        import sklearn.neighbors
+
+        memory.clear_all()
+        memory.set_budget(budget_mb)
+
+        tracemalloc.start()
+        try:
+            with quiet:
+                workload(seed)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        gc.collect()
+        memory.print_report()
+        return peak / 1e6
+
+    finally:
+        os.chdir(start_dir)
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if a standard query workload goes over the memory budget.")
+    parser.add_argument('--scale', choices=bench_pipeline.synthetic_gtfs.SCALES, default='medium')
+    parser.add_argument('--budget', type=float, help="MB (default depends on --scale)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="keep the synthetic feed and outputs here instead of a temporary folder")
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    budget_mb = args.budget or BUDGETS[args.scale]
+    peak_mb = run(args.scale, budget_mb, args.seed, args.work_dir, args.verbose)
+
+    print(f"Peak traced allocation: {peak_mb:.1f} MB (budget {budget_mb:.0f} MB).")
+    if peak_mb > budget_mb:
+        print("Workload exceeded the memory budget.")
+        sys.exit(1)
+    print("Workload within the memory budget.")
@@ -0,0 +1,200 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# ==============================
+#  PIPELINE BENCHMARKS
+# ==============================
+
+# Times each stage of the pipeline, from preprocessing to queries, on a synthetic
+# feed (benchmarks/synthetic_gtfs.py), so it runs offline and gives the same
+# numbers on every machine state. Everything happens in a scratch folder holding
+# txt_data/ and a copy of the repo's data/*.geojson:
+#   python benchmarks/bench_pipeline.py --scale medium
+#   python benchmarks/bench_pipeline.py --save   (writes the baseline for that scale)
+#   python benchmarks/bench_pipeline.py --check  (fails if a stage got slower or bigger)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'pipeline_baseline.json')
+sys.path.insert(0, REPO_ROOT)
+
+import synthetic_gtfs
+
+# A stage may be this much worse than the baseline before --check fails...
+TOLERANCE = 1.25
+# ...and by more than this, so millisecond stages don't fail on timer noise
+MIN_REGRESSION_S = 0.02
+MIN_REGRESSION_MB = 1.0
+
+NETWORK_TOGGLES = ("skytrain", "bridges")
+TEST_TIME = "08:00"
+BUDGET = 30
+QUERIES = 10
+
+
+def prepare_workspace(work_dir, scale, seed=0):
+    """Synthetic feed in work_dir/txt_data, plus the geojson inputs preprocessing reads."""
+    os.makedirs(f'{work_dir}/data', exist_ok=True)
+    for name in ['bridges.geojson', 'metro_vancouver_land_poly.geojson']:
+        shutil.copy(os.path.join(REPO_ROOT, 'data', name), f'{work_dir}/data/{name}')
+
+    return synthetic_gtfs.generate_feed(f'{work_dir}/txt_data', seed=seed, **synthetic_gtfs.SCALES[scale])
+
+
+def measure(func, repeats):
+    """
+    {'s': best wall time of `repeats` calls, 'peak_mb': peak traced allocation of one more}.
+    The peak is taken in a separate call since tracing slows everything down.
+    Returns the measurement and the last result.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'s': best, 'peak_mb': peak / 1e6}, result
+
+
+def run(scale='medium', repeats=5, seed=0, work_dir=None, verbose=False):
+    """{stage: {'s', 'peak_mb'}} for every stage, on a fresh synthetic feed."""
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    start_dir = os.getcwd()
+
+    counts = prepare_workspace(work_dir, scale, seed)
+    print(f"Synthetic feed ({scale}): {counts['stops']} stops, {counts['trips']} trips, {counts['stop_times']} stop_times.")
+
+    # The modules read data/ and txt_data/ relative to the working directory
+    os.chdir(work_dir)
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    try:
+        import preprocessing
+        import graph_builder
+        import analysis
+        import isochrone_cache
+
+        # Repeated queries would otherwise time cache hits
+        isochrone_cache.set_enabled(False)
+
+        profile = {}
+
+        def stage(name, func, times=repeats):
+            with quiet:
+                profile[name], result = measure(func, times)
+            print(f"{name:<20}{profile[name]['s']:>10.3f} s{profile[name]['peak_mb']:>10.1f} MB")
+            return result
+
+        def fresh(func):
+            # Preprocessing stages each read the feed from disk
+            def call():
+                preprocessing.load_gtfs.cache_clear()
+                return func()
+            return call
+
+        # Inputs the query stages need, not timed
+        with quiet:
+            preprocessing.process_land_components()
+            preprocessing.process_stops()
+            preprocessing.process_transfers()
+
+        stage('process_shapes', fresh(preprocessing.process_shapes))
+        path = stage('process_network', fresh(lambda: preprocessing.process_network(day_id=1, toggles=NETWORK_TOGGLES)))
+
+        with open(path, 'rb') as f:
+            network_edges = pickle.load(f)
+
+        G = stage('build_graph', lambda: graph_builder.build_graph(network_edges, TEST_TIME, window_mins=60, network_key='bench'))
+
+        # Query origins: stop locations picked at random (the same ones every run)
+        rng = np.random.default_rng(seed)
+        stops = analysis.get_stops()
+        stop_ids = list(stops)
+        picks = rng.choice(len(stop_ids), size=2 * QUERIES, replace=False)
+        points = [(stops[stop_ids[i]]['lat'], stops[stop_ids[i]]['lon']) for i in picks]
+        origins, destinations = points[:QUERIES], points[QUERIES:]
+
+        searches = stage('isochrone_search', lambda: [
+            analysis.isochrone_stop_times(G, lat, lon, BUDGET) for lat, lon in origins
+        ])
+        stage('isochrone_geometry', lambda: [
+            analysis.isochrone_polygon(best_times, BUDGET) for best_times in searches if best_times
+        ])
+        stage('get_route', lambda: [
+            analysis.get_route(G, o_lat, o_lon, d_lat, d_lon) for (o_lat, o_lon), (d_lat, d_lon) in zip(origins, destinations)
+        ])
+
+        return profile
+
+    finally:
+        os.chdir(start_dir)
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def check(profile, baseline, tolerance=TOLERANCE):
+    """Names of stages whose time or peak memory grew past the baseline."""
+    regressions = []
+    for name, current in profile.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = current['s'] > max(base['s'] * tolerance, base['s'] + MIN_REGRESSION_S)
+        bigger = current['peak_mb'] > max(base['peak_mb'] * tolerance, base['peak_mb'] + MIN_REGRESSION_MB)
+        if slower or bigger:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and peak memory of each pipeline stage on a synthetic feed.")
+    parser.add_argument('--scale', choices=synthetic_gtfs.SCALES, default='medium')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="keep the synthetic feed and outputs here instead of a temporary folder")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's own output")
+    parser.add_argument('--save', action='store_true', help="write the results as the new baseline for this scale")
+    parser.add_argument('--check', action='store_true', help="exit 1 if any stage regressed against the baseline")
+    args = parser.parse_args()
+
+    print(f"{'stage':<20}{'time':>12}{'peak':>13}")
+    profile = run(args.scale, args.repeats, args.seed, args.work_dir, args.verbose)
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baselines = json.load(f)
+
+    if args.save:
+        baselines[args.scale] = profile
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Baseline for '{args.scale}' saved to '{BASELINE_PATH}'.")
+
+    if args.check:
+        if args.scale not in baselines:
+            print(f"No baseline for '{args.scale}' yet. Run with --save first.")
+            sys.exit(1)
+
+        regressions = check(profile, baselines[args.scale], args.tolerance)
+        if regressions:
+            print(f"Pipeline regressed for: {', '.join(regressions)}")
+            sys.exit(1)
+        print("Pipeline within baseline.")
@@ -0,0 +1,175 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# ==============================
+#  QUERY SERVICE CHECK
+# ==============================
+
+# Starts service.py on a synthetic feed and drives it with its own client:
+#   python benchmarks/bench_service.py --scale small --clients 8 --queries 200
+# Checks that isochrone, route and matrix answers match direct analysis calls on the
+# same graph, that a burst beyond the pending limit is turned away with 503s, and
+# prints the service's latency per endpoint and its batching. Exits 1 on a mismatch.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import bench_pipeline
+
+TEST_TIME = "08:00"
+BUDGET_MINS = 30
+
+
+def weekday_in_feed():
+    import service_calendar
+    return min(day for day, service_ids in service_calendar.get_service_index().items() if service_ids and day.weekday() < 5)
+
+
+def random_queries(rng, points, n):
+    """n mixed (endpoint, args) queries between the given (lat, lon) points."""
+    queries = []
+    for kind in rng.choice(['isochrone', 'route', 'matrix'], size=n, p=[0.5, 0.3, 0.2]):
+        a, b, c = (points[i] for i in rng.choice(len(points), size=3, replace=False))
+        if kind == 'isochrone':
+            queries.append(('isochrone', (a[0], a[1])))
+        elif kind == 'route':
+            queries.append(('route', (a, b)))
+        else:
+            queries.append(('matrix', ([a, b], [b, c])))
+    return queries
+
+
+def check_answers(client, G, points, fields):
+    """Number of service answers that differ from the same calls made here."""
+    import analysis
+    mismatches = 0
+    (o_lat, o_lon), (d_lat, d_lon), other = points[:3]
+
+    served = client.isochrone(o_lat, o_lon, budget=BUDGET_MINS, walk_speed=1.2, max_walk=0.5, **fields)
+    direct = analysis.isochrone_stop_times(G, o_lat, o_lon, BUDGET_MINS, 1.2, 0.5) or {}
+    mismatches += served['stops'].keys() != direct.keys() or not all(
+        abs(served['stops'][s] - t) < 1e-9 for s, t in direct.items())
+
+    served = client.route((o_lat, o_lon), (d_lat, d_lon), **fields)
+    direct = analysis.get_route(G, o_lat, o_lon, d_lat, d_lon)
+    mismatches += (served['minutes'] is None) != (direct is None) or (
+        direct is not None and abs(served['minutes'] - direct[0]['time_min'].iloc[0]) > 1e-9)
+
+    origins, destinations = [(o_lat, o_lon), other], [(d_lat, d_lon), other]
+    served = client.matrix(origins, destinations, **fields)['minutes']
+    direct = [[analysis.get_travel_time(G, *o, *d) for d in destinations] for o in origins]
+    mismatches += any(
+        (s is None) != (t is None) or (t is not None and abs(s - t) > 1e-9)
+        for row_s, row_t in zip(served, direct) for s, t in zip(row_s, row_t))
+    return mismatches
+
+
+def run(scale='small', workers=2, clients=8, n_queries=200, seed=0, work_dir=None, verbose=False):
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='bench_service_')
+    start_dir = os.getcwd()
+
+    counts = bench_pipeline.prepare_workspace(work_dir, scale, seed)
+    print(f"Synthetic feed ({scale}): {counts['stops']} stops, {counts['trips']} trips, {counts['stop_times']} stop_times.")
+
+    os.chdir(work_dir)
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        import preprocessing
+        import service
+        import service_calendar
+        import analysis
+        import isochrone_cache
+
+        # Served and direct answers must both be computed, not cached
+        isochrone_cache.set_enabled(False)
+
+        with quiet:
+            preprocessing.process_land_components()
+            preprocessing.process_stops()
+            preprocessing.process_transfers()
+            preprocessing.process_shapes()
+            date = weekday_in_feed()
+            G = service_calendar.graph_for_date(date, ("skytrain", "bridges"), TEST_TIME)
+
+        fields = {'date': date.isoformat(), 'time': TEST_TIME}
+        server = service.start(port=0, workers=workers, warm=[fields])
+        client = service.Client(f"http://127.0.0.1:{server.server_address[1]}")
+
+        try:
+            rng = np.random.default_rng(seed)
+            stops = list(analysis.get_stops().values())
+            points = [(stops[i]['lat'], stops[i]['lon']) for i in rng.choice(len(stops), size=50, replace=False)]
+
+            with quiet:
+                mismatches = check_answers(client, G, points, fields)
+
+            # Load: mixed queries from concurrent clients
+            queries = random_queries(rng, points, n_queries)
+            calls = {
+                'isochrone': lambda a: client.isochrone(*a, budget=BUDGET_MINS, geometry=False, **fields),
+                'route': lambda a: client.route(*a, **fields),
+                'matrix': lambda a: client.matrix(*a, **fields)
+            }
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(clients) as threads:
+                list(threads.map(lambda q: calls[q[0]](q[1]), queries))
+            elapsed = time.perf_counter() - t0
+
+            # Backpressure: a burst well over a tiny pending limit must be partly refused
+            server.dispatcher.max_pending = 2
+            def burst(_):
+                try:
+                    client.matrix(points[:10], points[10:20], **fields)
+                    return 200
+                except service.ServiceError as e:
+                    return e.status
+            with ThreadPoolExecutor(16) as threads:
+                statuses = list(threads.map(burst, range(32)))
+            server.dispatcher.max_pending = service.MAX_PENDING
+
+            metrics = client.metrics()
+        finally:
+            service.stop(server)
+
+        print(f"{n_queries} queries from {clients} clients in {elapsed:.2f} s ({n_queries / elapsed:.0f}/s), "
+              f"{metrics['batches']} batches averaging {metrics['mean_batch']:.1f} queries.")
+        print(f"{'endpoint':<12}{'ok':>6}{'rejected':>10}{'p50 ms':>10}{'p95 ms':>10}{'compute p50':>13}")
+        for endpoint, row in metrics['endpoints'].items():
+            latency, compute = row.get('latency', {}), row.get('compute', {})
+            print(f"{endpoint:<12}{row['requests'] - row['errors'] - row['rejected']:>6}{row['rejected']:>10}"
+                  f"{latency.get('p50_ms', 0):>10.1f}{latency.get('p95_ms', 0):>10.1f}{compute.get('p50_ms', 0):>13.1f}")
+        print(f"Burst of 32 with 2 pending allowed: {statuses.count(200)} served, {statuses.count(503)} refused.")
+        return mismatches, statuses.count(503)
+
+    finally:
+        os.chdir(start_dir)
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the query service on a synthetic feed and check its answers.")
+    parser.add_argument('--scale', choices=bench_pipeline.synthetic_gtfs.SCALES, default='small')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="keep the synthetic feed and outputs here instead of a temporary folder")
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    mismatches, refused = run(args.scale, args.workers, args.clients, args.queries, args.seed, args.work_dir, args.verbose)
+    if mismatches or not refused:
+        print(f"{mismatches} answers differed from direct calls; {refused} burst queries were refused.")
+        sys.exit(1)
+    print("Service answers match direct calls.")
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# ==============================
+#  STARTUP PROFILE
+# ==============================
+
+# Cold import time and resident memory of each module, each in a fresh interpreter
+# so nothing is shared between measurements. Run from the directory holding data/ and txt_data/:
+#   python benchmarks/bench_startup.py
+#   python benchmarks/bench_startup.py --save   (writes the baseline)
+#   python benchmarks/bench_startup.py --check  (fails if startup got slower or bigger)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'startup_baseline.json')
+
+MODULES = ['graph_builder', 'analysis', 'preprocessing', 'resilience', 'hub_labels', 'app']
+
+# A measurement may be this much worse than the baseline before --check fails
+TOLERANCE = 1.25
+
+PROBE = """
+import json, sys, time
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * {page_size} / 1e6
+
+before = rss_mb()
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+
+print(json.dumps({{'import_s': elapsed, 'rss_mb': rss_mb(), 'rss_added_mb': rss_mb() - before}}))
+"""
+
+
+def profile_import(module):
+    """{'import_s', 'rss_mb', 'rss_added_mb'} for one cold import, or None if it failed."""
+    code = PROBE.format(module=module, page_size=os.sysconf('SC_PAGE_SIZE'))
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True,
+        text=True,
+        env={**os.environ, 'PYTHONPATH': REPO_ROOT}
+    )
+
+    if result.returncode != 0:
+        reason = (result.stderr.strip().splitlines() or [f"exit code {result.returncode}"])[-1]
+        print(f"{module}: import failed ({reason})")
+        return None
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(modules=MODULES, repeats=3):
+    """Best of `repeats` cold imports per module (the least disturbed by other load)."""
+    profile = {}
+    for module in modules:
+        runs = [profile_import(module) for _ in range(repeats)]
+        runs = [r for r in runs if r is not None]
+        if runs:
+            profile[module] = min(runs, key=lambda r: r['import_s'])
+    return profile
+
+
+def check(profile, baseline, tolerance=TOLERANCE):
+    """Names of modules whose import time or memory grew past the baseline."""
+    regressions = []
+    for module, current in profile.items():
+        base = baseline.get(module)
+        if base is None:
+            continue
+        if current['import_s'] > base['import_s'] * tolerance or current['rss_mb'] > base['rss_mb'] * tolerance:
+            regressions.append(module)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start import time and memory per module.")
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--save', action='store_true', help="write the results as the new baseline")
+    parser.add_argument('--check', action='store_true', help="exit 1 if any module regressed against the baseline")
+    args = parser.parse_args()
+
+    profile = run(args.modules, args.repeats)
+
+    print(f"{'module':<16}{'import (s)':>12}{'RSS (MB)':>12}{'added (MB)':>12}")
+    for module, result in profile.items():
+        print(f"{module:<16}{result['import_s']:>12.3f}{result['rss_mb']:>12.1f}{result['rss_added_mb']:>12.1f}")
+
+    if args.save:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(profile, f, indent=2)
+        print(f"Baseline saved to '{BASELINE_PATH}'.")
+
+    if args.check:
+        if not os.path.exists(BASELINE_PATH):
+            print("No baseline yet. Run with --save first.")
+            sys.exit(1)
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+        regressions = check(profile, baseline)
+        if regressions:
+            print(f"Startup regressed for: {', '.join(regressions)}")
+            sys.exit(1)
+        print("Startup within baseline.")
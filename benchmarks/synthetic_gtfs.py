@@ -0,0 +1,269 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# ==============================
+#  SYNTHETIC GTFS FEED
+# ==============================
+
+# Writes a made-up but TransLink-shaped GTFS feed, so the pipeline can be exercised
+# and benchmarked without the real download:
+#   - a grid of streets over Vancouver, a bus route along every row and column,
+#     with a stop bay on each side of the street at every intersection
+#   - one SkyTrain line (blank route_short_name, like the real feed) on the diagonal
+#   - weekday, Saturday and Sunday service (plus a holiday in calendar_dates.txt),
+#     running from 5 AM until after midnight
+#   - shapes with a point every ~50 m and shape_dist_traveled in km
+#   - transfers between the bays of each intersection
+# Usage: python benchmarks/synthetic_gtfs.py txt_data --scale medium
+
+# Grid size and weekday headway for each preset
+SCALES = {
+    'small': {'rows': 6, 'cols': 8, 'headway_mins': 15},
+    'medium': {'rows': 12, 'cols': 16, 'headway_mins': 10},
+    'large': {'rows': 24, 'cols': 32, 'headway_mins': 6}
+}
+
+# South-west corner of the grid (Marpole) and the distance between streets
+ORIGIN_LAT, ORIGIN_LON = 49.205, -123.19
+BLOCK_M = 600
+METRES_PER_DEGREE = 111_320
+
+# service_id: (calendar weekdays, headway multiplier)
+SERVICES = {
+    '1': ([1, 1, 1, 1, 1, 0, 0], 1.0),
+    '2': ([0, 0, 0, 0, 0, 1, 0], 1.5),
+    '3': ([0, 0, 0, 0, 0, 0, 1], 2.0)
+}
+
+FIRST_DEPARTURE = 5 * 3600
+LAST_DEPARTURE = 25 * 3600
+
+BUS_SPEED_KMH = 22
+SKYTRAIN_SPEED_KMH = 45
+DWELL_SEC = 20
+SHAPE_POINT_M = 50
+
+
+def _grid_to_latlon(row, col):
+    lat = ORIGIN_LAT + row * BLOCK_M / METRES_PER_DEGREE
+    lon = ORIGIN_LON + col * BLOCK_M / (METRES_PER_DEGREE * np.cos(np.radians(ORIGIN_LAT)))
+    return lat, lon
+
+
+def _make_stops(rows, cols):
+    """One stop bay per direction at every intersection: E, W, N, S sides of the street."""
+    offset = 15 / METRES_PER_DEGREE
+    bays = {'E': (-offset, 0), 'W': (offset, 0), 'N': (0, offset), 'S': (0, -offset)}
+
+    records = []
+    for r in range(rows):
+        for c in range(cols):
+            lat, lon = _grid_to_latlon(r, c)
+            for bay, (d_lat, d_lon) in bays.items():
+                stop_id = f"{50000 + (r * cols + c) * 4 + 'EWNS'.index(bay)}"
+                records.append({
+                    'stop_id': stop_id,
+                    'stop_code': stop_id,
+                    'stop_name': f"Row {r} Ave @ Col {c} St ({bay}B)",
+                    'stop_lat': round(lat + d_lat, 6),
+                    'stop_lon': round(lon + d_lon, 6),
+                    'location_type': 0,
+                    'parent_station': None,
+                    'bay': bay,
+                    'row': r,
+                    'col': c
+                })
+    return pd.DataFrame(records)
+
+
+def _shape_points(shape_id, lats, lons, rng):
+    """Shape through the stops with a point every SHAPE_POINT_M and a little jitter."""
+    seg_m = np.hypot(
+        np.diff(lats) * METRES_PER_DEGREE,
+        np.diff(lons) * METRES_PER_DEGREE * np.cos(np.radians(ORIGIN_LAT))
+    )
+    points_lat, points_lon, points_dist = [lats[0]], [lons[0]], [0.0]
+    stop_dist = [0.0]
+
+    for i, length in enumerate(seg_m):
+        n = max(1, int(length // SHAPE_POINT_M))
+        t = np.arange(1, n + 1) / n
+        jitter = rng.normal(0, 2 / METRES_PER_DEGREE, size=(2, n))
+        jitter[:, -1] = 0
+
+        points_lat.extend(lats[i] + t * (lats[i + 1] - lats[i]) + jitter[0])
+        points_lon.extend(lons[i] + t * (lons[i + 1] - lons[i]) + jitter[1])
+        points_dist.extend(stop_dist[-1] + t * length / 1000)
+        stop_dist.append(stop_dist[-1] + length / 1000)
+
+    shape = pd.DataFrame({
+        'shape_id': shape_id,
+        'shape_pt_lat': np.round(points_lat, 6),
+        'shape_pt_lon': np.round(points_lon, 6),
+        'shape_pt_sequence': np.arange(1, len(points_lat) + 1),
+        'shape_dist_traveled': np.round(points_dist, 4)
+    })
+    return shape, np.array(stop_dist)
+
+
+def _schedule(route_id, direction, shape_id, stop_ids, stop_dist_km, speed_kmh, headway_mins, rng):
+    """trips and stop_times rows for one route direction, over every service day."""
+    trips, stop_times = [], []
+
+    run_sec = np.concatenate([[0], np.diff(stop_dist_km) / speed_kmh * 3600 + DWELL_SEC])
+
+    for service_id, (_, headway_scale) in SERVICES.items():
+        headway_sec = int(headway_mins * headway_scale * 60)
+        departures = np.arange(FIRST_DEPARTURE + direction * headway_sec // 2, LAST_DEPARTURE, headway_sec)
+
+        # Trips slow down a little in the rush hours and vary from run to run
+        hour = departures / 3600
+        rush = 1 + 0.25 * (np.exp(-((hour - 8) ** 2) / 2) + np.exp(-((hour - 17) ** 2) / 2))
+        noise = rng.normal(1, 0.05, size=(len(departures), len(stop_ids))).clip(0.85, 1.2)
+        arrivals = departures[:, None] + np.cumsum(run_sec[None, :] * rush[:, None] * noise, axis=1)
+        arrivals = arrivals.astype(int)
+
+        trip_ids = [f"{route_id}{direction}{service_id}{k:04d}" for k in range(len(departures))]
+        trips.append(pd.DataFrame({
+            'route_id': route_id,
+            'service_id': service_id,
+            'trip_id': trip_ids,
+            'direction_id': direction,
+            'block_id': [f"{route_id}{service_id}{k % 12:02d}" for k in range(len(departures))],
+            'shape_id': shape_id
+        }))
+
+        clock = [f"{a // 3600:02d}:{a % 3600 // 60:02d}:{a % 60:02d}" for a in arrivals.ravel()]
+        stop_times.append(pd.DataFrame({
+            'trip_id': np.repeat(trip_ids, len(stop_ids)),
+            'arrival_time': clock,
+            'departure_time': clock,
+            'stop_id': np.tile(stop_ids, len(departures)),
+            'stop_sequence': np.tile(np.arange(1, len(stop_ids) + 1), len(departures)),
+            'pickup_type': 0,
+            'drop_off_type': 0,
+            'shape_dist_traveled': np.tile(np.round(stop_dist_km, 4), len(departures)),
+            'timepoint': 1
+        }))
+
+    return pd.concat(trips), pd.concat(stop_times)
+
+
+def generate_feed(out_dir, rows=12, cols=16, headway_mins=10, seed=0):
+    """
+    Writes a synthetic GTFS feed (stops, routes, trips, stop_times, shapes, transfers,
+    calendar, calendar_dates, agency) to out_dir.
+    Returns {table: rows written}.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    stops = _make_stops(rows, cols)
+    bay = stops.set_index(['row', 'col', 'bay'])['stop_id']
+
+    routes, trips, stop_times, shapes = [], [], [], []
+
+    def add_route(route_id, short_name, long_name, route_type, directions, speed_kmh, headway):
+        routes.append({
+            'route_id': route_id,
+            'agency_id': 'SYN',
+            'route_short_name': short_name,
+            'route_long_name': long_name,
+            'route_type': route_type
+        })
+        for direction, (stop_ids, lats, lons) in enumerate(directions):
+            shape_id = f"{route_id}{direction}"
+            shape, stop_dist_km = _shape_points(shape_id, np.array(lats), np.array(lons), rng)
+            shapes.append(shape)
+
+            route_trips, route_stop_times = _schedule(route_id, direction, shape_id, stop_ids, stop_dist_km, speed_kmh, headway, rng)
+            trips.append(route_trips)
+            stop_times.append(route_stop_times)
+
+    def along(keys):
+        ids = [bay[k] for k in keys]
+        located = stops.set_index('stop_id').loc[ids]
+        return ids, located['stop_lat'].to_numpy(), located['stop_lon'].to_numpy()
+
+    # Buses along every avenue (rows) and street (columns)
+    for r in range(rows):
+        east = along([(r, c, 'E') for c in range(cols)])
+        west = along([(r, c, 'W') for c in reversed(range(cols))])
+        add_route(f"{1000 + r}", f"{r + 1:03d}", f"Row {r} Ave", 3, [east, west], BUS_SPEED_KMH, headway_mins)
+
+    for c in range(cols):
+        north = along([(r, c, 'N') for r in range(rows)])
+        south = along([(r, c, 'S') for r in reversed(range(rows))])
+        add_route(f"{2000 + c}", f"{100 + c + 1:03d}", f"Col {c} St", 3, [north, south], BUS_SPEED_KMH, headway_mins)
+
+    # SkyTrain on the diagonal, stopping at every other intersection
+    stations = [(i, i) for i in range(0, min(rows, cols), 2)]
+    line_keys = [(r, c, 'N') for r, c in stations]
+    outbound = along(line_keys)
+    inbound = along([(r, c, 'S') for r, c in reversed(stations)])
+    add_route("3000", None, "Diagonal Line", 1, [outbound, inbound], SKYTRAIN_SPEED_KMH, max(2, headway_mins / 3))
+
+    # Transfers between the bays at each intersection
+    transfers = stops[['row', 'col', 'stop_id']].merge(stops[['row', 'col', 'stop_id']], on=['row', 'col'], suffixes=('_from', '_to'))
+    transfers = transfers[transfers['stop_id_from'] != transfers['stop_id_to']]
+    transfers = pd.DataFrame({
+        'from_stop_id': transfers['stop_id_from'],
+        'to_stop_id': transfers['stop_id_to'],
+        'transfer_type': 2,
+        'min_transfer_time': rng.choice([60, 90, 120], size=len(transfers))
+    })
+
+    calendar = pd.DataFrame([
+        {
+            'service_id': service_id,
+            **dict(zip(['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'], days)),
+            'start_date': '20260101',
+            'end_date': '20261231'
+        }
+        for service_id, (days, _) in SERVICES.items()
+    ])
+
+    # Thanksgiving Monday runs the Sunday schedule
+    calendar_dates = pd.DataFrame([
+        {'service_id': '1', 'date': '20261012', 'exception_type': 2},
+        {'service_id': '3', 'date': '20261012', 'exception_type': 1}
+    ])
+
+    agency = pd.DataFrame([{
+        'agency_id': 'SYN',
+        'agency_name': 'Synthetic Transit',
+        'agency_url': 'https://example.com',
+        'agency_timezone': 'America/Vancouver'
+    }])
+
+    tables = {
+        'agency': agency,
+        'stops': stops.drop(columns=['bay', 'row', 'col']),
+        'routes': pd.DataFrame(routes),
+        'trips': pd.concat(trips),
+        'stop_times': pd.concat(stop_times),
+        'shapes': pd.concat(shapes),
+        'transfers': transfers,
+        'calendar': calendar,
+        'calendar_dates': calendar_dates
+    }
+
+    for name, table in tables.items():
+        table.to_csv(f'{out_dir}/{name}.txt', index=False)
+
+    return {name: len(table) for name, table in tables.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic GTFS feed.")
+    parser.add_argument('out_dir', nargs='?', default='txt_data')
+    parser.add_argument('--scale', choices=SCALES, default='medium')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    counts = generate_feed(args.out_dir, seed=args.seed, **SCALES[args.scale])
+    for name, rows in counts.items():
+        print(f"{name}: {rows} rows")
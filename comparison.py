@@ -0,0 +1,213 @@
+import contextvars
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import analysis
+import isochrone_cache
+import tracing
+
+# =============================
+# BASELINE VS SCENARIO
+# =============================
+
+# What a closure or a service cut costs one origin: the isochrone on the baseline
+# graph, the isochrone on the scenario graph, the area only the baseline reaches, and
+# how much later every stop is reached. Both sides share one snap, one projection of
+# the reached stops and the land pieces, and run side by side:
+#   searches   in a small process pool when both graphs are shared (shared_graph.py,
+#              so sending them is just their folder names), otherwise in threads
+#   polygons   in threads, since shapely releases the GIL while buffering and clipping
+# The atlas is not consulted: it answers for a cell centre, and comparing that with a
+# live search from the exact click would show differences that are not there.
+
+_POOL = None
+
+
+def _search_pool():
+    """Process pool for the two searches, started on first use and kept for later comparisons."""
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=2)
+    return _POOL
+
+
+def _in_processes(graphs):
+    return (os.cpu_count() or 1) > 1 and all(G.graph.get('shared') for G in graphs)
+
+
+def _run_in_threads(calls):
+    """Runs each (func, *args) in its own thread, keeping the caller's tracing context."""
+    with ThreadPoolExecutor(max_workers=len(calls)) as threads:
+        futures = [threads.submit(contextvars.copy_context().run, *call) for call in calls]
+        return [f.result() for f in futures]
+
+
+def search_both(graphs, first_legs, time_budget_mins, walk_speed_mps, max_walk_km):
+    """best_times ({stop_id: minutes}, empty when nothing is reached) on each graph from one snap."""
+    settings = (first_legs, time_budget_mins, walk_speed_mps, max_walk_km)
+
+    if not _in_processes(graphs):
+        results = _run_in_threads([(analysis.stop_times_from_legs, G, *settings) for G in graphs])
+        return [r or {} for r in results]
+
+    # Cached searches are answered here, so only the misses cross to the pool
+    best = []
+    pending = {}
+    for i, G in enumerate(graphs):
+        key = isochrone_cache.search_key(G, *settings)
+        found, best_times = isochrone_cache.get(key) if key is not None else (False, None)
+        if not found:
+            pending[i] = (key, _search_pool().submit(analysis.stop_times_from_legs, G, *settings))
+        best.append(dict(best_times) if best_times else {})
+
+    for i, (key, future) in pending.items():
+        best_times = future.result()
+        if key is not None:
+            isochrone_cache.put(key, best_times)
+        best[i] = best_times or {}
+    return best
+
+
+def polygons_for(time_sets, time_budget_mins, walk_speed_mps, max_walk_km):
+    """
+    Isochrone polygon (EPSG:4326 geometry, or None) for each best_times. Polygons already
+    drawn come from isochrone_cache; the rest share one projection of their stops and
+    are built side by side.
+    """
+    keys = [isochrone_cache.geometry_key(t, time_budget_mins, walk_speed_mps, max_walk_km) for t in time_sets]
+    polygons = [None] * len(time_sets)
+    missing = []
+
+    for i, (key, best_times) in enumerate(zip(keys, time_sets)):
+        found, wkb = isochrone_cache.get(key)
+        if found:
+            polygons[i] = None if wkb is None else shapely.from_wkb(wkb)
+        elif best_times:
+            missing.append(i)
+
+    if missing:
+        projected = analysis.project_stops(set().union(*(time_sets[i] for i in missing)))
+        areas = _run_in_threads([
+            (analysis.isochrone_area, time_sets[i], time_budget_mins, walk_speed_mps, max_walk_km, projected)
+            for i in missing
+        ])
+        built = gpd.GeoSeries(areas, crs="EPSG:3005").to_crs("EPSG:4326")
+        for i, polygon in zip(missing, built):
+            polygons[i] = polygon
+            isochrone_cache.put(keys[i], None if polygon is None else shapely.to_wkb(polygon))
+
+    return polygons
+
+
+def stop_deltas(base_times, scenario_times):
+    """
+    One row per stop reached on either side, with its minutes on each and the
+    difference (scenario - baseline). delta_min is inf for stops only the baseline
+    reaches and -inf for stops only the scenario reaches; the biggest losses come first.
+    """
+    stops = analysis.get_stops()
+    stop_ids = sorted(set(base_times) | set(scenario_times))
+
+    deltas = pd.DataFrame({
+        'stop_id': stop_ids,
+        'name': [stops[s].get('name') for s in stop_ids],
+        'lat': [stops[s]['lat'] for s in stop_ids],
+        'lon': [stops[s]['lon'] for s in stop_ids],
+        'baseline_min': [base_times.get(s, np.nan) for s in stop_ids],
+        'scenario_min': [scenario_times.get(s, np.nan) for s in stop_ids]
+    })
+    deltas['delta_min'] = deltas['scenario_min'].fillna(np.inf) - deltas['baseline_min'].fillna(np.inf)
+
+    return deltas.sort_values('delta_min', ascending=False, kind='stable').reset_index(drop=True)
+
+
+@tracing.traced('compare')
+def compare_isochrones(G_base, G_scenario, start_lat, start_lon, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0):
+    """
+    Isochrones from one origin on a baseline and a scenario graph, compared.
+    Returns None when no stop is within walking distance, otherwise a dict:
+      'baseline', 'scenario'  one-row GeoDataFrames (EPSG:4326) of each isochrone
+      'lost', 'gained'        area only the baseline reaches, and only the scenario reaches
+      'deltas'                stop_deltas() of the two searches
+      'summary'               areas in km², stops lost and gained, and minutes added
+    Layers with nothing in them have an empty geometry.
+    """
+
+    # 1. SNAP ONCE
+    first_legs = analysis.snap_to_stops(start_lat, start_lon, walk_speed_mps, max_walk_km)
+    if len(first_legs) == 0:
+        print("Warning: No stops found within walking distance.")
+        return None
+
+    # 2. BOTH SEARCHES
+    base_times, scenario_times = search_both(
+        (G_base, G_scenario), first_legs, time_budget_mins, walk_speed_mps, max_walk_km
+    )
+
+    # 3. BOTH POLYGONS, AND WHAT CHANGED BETWEEN THEM
+    with tracing.span('compare.geometry'):
+        base, scenario = (
+            shapely.Polygon() if p is None else p
+            for p in polygons_for([base_times, scenario_times], time_budget_mins, walk_speed_mps, max_walk_km)
+        )
+        layers = gpd.GeoSeries(
+            [base, scenario, shapely.difference(base, scenario), shapely.difference(scenario, base)],
+            index=['baseline', 'scenario', 'lost', 'gained'],
+            crs="EPSG:4326"
+        )
+        km2 = layers.to_crs("EPSG:3005").area / 1e6
+
+    # 4. PER-STOP DELTAS
+    deltas = stop_deltas(base_times, scenario_times)
+    both = np.isfinite(deltas['delta_min'])
+    summary = {
+        'baseline_km2': float(km2['baseline']),
+        'scenario_km2': float(km2['scenario']),
+        'lost_km2': float(km2['lost']),
+        'gained_km2': float(km2['gained']),
+        'stops_lost': int((deltas['delta_min'] == np.inf).sum()),
+        'stops_gained': int((deltas['delta_min'] == -np.inf).sum()),
+        'stops_slower': int((deltas.loc[both, 'delta_min'] > 1e-9).sum()),
+        'minutes_added': float(deltas.loc[both, 'delta_min'].clip(lower=0).sum())
+    }
+    tracing.current().set(**summary)
+
+    result = {name: gpd.GeoDataFrame(geometry=[layers[name]], crs="EPSG:4326") for name in layers.index}
+    result['deltas'] = deltas
+    result['summary'] = summary
+    return result
+
+
+# ==========================
+# TEST SCRIPT
+# ==========================
+if __name__ == "__main__":
+    import atlas
+    import service_calendar
+
+    TEST_LAT = 49.26259
+    TEST_LON = -123.0768
+    TEST_TIME = "08:00"
+    BUDGET = 30
+
+    print("--- Comparing the full network with no major bridges ---")
+    date = atlas.next_weekday()
+    G_base = service_calendar.graph_for_date(date, ("skytrain", "bridges"), TEST_TIME)
+    G_scenario = service_calendar.graph_for_date(date, ("skytrain",), TEST_TIME)
+
+    result = compare_isochrones(G_base, G_scenario, TEST_LAT, TEST_LON, time_budget_mins=BUDGET)
+
+    if result is not None:
+        for name, value in result['summary'].items():
+            print(f"  {name}: {value:.2f}" if isinstance(value, float) else f"  {name}: {value}")
+        print(result['deltas'].head(20).to_string())
+
+        os.makedirs("output", exist_ok=True)
+        result['lost'].to_file("output/comparison_lost.geojson", driver="GeoJSON")
+        result['deltas'].to_csv("output/comparison_deltas.csv", index=False)
+        print("Saved 'output/comparison_lost.geojson' and 'output/comparison_deltas.csv'.")
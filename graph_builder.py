@@ -1,30 +1,350 @@
 import networkx as nx
+import numpy as np
+import pandas as pd
 import pickle
-import sys
+import re
+from functools import lru_cache
+from types import MappingProxyType
+
+import memory
+import tracing
 
 # ==============================
 #  GLOBAL DATA LOADING
 # ==============================
 
-print("Loading network data...")
+# Everything below is loaded on first use and then cached, so importing this
+# module doesn't wait on the transfer, footpath or cluster files. Each cache is a
+# memory.py component, so a memory budget can drop it.
 
-try:
-    # Transfer Edges: {(u, v, 'transfer'): seconds}
-    with open('data/transfer_edges.pkl', 'rb') as f:
-        TRANSFER_EDGES = pickle.load(f)
+@memory.component('transfer_edges')
+@lru_cache(maxsize=None)
+def get_transfer_edges():
+    """Transfer Edges: {(u, v, 'transfer'): seconds}"""
+    try:
+        with open('data/transfer_edges.pkl', 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        print("Error: Could not find .pkl files in /data folder.")
+        print("Did you run preprocessing.py?")
+        raise
 
-    print("Data loaded successfully.")
-    
-    # first_key = list(NETWORK_EDGES.keys())[0]
-    # print(f"DEBUG: Network Edge Key Type: {type(first_key[0])} Value: '{first_key[0]}'")
 
-    # first_transfer = list(TRANSFER_EDGES.keys())[0]
-    # print(f"DEBUG: Transfer Key Type: {type(first_transfer[0])} Value: '{first_transfer[0]}'")
+# ==============================
+#  STATIC WALK LAYER
+# ==============================
+
+def build_walk_layer(transfer_edges):
+    """
+    Turns {(u, v, tag): seconds} into a read-only adjacency in both directions:
+    {'succ': {u: {v: attrs}}, 'pred': {v: {u: attrs}}}.
+    Transfers don't depend on day, time or frequency, so this is built once and
+    shared by every graph instead of being copied into each nx.DiGraph.
+    """
+    succ = {}
+    pred = {}
+
+    for (u, v, tag), weight_sec in transfer_edges.items():
+        edge_attrs = MappingProxyType({
+            'weight': weight_sec / 60.0,
+            'route_id': tag,
+            'type': 'walk'
+        })
+        succ.setdefault(u, {})[v] = edge_attrs
+        pred.setdefault(v, {})[u] = edge_attrs
+
+    return MappingProxyType({
+        'succ': MappingProxyType({u: MappingProxyType(nbrs) for u, nbrs in succ.items()}),
+        'pred': MappingProxyType({v: MappingProxyType(nbrs) for v, nbrs in pred.items()})
+    })
+
+
+EMPTY_WALK_LAYER = build_walk_layer({})
+
+
+# Graphs store the layer's name, not the layer, so pickled graphs stay small
+# and every process resolves the name to its own copy.
+@memory.component('walk_layers')
+@lru_cache(maxsize=None)
+def get_walk_layers():
+    """{'transfers': layer, 'clustered': layer (only when stop clusters exist)}"""
+    transfer_edges = get_transfer_edges()
+    walk_layers = {'transfers': build_walk_layer(transfer_edges)}
+
+    stop_clusters = get_stop_clusters()
+    if stop_clusters is not None:
+        walk_layers['clustered'] = build_walk_layer(cluster_transfer_edges(transfer_edges, stop_clusters))
+
+    return walk_layers
+
+
+def walk_layer(G):
+    """The static walk layer attached to G (empty for graphs built without one)."""
+    name = G.graph.get('walk_layer')
+    if name is None:
+        return EMPTY_WALK_LAYER
+    return get_walk_layers().get(name, EMPTY_WALK_LAYER)
+
+
+# ==============================
+#  GENERATED FOOTPATHS
+# ==============================
+
+def build_footpath_layer(stop_ids, from_idx, to_idx, dist_m):
+    """
+    CSR adjacency over stop_ids, plus its transpose so searches can also walk
+    the footpaths backwards: {'stop_ids', 'index', 'succ': (indptr, indices, dist_m), 'pred': ...}.
+    """
+    n = len(stop_ids)
+
+    order = np.lexsort((to_idx, from_idx))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(from_idx, minlength=n))])
+
+    rev_order = np.lexsort((from_idx, to_idx))
+    rev_indptr = np.concatenate([[0], np.cumsum(np.bincount(to_idx, minlength=n))])
+
+    return {
+        'stop_ids': list(stop_ids),
+        'index': {stop_id: i for i, stop_id in enumerate(stop_ids)},
+        'succ': (indptr, to_idx[order].astype(np.int32), dist_m[order].astype(np.float32)),
+        'pred': (rev_indptr, from_idx[rev_order].astype(np.int32), dist_m[rev_order].astype(np.float32))
+    }
+
+
+def load_footpaths(path='data/footpaths.npz'):
+    """Loads the CSR footpath arrays written by preprocessing.process_footpaths."""
+    with np.load(path) as data:
+        stop_ids = data['stop_ids'].tolist()
+        indptr = data['indptr']
+        indices = data['indices']
+        dist_m = data['dist_m']
+
+    from_idx = np.repeat(np.arange(len(stop_ids), dtype=np.int32), np.diff(indptr))
+    return build_footpath_layer(stop_ids, from_idx, indices, dist_m)
+
+
+@memory.component('footpaths')
+@lru_cache(maxsize=None)
+def get_footpaths():
+    """The generated footpath layer over stops, or None if preprocessing.process_footpaths hasn't been run."""
+    try:
+        footpaths = load_footpaths()
+    except FileNotFoundError:
+        return None
+
+    print(f"Loaded {len(footpaths['succ'][1])} generated footpaths.")
+    return footpaths
+
+
+# Same naming scheme as get_walk_layers
+@memory.component('footpath_layers')
+@lru_cache(maxsize=None)
+def get_footpath_layers():
+    """{'stops': layer, 'clustered': layer (only when stop clusters exist)}, empty without footpaths."""
+    footpaths = get_footpaths()
+    if footpaths is None:
+        return {}
+
+    footpath_layers = {'stops': footpaths}
+
+    stop_clusters = get_stop_clusters()
+    if stop_clusters is not None:
+        footpath_layers['clustered'] = cluster_footpaths(footpaths, stop_clusters)
+
+    return footpath_layers
+
+
+def footpath_edges(u, walk_speed_mps, direction='succ', layer='stops'):
+    """(v, walk_time_min) for every generated footpath leaving u ('pred': entering u)."""
+    footpaths = get_footpath_layers().get(layer)
+    if footpaths is None or u not in footpaths['index']:
+        return []
+
+    indptr, indices, dist_m = footpaths[direction]
+    row = footpaths['index'][u]
+    start, end = indptr[row], indptr[row + 1]
+
+    stop_ids = footpaths['stop_ids']
+    walk_speed_mpm = walk_speed_mps * 60.0
+    return [
+        (stop_ids[i], d / walk_speed_mpm)
+        for i, d in zip(indices[start:end].tolist(), dist_m[start:end].tolist())
+    ]
+
+
+# ==============================
+#  STOP CLUSTERS (optional)
+# ==============================
+
+@memory.component('stop_clusters')
+@lru_cache(maxsize=None)
+def get_stop_clusters():
+    """Stop Clusters: {stop_id: cluster_id}, written by preprocessing.process_clusters (None if absent)."""
+    try:
+        with open('data/stop_clusters.pkl', 'rb') as f:
+            stop_clusters = pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+    print(f"Loaded stop clusters for {len(stop_clusters)} stops.")
+    return stop_clusters
+
+
+def cluster_members(clusters):
+    """Inverts {stop_id: cluster_id} into {cluster_id: [stop_id, ...]}."""
+    members = {}
+    for stop_id, cluster_id in clusters.items():
+        members.setdefault(cluster_id, []).append(stop_id)
+    return members
+
+
+def cluster_network(network_edges, clusters):
+    """
+    Renames segment endpoints to their clusters. Segments inside one cluster are dropped
+    and segments that now share (u, v, route) pool their trips.
+    """
+    clustered = {}
+
+    for (u, v, route_id), edge_data in network_edges.items():
+        cu = clusters.get(u, u)
+        cv = clusters.get(v, v)
+        if cu == cv:
+            continue
+
+        key = (cu, cv, route_id)
+        if key not in clustered:
+            clustered[key] = dict(edge_data)
+        else:
+            clustered[key]['trips'] = clustered[key]['trips'] + edge_data['trips']
+
+    return clustered
+
+
+def cluster_transfer_edges(transfer_edges, clusters):
+    """Transfers between clusters, keeping the fastest of any merged pairs."""
+    clustered = {}
+
+    for (u, v, tag), weight_sec in transfer_edges.items():
+        cu = clusters.get(u, u)
+        cv = clusters.get(v, v)
+        if cu == cv:
+            continue
+
+        key = (cu, cv, tag)
+        clustered[key] = min(weight_sec, clustered.get(key, weight_sec))
+
+    return clustered
+
+
+def cluster_footpaths(footpaths, clusters):
+    """Footpaths between clusters, keeping the shortest of any merged pairs."""
+    indptr, indices, dist_m = footpaths['succ']
+    stop_ids = footpaths['stop_ids']
+
+    cluster_of = np.array([clusters.get(s, s) for s in stop_ids], dtype=object)
+    from_idx = np.repeat(np.arange(len(stop_ids)), np.diff(indptr))
+
+    paths = pd.DataFrame({
+        'u': cluster_of[from_idx],
+        'v': cluster_of[indices],
+        'dist_m': dist_m
+    })
+    paths = paths[paths['u'] != paths['v']].groupby(['u', 'v'], as_index=False)['dist_m'].min()
 
-except FileNotFoundError:
-    print("Error: Could not find .pkl files in /data folder.")
-    print("Did you run preprocessing.py?")
-    sys.exit(1)
+    cluster_ids = pd.Index(sorted(set(cluster_of)))
+    return build_footpath_layer(
+        cluster_ids.tolist(),
+        cluster_ids.get_indexer(paths['u']),
+        cluster_ids.get_indexer(paths['v']),
+        paths['dist_m'].to_numpy()
+    )
+
+
+@memory.component('cluster_members')
+@lru_cache(maxsize=None)
+def get_cluster_members():
+    """{cluster_id: [stop_id, ...]}, or None without stop clusters."""
+    stop_clusters = get_stop_clusters()
+    if stop_clusters is None:
+        return None
+    return cluster_members(stop_clusters)
+
+
+def to_graph_stops(G, legs):
+    """
+    Maps (stop_id, walk_time_min) pairs onto G's street nodes: unchanged for plain graphs,
+    renamed to clusters (fastest member wins) for clustered ones.
+    """
+    if not G.graph.get('clustered'):
+        return legs
+
+    stop_clusters = get_stop_clusters()
+    fastest = {}
+    for stop_id, walk_time in legs:
+        cluster_id = stop_clusters.get(stop_id, stop_id)
+        fastest[cluster_id] = min(walk_time, fastest.get(cluster_id, float('inf')))
+    return list(fastest.items())
+
+
+# ==============================
+#  EDGE ACCESS
+# ==============================
+
+def out_edges(G, u, walk_speed_mps=None, direction='succ'):
+    """
+    Yields (v, weight_min) for every edge leaving u: transit edges in G, the shared
+    walk layer, and (when a walk speed is given) generated footpaths.
+    direction='pred' yields edges entering u instead.
+    """
+    if G.graph.get('shared'):
+        # shared_graph.SharedGraph reads weights straight from its arrays
+        yield from G.weighted_edges(u, direction)
+    else:
+        adjacency = G.succ if direction == 'succ' else G.pred
+        if u in adjacency:
+            for v, edge_data in adjacency[u].items():
+                yield v, edge_data['weight']
+
+    layer = walk_layer(G)[direction]
+    if u in layer:
+        for v, edge_data in layer[u].items():
+            yield v, edge_data['weight']
+
+    if walk_speed_mps and G.graph.get('footpaths'):
+        yield from footpath_edges(u, walk_speed_mps, direction, G.graph['footpaths'])
+
+
+def get_edge(G, u, v, walk_speed_mps=None):
+    """Edge attributes from the transit layer, falling back to the walk layer and footpaths."""
+    data = G.get_edge_data(u, v)
+    if data is not None:
+        return data
+
+    data = walk_layer(G)['succ'].get(u, {}).get(v)
+    if data is not None:
+        return data
+
+    if walk_speed_mps and G.graph.get('footpaths'):
+        for w, weight in footpath_edges(u, walk_speed_mps, layer=G.graph['footpaths']):
+            if w == v:
+                return {'weight': weight, 'route_id': 'footpath', 'type': 'walk'}
+
+    return None
+
+
+def graph_key(network_key, current_time_str, window_mins=60, frequency_modifier=1.0, clustered=False):
+    """
+    Identifies a built graph for files and caches derived from it
+    (network_key is the network file name, e.g. 'network_edges_1_skytrain_bridges';
+    preprocessing.network_path puts its toggles in one order, so one set has one key).
+    """
+    return f"{network_key}_{current_time_str.replace(':', '')}_{window_mins}_{frequency_modifier:g}" + ("_clustered" if clustered else "")
+
+
+def built_from(key, network_key):
+    """True when the graph key was built from the network file named network_key."""
+    # Graph keys are '{network_key}_{HHMM}_...' (see graph_key)
+    return key is not None and re.match(re.escape(network_key) + r'_\d{3,4}_', key) is not None
 
 
 def parse_time(time_str):
@@ -39,7 +359,8 @@ def parse_time(time_str):
 # GRAPH BUILDER
 # =================
 
-def build_graph(network_edges, current_time_str, window_mins=60, frequency_modifier=1.0):
+@tracing.traced('graph.build')
+def build_graph(network_edges, current_time_str, window_mins=60, frequency_modifier=1.0, use_clusters=False, contract=False, network_key=None):
 
     # convert time to seconds
     center_sec = parse_time(current_time_str)
@@ -51,7 +372,17 @@ def build_graph(network_edges, current_time_str, window_mins=60, frequency_modif
     start_window = center_sec - (window_seconds / 2)
     end_window = center_sec + (window_seconds / 2)
     
-    G = nx.DiGraph()
+    # With use_clusters, street nodes become the station clusters of preprocessing.process_clusters
+    stop_clusters = get_stop_clusters() if use_clusters else None
+    clustered = stop_clusters is not None
+    if clustered:
+        network_edges = cluster_network(network_edges, stop_clusters)
+
+    G = nx.DiGraph(clustered=clustered)
+
+    if network_key is not None:
+        G.graph['key'] = graph_key(network_key, current_time_str, window_mins, frequency_modifier, clustered)
+        G.graph['network'] = network_key
         
     # ADD NETWORK EDGES
     for (u, v, route_id), edge_data in network_edges.items():
@@ -110,20 +441,183 @@ def build_graph(network_edges, current_time_str, window_mins=60, frequency_modif
         break 
         """
 
-    # ADD TRANSFER EDGES
-    # Transfers connect Street Nodes to Street Nodes
-    for (u, v, tag), weight_sec in TRANSFER_EDGES.items():
-        
-        weight_min = weight_sec / 60.0
-        
-        G.add_edge(
-            u, 
-            v, 
-            weight=weight_min,
-            route_id=tag, 
-            type='walk'
-        )
-    return G
+    # ATTACH TRANSFER EDGES
+    # Transfers connect Street Nodes to Street Nodes. They live in the shared
+    # walk layer; searches read it alongside G (see get_edge).
+    G.graph['walk_layer'] = 'clustered' if clustered else 'transfers'
+
+    # Generated footpaths are weighted per walk speed at query time (see out_edges)
+    G.graph['footpaths'] = ('clustered' if clustered else 'stops') if get_footpaths() is not None else None
+    tracing.current().set(network=network_key, nodes=G.number_of_nodes(), edges=G.number_of_edges(), contract=contract)
+
+    # Contracted mode: in-vehicle chains become shortcut edges (see contract_graph)
+    if contract:
+        G = contract_graph(G)
+
+    # Counted towards the memory budget for as long as the graph is alive
+    return memory.account('graphs', G)
+
+# =======================
+# ROUTE-CHAIN CONTRACTION
+# =======================
+
+# Longest run of in-vehicle nodes folded into one piece. Boarding at or getting off
+# inside a piece needs a direct street edge per stop pair, so edges grow with the
+# square of this while nodes shrink linearly.
+MAX_CHAIN = 8
+
+def _chain_interior(G, n):
+    """
+    Returns (prev, next, street) when route node n sits inside an in-vehicle chain:
+    one travel edge in, one travel edge out, and otherwise only boarding from and
+    getting off to its own street node. Returns None for every other node.
+    """
+    travel_in, travel_out, street = [], [], None
+
+    for p, edge_data in G.pred[n].items():
+        if edge_data['type'] == 'travel':
+            travel_in.append(p)
+        elif edge_data['type'] == 'board' and street in (None, p):
+            street = p
+        else:
+            return None
+
+    for v, edge_data in G.succ[n].items():
+        if edge_data['type'] == 'travel':
+            travel_out.append(v)
+        elif edge_data['type'] == 'deboard' and street in (None, v):
+            street = v
+        else:
+            return None
+
+    if len(travel_in) != 1 or len(travel_out) != 1 or travel_in[0] == travel_out[0] or street is None:
+        return None
+
+    return travel_in[0], travel_out[0], street
+
+
+def contract_graph(G, max_chain=MAX_CHAIN):
+    """
+    Folds in-vehicle chains of travel edges into shortcut edges. For a piece
+    a -> i1 -> ... -> ik -> b, the inner route nodes disappear and are replaced by:
+      a -> b             stay on board
+      a -> street(ij)    ride, then get off at ij
+      street(ij) -> b    board at ij, then ride
+      street(ij) -> street(il)  board at ij, get off at il
+    Every shortcut keeps 'path' (the original nodes) and 'legs' (the original edge
+    attributes) so expand_path can rebuild itineraries and shape geometry.
+    """
+    interior = {}
+    for n in G.nodes:
+        chain = _chain_interior(G, n)
+        if chain is not None:
+            interior[n] = chain
+
+    # Cut chains into pieces between kept nodes. A chain longer than max_chain keeps
+    # a node at each cut, and a loop made only of interior nodes keeps one of its nodes.
+    kept = {n for n in G.nodes if n not in interior}
+    visited = set()
+    pieces = []
+
+    def trace(start):
+        stack = [start]
+        while stack:
+            a = stack.pop()
+            for first, edge_data in G.succ[a].items():
+                if edge_data['type'] != 'travel' or first not in interior or first in visited:
+                    continue
+
+                piece = [a]
+                node = first
+                while node in interior and node not in visited:
+                    if len(piece) > max_chain:
+                        kept.add(node)
+                        visited.add(node)
+                        stack.append(node)
+                        break
+                    visited.add(node)
+                    piece.append(node)
+                    node = interior[node][1]
+
+                piece.append(node)
+                pieces.append(piece)
+
+    for n in list(kept):
+        trace(n)
+    for n in interior:
+        if n not in visited:
+            kept.add(n)
+            visited.add(n)
+            trace(n)
+
+    # Copy everything that touches kept nodes only
+    H = nx.DiGraph(**G.graph)
+    H.graph['contracted'] = True
+    if G.graph.get('key') is not None:
+        H.graph['key'] = G.graph['key'] + "_contracted"
+    H.add_nodes_from(n for n in G.nodes if n not in interior or n in kept)
+    H.add_edges_from(
+        (u, v, edge_data) for u, v, edge_data in G.edges(data=True)
+        if (u not in interior or u in kept) and (v not in interior or v in kept)
+    )
+
+    def add_shortcut(u, v, path, legs):
+        if u == v:
+            return
+        weight = sum(leg['weight'] for leg in legs)
+        if H.has_edge(u, v) and H.edges[u, v]['weight'] <= weight:
+            return
+        H.add_edge(u, v, weight=weight, type='shortcut', route_id=legs[0]['route_id'],
+                   path=tuple(path), legs=tuple(legs))
+
+    for piece in pieces:
+        inner = piece[1:-1]
+        if not inner:
+            continue
+
+        travel = [G.edges[a, b] for a, b in zip(piece, piece[1:])]
+        a, b = piece[0], piece[-1]
+
+        add_shortcut(a, b, piece, travel)
+
+        for j, node in enumerate(inner, start=1):
+            street = interior[node][2]
+            board = G.edges[street, node]
+            deboard = G.edges[node, street]
+
+            # Ride from a, get off here
+            add_shortcut(a, street, piece[:j + 1] + [street], travel[:j] + [deboard])
+            # Board here, ride to b
+            add_shortcut(street, b, [street] + piece[j:], [board] + travel[j:])
+
+            # Board here, get off further down the piece
+            for l in range(j + 1, len(piece) - 1):
+                other_street = interior[piece[l]][2]
+                add_shortcut(street, other_street,
+                             [street] + piece[j:l + 1] + [other_street],
+                             [board] + travel[j:l] + [G.edges[piece[l], other_street]])
+
+    return H
+
+
+def expand_path(G, node_path, walk_speed_mps=None):
+    """
+    Turns a node path into (u, v, edge_data) legs, unfolding shortcut edges into the
+    original board/travel/deboard edges. Pairs without an edge get edge_data None.
+    """
+    legs = []
+
+    for u, v in zip(node_path, node_path[1:]):
+        edge_data = get_edge(G, u, v, walk_speed_mps)
+
+        if edge_data is not None and 'path' in edge_data:
+            path = edge_data['path']
+            legs.extend(zip(path, path[1:], edge_data['legs']))
+        else:
+            legs.append((u, v, edge_data))
+
+    return legs
+
 
 # ==========================
 # TEST SCRIPT
@@ -134,11 +628,15 @@ if __name__ == "__main__":
     # Test Parameters
     TEST_TIME = "08:00" # 8:00 AM (Rush Hour)
     TEST_WINDOW = 60    # 1 Hour Window
+    TEST_NETWORK = 'data/network_edges_1_skytrain_bridges.pkl' # Weekday, everything open
+
+    with open(TEST_NETWORK, 'rb') as f:
+        network_edges = pickle.load(f)
     
     try:
         # Build
         print(f"Building graph for {TEST_TIME}...")
-        graph = build_graph(TEST_TIME, TEST_WINDOW)
+        graph = build_graph(network_edges, TEST_TIME, TEST_WINDOW)
         
         # Report Stats
         print(f"Graph built successfully!")
@@ -147,7 +645,7 @@ if __name__ == "__main__":
         
         # Check specific edge types
         bus_edges = [e for u, v, e in graph.edges(data=True) if e['type'] == 'travel']
-        walk_edges = [e for u, v, e in graph.edges(data=True) if e['type'] == 'walk']
+        walk_edges = [e for nbrs in walk_layer(graph)['succ'].values() for e in nbrs.values()]
         board_edges = [e for u, v, e in graph.edges(data=True) if e['type'] == 'board']
         deboard_edges = [e for u, v, e in graph.edges(data=True) if e['type'] == 'deboard']
         
@@ -161,4 +659,24 @@ if __name__ == "__main__":
             print(f"\nSample Bus Edge Data: {bus_edges[0]}")
 
     except Exception as e:
-        print(f"\nCRASHED: {e}")
\ No newline at end of file
+        print(f"\nCRASHED: {e}")
+
+    # Contraction measurements
+    print("\n--- Route-Chain Contraction ---")
+    import analysis
+
+    graph = build_graph(network_edges, TEST_TIME, TEST_WINDOW)
+    contracted = contract_graph(graph)
+
+    # Origins: a sample of stop locations
+    stops = analysis.get_stops()
+    sample = list(stops.values())[::max(1, len(stops) // 50)]
+    origins = [(info['lat'], info['lon']) for info in sample]
+
+    before = analysis.measure_searches(graph, origins)
+    after = analysis.measure_searches(contracted, origins)
+
+    print(f"Nodes: {graph.number_of_nodes()} -> {contracted.number_of_nodes()}")
+    print(f"Edges: {graph.number_of_edges()} -> {contracted.number_of_edges()}")
+    print(f"Settled per search: {before['settled']:.0f} -> {after['settled']:.0f}")
+    print(f"Time per search: {before['ms']:.1f} ms -> {after['ms']:.1f} ms")
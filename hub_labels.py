@@ -0,0 +1,277 @@
+import numpy as np
+import pickle
+import os
+import time
+from functools import lru_cache
+from heapq import heappush, heappop
+
+import graph_builder
+import memory
+import shared_graph
+
+# =============================
+# HUB LABELS
+# =============================
+
+# Pruned landmark labeling over a built graph. Every node v gets
+#   out-label: {hub: minutes from v to hub}
+#   in-label:  {hub: minutes from hub to v}
+# and the travel time s -> t is min over shared hubs of out[s][hub] + in[t][hub].
+# The frequency-based graph is static for a given (network, time, frequency, walk speed),
+# so labels are computed once offline and saved next to the network files.
+
+def labels_path(G, walk_speed_mps):
+    """Where labels for this graph are saved, or None for graphs without a key."""
+    if G.graph.get('key') is None:
+        return None
+    return f"data/hub_labels_{G.graph['key']}_{walk_speed_mps:g}.pkl"
+
+
+def fingerprint(G):
+    """
+    What labels for G are computed from: the network and footpath files as they are on
+    disk, and the graph's size. Saved labels with a different fingerprint are stale.
+    """
+    def version(path):
+        return shared_graph.network_version(path) if os.path.exists(path) else None
+
+    return (version(f"data/{G.graph.get('network')}.pkl"), version('data/footpaths.npz'), G.number_of_nodes())
+
+
+def _index_graph(G, walk_speed_mps):
+    """
+    Integer adjacency lists in both directions over transit edges, the walk layer and
+    footpaths, so the labeling loop never touches networkx.
+    """
+    nodes = set(G.nodes)
+    nodes.update(graph_builder.walk_layer(G)['succ'])
+    nodes.update(graph_builder.walk_layer(G)['pred'])
+    if G.graph.get('footpaths'):
+        nodes.update(graph_builder.get_footpath_layers()[G.graph['footpaths']]['stop_ids'])
+
+    nodes = sorted(nodes, key=str)
+    index = {n: i for i, n in enumerate(nodes)}
+
+    forward = [[] for _ in nodes]
+    backward = [[] for _ in nodes]
+    for u in nodes:
+        for v, weight in graph_builder.out_edges(G, u, walk_speed_mps):
+            forward[index[u]].append((index[v], weight))
+            backward[index[v]].append((index[u], weight))
+
+    return nodes, index, forward, backward
+
+
+def _label_query(out_label, in_label):
+    """min over shared hubs of out_label[hub] + in_label[hub]."""
+    if len(out_label) > len(in_label):
+        out_label, in_label = in_label, out_label
+    best = float('inf')
+    for hub, d in out_label.items():
+        other = in_label.get(hub)
+        if other is not None and d + other < best:
+            best = d + other
+    return best
+
+
+def _pruned_dijkstra(source, rank, adjacency, source_label, labels, forward):
+    """
+    One labeling pass from the hub at `source`. Nodes already covered by
+    earlier hubs at this distance or better are neither labeled nor expanded.
+    """
+    best = {source: 0.0}
+    settled = set()
+    heap = [(0.0, source)]
+
+    while heap:
+        d, v = heappop(heap)
+        if v in settled:
+            continue
+        settled.add(v)
+
+        if forward:
+            covered = _label_query(source_label, labels[v])
+        else:
+            covered = _label_query(labels[v], source_label)
+        if covered <= d:
+            continue
+
+        labels[v][rank] = d
+
+        for w, weight in adjacency[v]:
+            nd = d + weight
+            if nd < best.get(w, float('inf')):
+                best[w] = nd
+                heappush(heap, (nd, w))
+
+
+def build_hub_labels(G, walk_speed_mps=1.2):
+    """
+    Builds and saves hub labels for G. Hubs are taken in decreasing degree order so
+    busy interchanges cover most shortest paths early and prune later searches.
+    Only street nodes (stops) are kept in the saved labels.
+    Returns (labels, stats).
+    """
+    t0 = time.perf_counter()
+
+    nodes, index, forward, backward = _index_graph(G, walk_speed_mps)
+    order = sorted(range(len(nodes)), key=lambda i: len(forward[i]) + len(backward[i]), reverse=True)
+
+    label_in = [{} for _ in nodes]
+    label_out = [{} for _ in nodes]
+
+    for rank, hub in enumerate(order):
+        # Hub -> everything (fills in-labels), then everything -> hub (fills out-labels)
+        _pruned_dijkstra(hub, rank, forward, label_out[hub], label_in, forward=True)
+        _pruned_dijkstra(hub, rank, backward, label_in[hub], label_out, forward=False)
+
+        if rank % 5000 == 0 and rank:
+            print(f"Labeled {rank}/{len(nodes)} hubs...")
+
+    def packed(label):
+        ranks = np.fromiter(sorted(label), dtype=np.int32, count=len(label))
+        dists = np.array([label[r] for r in ranks.tolist()], dtype=np.float32)
+        return ranks, dists
+
+    street_nodes = [n for n in nodes if "_" not in str(n)]
+    labels = {
+        'key': G.graph.get('key'),
+        'walk_speed_mps': walk_speed_mps,
+        'fingerprint': fingerprint(G),
+        'out': {n: packed(label_out[index[n]]) for n in street_nodes},
+        'in': {n: packed(label_in[index[n]]) for n in street_nodes}
+    }
+
+    entries = sum(len(r) for r, _ in labels['out'].values()) + sum(len(r) for r, _ in labels['in'].values())
+    stats = {
+        'preprocessing_s': time.perf_counter() - t0,
+        'nodes': len(nodes),
+        'street_nodes': len(street_nodes),
+        'avg_label_entries': entries / max(2 * len(street_nodes), 1),
+        'label_mb': entries * 8 / 1e6
+    }
+
+    path = labels_path(G, walk_speed_mps)
+    if path is not None:
+        with open(path, 'wb') as f:
+            pickle.dump(labels, f)
+        print(f"Hub labels saved to '{path}'.")
+
+    print(f"Hub labels complete in {stats['preprocessing_s']:.1f} s. "
+          f"{stats['avg_label_entries']:.1f} entries per label, {stats['label_mb']:.1f} MB.")
+
+    return labels, stats
+
+
+# =============================
+# QUERIES
+# =============================
+
+@memory.component('hub_labels')
+@lru_cache(maxsize=None)
+def _read_labels(path, version):
+    # version (the file's mtime and size) makes a rebuilt file a new cache entry
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_hub_labels(G, walk_speed_mps):
+    """Labels saved for this graph and walk speed, or None if there are none (or they are stale)."""
+    path = labels_path(G, walk_speed_mps)
+    if path is None or not os.path.exists(path):
+        return None
+    labels = _read_labels(path, shared_graph.network_version(path))
+    if labels.get('fingerprint') != fingerprint(G):
+        print(f"Hub labels in '{path}' were built from other network files. Ignoring them.")
+        return None
+    return labels
+
+
+def _combine(labels, legs):
+    """
+    Merges the labels of several stops, each offset by its walking time, into one
+    label (the cheapest way to reach / leave every hub through any of them).
+    """
+    ranks = []
+    dists = []
+    for stop_id, walk_time in legs:
+        if stop_id not in labels:
+            continue
+        stop_ranks, stop_dists = labels[stop_id]
+        ranks.append(stop_ranks)
+        dists.append(stop_dists + np.float32(walk_time))
+
+    if not ranks:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+    ranks = np.concatenate(ranks)
+    dists = np.concatenate(dists)
+
+    # Keep the smallest distance per hub
+    order = np.lexsort((dists, ranks))
+    ranks, dists = ranks[order], dists[order]
+    first = np.concatenate([[True], ranks[1:] != ranks[:-1]])
+    return ranks[first], dists[first]
+
+
+def label_travel_time(labels, first_legs, last_legs):
+    """
+    Door-to-door minutes from the walked-to stops (first_legs) to the stops walked from
+    (last_legs), by merging labels only. Returns inf when no hub connects them.
+    """
+    out_ranks, out_dists = _combine(labels['out'], first_legs)
+    in_ranks, in_dists = _combine(labels['in'], last_legs)
+
+    _, i, j = np.intersect1d(out_ranks, in_ranks, assume_unique=True, return_indices=True)
+    if len(i) == 0:
+        return float('inf')
+
+    return float((out_dists[i] + in_dists[j]).min())
+
+
+# ==========================
+# TEST SCRIPT
+# ==========================
+if __name__ == "__main__":
+    import random
+    import analysis
+    import preprocessing
+
+    TEST_TIME = "08:00"
+    WALK_SPEED = 1.2
+    NETWORK_PATH = preprocessing.network_path(1, ("skytrain", "bridges"))
+    NETWORK_KEY = os.path.splitext(os.path.basename(NETWORK_PATH))[0]
+
+    print("--- Building Hub Labels ---")
+    with open(NETWORK_PATH, 'rb') as f:
+        network_edges = pickle.load(f)
+
+    G = graph_builder.build_graph(network_edges, TEST_TIME, window_mins=60, network_key=NETWORK_KEY)
+    labels, stats = build_hub_labels(G, WALK_SPEED)
+
+    # Query speed: labels vs. search, on random stop pairs
+    random.seed(0)
+    stops = list(analysis.get_stops().values())
+    pairs = [(random.choice(stops), random.choice(stops)) for _ in range(200)]
+
+    legs = [
+        (analysis.snap_to_stops(a['lat'], a['lon'], WALK_SPEED, 0.5),
+         analysis.snap_to_stops(b['lat'], b['lon'], WALK_SPEED, 0.5))
+        for a, b in pairs
+    ]
+
+    t0 = time.perf_counter()
+    label_times = [label_travel_time(labels, graph_builder.to_graph_stops(G, s), graph_builder.to_graph_stops(G, t)) for s, t in legs]
+    label_ms = 1000 * (time.perf_counter() - t0) / len(legs)
+
+    t0 = time.perf_counter()
+    search_times = []
+    for s, t in legs:
+        last_legs = dict(graph_builder.to_graph_stops(G, t))
+        dist, _ = analysis.search_tree(G, s, float('inf'), last_legs=last_legs, walk_speed_mps=WALK_SPEED)
+        search_times.append(min((dist[n] + w for n, w in last_legs.items() if n in dist), default=float('inf')))
+    search_ms = 1000 * (time.perf_counter() - t0) / len(legs)
+
+    mismatches = sum(1 for a, b in zip(label_times, search_times) if abs(a - b) > 1e-3)
+    print(f"Label query: {label_ms:.3f} ms, search: {search_ms:.2f} ms ({search_ms / label_ms:.0f}x speedup)")
+    print(f"Mismatched travel times: {mismatches} of {len(legs)}")
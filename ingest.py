@@ -0,0 +1,199 @@
+import pandas as pd
+import numpy as np
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import time
+import zipfile
+
+import isochrone_cache
+import preprocessing
+import service_calendar
+import shared_graph
+
+# =============================
+# GTFS ZIP INGESTION
+# =============================
+
+# Reads a GTFS zip straight from the archive (members are streamed, never extracted)
+# and writes a typed Parquet store that preprocessing reads instead of txt_data/:
+#   gtfs_data/{table}.parquet                      one file per small table
+#   gtfs_data/stop_times/service_id=X/*.parquet    stop_times split by service day
+# so a day's network only ever opens that day's stop_times.
+
+# The store remembers which zip it came from, so a new feed can drop the networks
+# built from the old one (and an unchanged feed keeps them)
+FEED_VERSION_FILE = 'feed_version.txt'
+
+STOP_TIMES_SCHEMA_COLUMNS = ['trip_id', 'stop_id', 'stop_sequence', 'arrival_sec', 'shape_dist_traveled', 'service_id']
+
+
+def _stop_times_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('trip_id', pa.string()),
+        ('stop_id', pa.string()),
+        ('stop_sequence', pa.int32()),
+        ('arrival_sec', pa.int32()),
+        ('shape_dist_traveled', pa.float64()),
+        ('service_id', pa.string())
+    ])
+
+
+def _stop_times_batches(archive, member, service_of_trip, chunksize):
+    """Typed record batches of stop_times, each row tagged with its trip's service_id."""
+    import pyarrow as pa
+
+    schema = _stop_times_schema()
+
+    with archive.open(member) as f:
+        reader = pd.read_csv(
+            f,
+            usecols=lambda column: column in preprocessing.STOP_TIMES_COLUMNS,
+            dtype={'trip_id': str, 'stop_id': str, 'arrival_time': str, 'stop_sequence': np.int32},
+            chunksize=chunksize
+        )
+
+        for chunk in reader:
+            chunk['arrival_sec'] = preprocessing.parse_gtfs_times(chunk.pop('arrival_time'))
+            if 'shape_dist_traveled' not in chunk:
+                chunk['shape_dist_traveled'] = np.nan
+            chunk['service_id'] = chunk['trip_id'].map(service_of_trip)
+
+            # Rows for trips missing from trips.txt can never be selected by a service day
+            chunk = chunk[chunk['service_id'].notna()]
+            yield pa.RecordBatch.from_pandas(chunk[STOP_TIMES_SCHEMA_COLUMNS], schema=schema, preserve_index=False)
+
+
+def feed_version(zip_path):
+    """Short SHA-1 of the zip's bytes."""
+    digest = hashlib.sha1()
+    with open(zip_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def stored_version(store_dir=preprocessing.GTFS_STORE):
+    """feed_version of the zip the store at store_dir was ingested from (None if unknown)."""
+    try:
+        with open(f'{store_dir}/{FEED_VERSION_FILE}') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def drop_networks(data_dir='data'):
+    """
+    Deletes every network file, and the hub labels and atlases built from them.
+    Their shared graphs are retired. Returns the network keys dropped.
+    """
+    network_keys = []
+    for path in glob.glob(f'{data_dir}/network_edges_*.pkl'):
+        network_keys.append(os.path.splitext(os.path.basename(path))[0])
+        os.remove(path)
+
+    for network_key in network_keys:
+        preprocessing.drop_built_from(network_key, data_dir)
+
+    shared_graph.retire()
+    return network_keys
+
+
+def ingest_gtfs(zip_path, store_dir=preprocessing.GTFS_STORE, chunksize=preprocessing.STOP_TIMES_CHUNK_ROWS):
+    """
+    Converts the GTFS zip at zip_path into the Parquet store at store_dir.
+    The new store is written next to the old one and swapped in at the end, so a
+    failed ingest leaves the previous feed untouched.
+    Returns {table: rows written}.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    t0 = time.perf_counter()
+    staging_dir = f'{store_dir}.ingesting'
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    version = feed_version(zip_path)
+    previous_version = stored_version(store_dir)
+
+    counts = {}
+
+    with zipfile.ZipFile(zip_path) as archive:
+        # Members may sit in a subfolder of the zip
+        members = {
+            os.path.splitext(os.path.basename(name))[0]: name
+            for name in archive.namelist() if name.endswith('.txt')
+        }
+
+        if 'trips' not in members or 'stop_times' not in members:
+            shutil.rmtree(staging_dir)
+            raise ValueError(f"'{zip_path}' is missing trips.txt or stop_times.txt.")
+
+        # 1. SMALL TABLES
+        for table, member in members.items():
+            if table == 'stop_times':
+                continue
+
+            with archive.open(member) as f:
+                df = pd.read_csv(f, dtype=preprocessing.GTFS_DTYPES)
+
+            df.to_parquet(f'{staging_dir}/{table}.parquet', index=False)
+            counts[table] = len(df)
+            print(f"Ingested {table}: {len(df)} rows.")
+
+        # 2. STOP TIMES, partitioned by service_id
+        trips = pd.read_parquet(f'{staging_dir}/trips.parquet', columns=['trip_id', 'service_id'])
+        service_of_trip = trips.set_index('trip_id')['service_id']
+
+        counts['stop_times'] = 0
+
+        def counted(batches):
+            for batch in batches:
+                counts['stop_times'] += batch.num_rows
+                yield batch
+
+        ds.write_dataset(
+            counted(_stop_times_batches(archive, members['stop_times'], service_of_trip, chunksize)),
+            f'{staging_dir}/stop_times',
+            schema=_stop_times_schema(),
+            format='parquet',
+            partitioning=ds.partitioning(pa.schema([('service_id', pa.string())]), flavor='hive'),
+            existing_data_behavior='overwrite_or_ignore'
+        )
+        print(f"Ingested stop_times: {counts['stop_times']} rows in {trips['service_id'].nunique()} service partitions.")
+
+    with open(f'{staging_dir}/{FEED_VERSION_FILE}', 'w') as f:
+        f.write(version)
+
+    # 3. SWAP IN
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.rename(staging_dir, store_dir)
+
+    # Tables, service days and isochrones cached from the previous feed are stale now,
+    # and so are its networks, unless this is the same zip again
+    preprocessing.load_gtfs.cache_clear()
+    service_calendar.get_service_index.cache_clear()
+    isochrone_cache.invalidate()
+    if version != previous_version:
+        dropped = drop_networks()
+        if dropped:
+            print(f"Dropped {len(dropped)} networks built from the previous feed.")
+
+    print(f"GTFS store '{store_dir}' complete in {time.perf_counter() - t0:.1f} s.")
+    return counts
+
+
+# ==========================
+# COMMAND LINE
+# ==========================
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python ingest.py path/to/google_transit.zip")
+        sys.exit(1)
+
+    ingest_gtfs(sys.argv[1])
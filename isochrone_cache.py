@@ -0,0 +1,199 @@
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+from collections import OrderedDict
+
+import graph_builder
+import memory
+import tracing
+
+# =============================
+# ISOCHRONE RESULT CACHE
+# =============================
+
+# Popular origins (downtown, the big stations) get clicked over and over, and every
+# click used to redo the same search and the same polygon. Results are cached in two
+# namespaces:
+#   'search'    best_times, keyed by the graph key, the snapped origin (reached first
+#               stops with walk times rounded to ROUND_WALK_MINS) and the budget,
+#               walk speed and max walk, so nearby clicks with the same first legs share it
+#   'geometry'  the exact polygon (as WKB), keyed by the best_times and settings it was
+#               drawn from
+#
+# The memory tier is an LRU of MAX_ENTRIES results, counted by memory.py. The disk tier
+# is optional (isochrone_cache.enable_disk(path) or TRANSIT_ISOCHRONE_CACHE_DIR) and
+# keeps one pickle per result, so results survive restarts and are shared between
+# processes. Search results are stored per graph key, and rebuilding a network
+# (preprocessing.save_network) drops that network's entries; a new feed
+# (ingest, preprocessing.process_stops) drops everything.
+
+MAX_ENTRIES = 256
+
+# Walk times to the first stops are rounded to this many minutes for the key
+ROUND_WALK_MINS = 0.25
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_sizes = {}
+_enabled = os.environ.get('TRANSIT_ISOCHRONE_CACHE') != '0'
+_disk_dir = None
+_stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+
+def set_enabled(enabled):
+    """Turns caching on or off (TRANSIT_ISOCHRONE_CACHE=0 starts with it off). Benchmarks turn it off."""
+    global _enabled
+    _enabled = enabled
+
+
+def enable_disk(path):
+    """Also keeps results under path (None: memory only)."""
+    global _disk_dir
+    _disk_dir = path
+
+
+# =============================
+# KEYS
+# =============================
+
+def _digest(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def search_key(G, first_legs, time_budget_mins, walk_speed_mps, max_walk_km):
+    """Key of an isochrone search, or None for graphs without a key (never cached)."""
+    graph_key = G.graph.get('key')
+    if graph_key is None:
+        return None
+
+    legs = sorted((str(stop_id), round(walk_time / ROUND_WALK_MINS)) for stop_id, walk_time in first_legs)
+    return ('search', graph_key, _digest(legs, float(time_budget_mins), float(walk_speed_mps), float(max_walk_km)))
+
+
+def geometry_key(best_times, time_budget_mins, walk_speed_mps, max_walk_km):
+    times = sorted((str(stop_id), round(minutes, 4)) for stop_id, minutes in best_times.items())
+    return ('geometry', None, _digest(times, float(time_budget_mins), float(walk_speed_mps), float(max_walk_km)))
+
+
+def _disk_path(key):
+    namespace, graph_key, digest = key
+    folder = graph_key if namespace == 'search' else 'geometry'
+    return f"{_disk_dir}/{folder}/{digest}.pkl"
+
+
+# =============================
+# LOOKUPS
+# =============================
+
+def get(key):
+    """(True, value) for a cached result, else (False, None). Disk hits are promoted to memory."""
+    if not _enabled:
+        return False, None
+
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            _stats['memory_hits'] += 1
+            tracing.current().set(cache='memory')
+            return True, _entries[key]
+
+    if _disk_dir is not None:
+        try:
+            with open(_disk_path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+        else:
+            with _lock:
+                _stats['disk_hits'] += 1
+            tracing.current().set(cache='disk')
+            _remember(key, value)
+            return True, value
+
+    with _lock:
+        _stats['misses'] += 1
+    tracing.current().set(cache='miss')
+    return False, None
+
+
+def put(key, value):
+    """Caches value (which must not be modified afterwards) under key."""
+    if not _enabled:
+        return
+    _remember(key, value)
+
+    if _disk_dir is not None:
+        path = _disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so other processes never read half a file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(temp_path, path)
+
+
+def _remember(key, value):
+    size = memory.deep_size(value)
+    with _lock:
+        _entries[key] = value
+        _entries.move_to_end(key)
+        _sizes[key] = size
+        while len(_entries) > MAX_ENTRIES:
+            old_key, _ = _entries.popitem(last=False)
+            _sizes.pop(old_key, None)
+        held = sum(_sizes.values())
+
+    # Outside the lock: the budget may clear this cache from another thread
+    memory.update('isochrone_cache', held)
+
+
+# =============================
+# INVALIDATION
+# =============================
+
+def invalidate(network_key=None):
+    """
+    Drops cached results: those of graphs built from network_key (a network file name
+    such as 'network_edges_1_skytrain_bridges'), or everything when it is None.
+    """
+    with _lock:
+        stale = [k for k in _entries if network_key is None or graph_builder.built_from(k[1], network_key)]
+        for key in stale:
+            del _entries[key]
+            _sizes.pop(key, None)
+        held = sum(_sizes.values())
+    memory.update('isochrone_cache', held)
+
+    if _disk_dir is not None and os.path.isdir(_disk_dir):
+        for folder in os.listdir(_disk_dir):
+            if network_key is None or (folder != 'geometry' and graph_builder.built_from(folder, network_key)):
+                shutil.rmtree(f"{_disk_dir}/{folder}", ignore_errors=True)
+
+
+def _clear_memory():
+    with _lock:
+        _entries.clear()
+        _sizes.clear()
+
+
+memory.register('isochrone_cache', _clear_memory)
+
+
+# =============================
+# METRICS
+# =============================
+
+def stats():
+    """{'memory_hits', 'disk_hits', 'misses', 'hit_rate', 'entries'} since the process started."""
+    with _lock:
+        counts = dict(_stats)
+        counts['entries'] = len(_entries)
+    lookups = counts['memory_hits'] + counts['disk_hits'] + counts['misses']
+    counts['hit_rate'] = (counts['memory_hits'] + counts['disk_hits']) / lookups if lookups else 0.0
+    return counts
+
+
+if os.environ.get('TRANSIT_ISOCHRONE_CACHE_DIR'):
+    enable_disk(os.environ['TRANSIT_ISOCHRONE_CACHE_DIR'])
@@ -0,0 +1,365 @@
+import functools
+import itertools
+import os
+import sys
+import threading
+import time
+import weakref
+from collections.abc import Mapping
+
+import numpy as np
+import shapely
+
+import tracing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# =============================
+# MEMORY BUDGET
+# =============================
+
+# Everything the modules cache (stops, shapes, the stop index, land geometry, walk
+# layers, footpaths, hub labels) and every graph that is built is accounted for here
+# as a named component:
+#
+#     @memory.component("shapes")
+#     @lru_cache(maxsize=None)
+#     def get_shapes(): ...
+#
+# Each component records an estimate of the bytes it holds and the growth in resident
+# memory (RSS) its loads caused: now, and at most since the process started.
+#
+# With a budget (memory.set_budget(mb) or TRANSIT_MEMORY_BUDGET_MB), the process runs
+# in low-memory mode: shapes are read from memory-mapped arrays instead of the pickle,
+# and whenever the components hold more than the budget, the least recently used
+# caches are dropped until they fit. They are reloaded on their next use. Graphs are
+# counted (only while a budget is set) but never dropped, since sessions and searches
+# own them.
+
+_lock = threading.RLock()
+_components = {}
+_budget_bytes = None
+
+# Containers bigger than this are sized from a sample of their items
+SAMPLE_ITEMS = 200
+
+
+def set_budget(mb):
+    """Caps the memory held by cached components at mb megabytes (None: no cap)."""
+    global _budget_bytes
+    _budget_bytes = None if mb is None else int(mb * 1e6)
+    enforce()
+
+
+def budget_mb():
+    return None if _budget_bytes is None else _budget_bytes / 1e6
+
+
+def low_memory():
+    """True when a budget is set, so loaders should prefer memory-mapped files."""
+    return _budget_bytes is not None
+
+
+# =============================
+# PROCESS MEMORY
+# =============================
+
+def current_rss():
+    """Resident memory of this process in bytes (0 where it can't be read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Highest resident memory of this process so far in bytes (0 where it can't be read)."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# =============================
+# SIZE ESTIMATES
+# =============================
+
+def deep_size(obj, _seen=None):
+    """
+    Estimated bytes held by obj and everything it references. NumPy arrays count
+    their buffer only if they own it (memory maps and views are free), tables count
+    their columns and geometry coordinates, and large containers are extrapolated
+    from a sample of their items.
+    """
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, (str, bytes, int, float, bool, np.generic, type(None))):
+        return sys.getsizeof(obj)
+
+    if isinstance(obj, np.ndarray):
+        size = sys.getsizeof(obj)
+        if obj.dtype == object:
+            size += _sampled(obj.ravel().tolist(), obj.size, seen)
+        return size
+
+    if isinstance(obj, shapely.Geometry):
+        return sys.getsizeof(obj) + 16 * int(shapely.get_num_coordinates(obj))
+
+    # pandas / geopandas tables and series
+    if hasattr(obj, 'memory_usage') and hasattr(obj, 'dtypes'):
+        size = int(np.sum(obj.memory_usage(index=True, deep=True)))
+        columns = [obj] if not hasattr(obj, 'columns') else [obj[c] for c in obj.columns]
+        for column in columns:
+            if str(column.dtype) == 'geometry':
+                size += 16 * int(shapely.get_num_coordinates(column.values).sum())
+        return size
+
+    # Memory-mapped stores size their own attributes, not the views they hand out
+    if _is_mapped(obj):
+        return sys.getsizeof(obj) + deep_size(vars(obj), seen)
+
+    if isinstance(obj, Mapping):
+        # Keys and values one by one: the (key, value) tuples are temporary, and a
+        # freed tuple's id comes back for the next one
+        pairs = itertools.chain.from_iterable(obj.items())
+        return sys.getsizeof(obj) + _sampled(pairs, 2 * len(obj), seen)
+
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + _sampled(obj, len(obj), seen)
+
+    size = sys.getsizeof(obj)
+    try:
+        # Plain objects and extension types (e.g. a BallTree) expose what they hold this way
+        state = obj.__getstate__()
+    except Exception:
+        return size
+    if state is not None and state is not obj:
+        size += deep_size(state, seen)
+    return size
+
+
+def _sampled(items, n, seen):
+    if n <= SAMPLE_ITEMS:
+        return sum(deep_size(item, seen) for item in items)
+
+    sample = 0
+    for i, item in enumerate(items):
+        if i == SAMPLE_ITEMS:
+            break
+        sample += deep_size(item, seen)
+    return int(sample * n / SAMPLE_ITEMS)
+
+
+# =============================
+# COMPONENTS
+# =============================
+
+_MISSING = object()
+
+
+class Component:
+    """Memory held by one cache (or, for graphs, one kind of object)."""
+
+    def __init__(self, name, clear=None):
+        self.name = name
+        self._clear = clear
+        self.held = 0
+        self.rss = 0
+        self.peak_rss = 0
+        self.loads = 0
+        self.evictions = 0
+        self.last_used = 0.0
+        self.mapped = False
+        self.value = _MISSING
+
+    @property
+    def evictable(self):
+        return self._clear is not None and self.held > 0
+
+    def loaded(self, obj, rss_before):
+        """Records a newly cached obj, loaded while RSS went from rss_before to now."""
+        size = deep_size(obj)
+        with _lock:
+            self.held += size
+            self.rss += max(0, current_rss() - rss_before)
+            self.peak_rss = max(self.peak_rss, self.rss)
+            self.loads += 1
+            self.mapped = self.mapped or _is_mapped(obj)
+        tracing.event('memory.load', component=self.name, held_mb=size / 1e6)
+
+    def clear(self):
+        """Drops the cached data (it is reloaded on next use)."""
+        with _lock:
+            if self._clear is None:
+                return
+            self._clear()
+            self.value = _MISSING
+            if self.held:
+                self.evictions += 1
+            self.held = 0
+            self.rss = 0
+            self.mapped = False
+
+
+def _is_mapped(obj):
+    return getattr(obj, 'mapped', False) is True
+
+
+def register(name, clear=None):
+    """The component called name, created with the callable that drops its cache."""
+    with _lock:
+        if name not in _components:
+            _components[name] = Component(name, clear)
+        elif clear is not None:
+            _components[name]._clear = clear
+        return _components[name]
+
+
+def component(name):
+    """
+    Decorator for a functools.lru_cache loader: accounts for each result it caches and
+    lets the budget drop the cache. cache_clear() and cache_info() still work.
+    """
+    def decorator(cached):
+        comp = register(name, cached.cache_clear)
+
+        @functools.wraps(cached)
+        def wrapper(*args, **kwargs):
+            comp.last_used = time.monotonic()
+            # Loaders without arguments sit on search paths, so their hits skip the bookkeeping
+            if not args and not kwargs and comp.value is not _MISSING:
+                return comp.value
+
+            misses = cached.cache_info().misses
+            rss_before = current_rss()
+            result = cached(*args, **kwargs)
+
+            if cached.cache_info().misses != misses:
+                comp.loaded(result, rss_before)
+                enforce(keep=name)
+            if not args and not kwargs:
+                comp.value = result
+            return result
+
+        wrapper.cache_clear = comp.clear
+        wrapper.cache_info = cached.cache_info
+        return wrapper
+    return decorator
+
+
+def account(name, obj):
+    """
+    Counts obj (e.g. a graph) towards component name for as long as it is alive.
+    Its size is never evicted, but it pushes caches out under a budget. Sizing obj
+    walks all of it, so without a budget nothing is counted.
+    """
+    if _budget_bytes is None:
+        return obj
+
+    comp = register(name)
+    size = deep_size(obj)
+    with _lock:
+        comp.held += size
+        comp.loads += 1
+        comp.last_used = time.monotonic()
+    weakref.finalize(obj, _release, comp, size)
+    enforce()
+    return obj
+
+
+def update(name, nbytes):
+    """Sets what component name holds, for caches that keep track of their own size."""
+    comp = register(name)
+    with _lock:
+        comp.held = nbytes
+        comp.last_used = time.monotonic()
+    enforce(keep=name)
+
+
+def _release(comp, size):
+    with _lock:
+        comp.held = max(0, comp.held - size)
+
+
+def held():
+    """Bytes held by all components."""
+    with _lock:
+        return sum(c.held for c in _components.values())
+
+
+def enforce(keep=None):
+    """Drops least recently used caches (never `keep`) until the components fit the budget."""
+    if _budget_bytes is None:
+        return
+
+    with _lock:
+        while held() > _budget_bytes:
+            candidates = [c for c in _components.values() if c.evictable and c.name != keep]
+            if not candidates:
+                break
+            victim = min(candidates, key=lambda c: c.last_used)
+            held_mb = victim.held / 1e6
+            victim.clear()
+            tracing.event('memory.evict', component=victim.name, held_mb=held_mb)
+
+
+def clear_all():
+    """Drops every cache registered here."""
+    with _lock:
+        for comp in _components.values():
+            comp.clear()
+
+
+# =============================
+# REPORTING
+# =============================
+
+def report():
+    """[{'component', 'held_mb', 'rss_mb', 'peak_rss_mb', 'loads', 'evictions', 'mapped'}] by component name."""
+    with _lock:
+        return [
+            {
+                'component': c.name,
+                'held_mb': c.held / 1e6,
+                'rss_mb': c.rss / 1e6,
+                'peak_rss_mb': c.peak_rss / 1e6,
+                'loads': c.loads,
+                'evictions': c.evictions,
+                'mapped': c.mapped
+            }
+            for c in sorted(_components.values(), key=lambda c: c.name)
+        ]
+
+
+def process():
+    """{'rss_mb', 'peak_rss_mb', 'held_mb', 'budget_mb'} for the whole process."""
+    return {
+        'rss_mb': current_rss() / 1e6,
+        'peak_rss_mb': peak_rss() / 1e6,
+        'held_mb': held() / 1e6,
+        'budget_mb': budget_mb()
+    }
+
+
+def print_report():
+    totals = process()
+    budget = f"{totals['budget_mb']:.0f} MB" if totals['budget_mb'] is not None else "none"
+    print(f"RSS {totals['rss_mb']:.1f} MB (peak {totals['peak_rss_mb']:.1f} MB), "
+          f"components hold {totals['held_mb']:.1f} MB, budget {budget}")
+    print(f"{'component':<20}{'held':>10}{'rss':>10}{'peak rss':>10}{'loads':>7}{'evicted':>9}")
+    for r in report():
+        mapped = "  (mapped)" if r['mapped'] else ""
+        print(f"{r['component']:<20}{r['held_mb']:>10.1f}{r['rss_mb']:>10.1f}{r['peak_rss_mb']:>10.1f}"
+              f"{r['loads']:>7}{r['evictions']:>9}{mapped}")
+
+
+if os.environ.get('TRANSIT_MEMORY_BUDGET_MB'):
+    set_budget(float(os.environ['TRANSIT_MEMORY_BUDGET_MB']))
@@ -1,9 +1,21 @@
 import pandas as pd
+import numpy as np
 import geopandas as gpd
 import shapely
 from shapely.geometry import LineString
+import glob
 import pickle
 import pprint
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import graph_builder
+import isochrone_cache
+import shared_graph
+import tracing
 
 
 # =======================
@@ -21,89 +33,225 @@ for f in data_files:
     data[file_name] = pd.read_csv(f)
 """
 
-trips = pd.read_csv('txt_data/trips.txt', dtype={'shape_id': str})
-stop_times = pd.read_csv('txt_data/stop_times.txt', dtype={'stop_id': str})
-stops = pd.read_csv('txt_data/stops.txt', dtype={'stop_id': str})
-routes = pd.read_csv('txt_data/routes.txt')
-transfers = pd.read_csv('txt_data/transfers.txt', dtype={'from_stop_id': str, 'to_stop_id': str})
-shapes = pd.read_csv('txt_data/shapes.txt', dtype={'shape_id': str})
+# IDs (and dates, and route numbers like "099") are kept as text in every table
+GTFS_STRING_COLUMNS = [
+    'agency_id', 'route_id', 'service_id', 'trip_id', 'shape_id', 'block_id', 'stop_id',
+    'parent_station', 'zone_id', 'from_stop_id', 'to_stop_id', 'from_route_id', 'to_route_id',
+    'from_trip_id', 'to_trip_id', 'route_short_name', 'date', 'start_date', 'end_date'
+]
+GTFS_DTYPES = {column: str for column in GTFS_STRING_COLUMNS}
+
+# Typed Parquet copy of the feed written by ingest.py; used instead of txt_data/ when present
+GTFS_STORE = 'gtfs_data'
+
+# Tables are read on first use by the step that needs them and kept for later calls,
+# so importing this module (e.g. from app.py) reads nothing.
+@lru_cache(maxsize=None)
+def load_gtfs(name):
+    """GTFS table {name} as a DataFrame, from the Parquet store or txt_data/{name}.txt."""
+    store_path = f'{GTFS_STORE}/{name}.parquet'
+    with tracing.span('gtfs.load', table=name) as span:
+        if os.path.exists(store_path):
+            table = pd.read_parquet(store_path)
+        else:
+            table = pd.read_csv(f'txt_data/{name}.txt', dtype=GTFS_DTYPES)
+        span.set(rows=len(table))
+    return table
+
+
+# stop_times is by far the largest table, so it isn't cached: it is streamed in chunks,
+# keeping only the columns process_network uses and only the trips it asks for.
+STOP_TIMES_COLUMNS = ['trip_id', 'arrival_time', 'stop_id', 'stop_sequence', 'shape_dist_traveled']
+STOP_TIMES_CHUNK_ROWS = 500_000
+
+
+def parse_gtfs_times(times):
+    """
+    'HH:MM:SS' strings to seconds after midnight as int32 (GTFS hours can pass 24).
+    Missing or malformed times become -1.
+    """
+    parts = times.str.extract(r'^\s*(\d+):(\d{2}):(\d{2})\s*$').astype(float)
+    seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return seconds.fillna(-1).astype(np.int32)
+
+
+@tracing.traced('gtfs.stop_times')
+def load_stop_times(service_ids=None, chunksize=STOP_TIMES_CHUNK_ROWS):
+    """
+    stop_times for the trips running on service_ids (all trips when None), with
+    trip_id/stop_id as categoricals, arrival_sec and stop_sequence as int32.
+    The file is read chunksize rows at a time and each chunk is filtered before the
+    next is read, so peak memory follows the selected service rather than the whole feed.
+    """
+    if os.path.isdir(f'{GTFS_STORE}/stop_times'):
+        return load_stored_stop_times(service_ids)
+
+    trips = load_gtfs('trips')
+    if service_ids is not None:
+        service_ids = {str(s) for s in service_ids}
+        wanted_trips = trips.loc[trips['service_id'].isin(service_ids), 'trip_id']
+    else:
+        wanted_trips = trips['trip_id']
+
+    # Fixed categories so every chunk shares one dtype and concatenates without copying strings
+    dtypes = {
+        'trip_id': pd.CategoricalDtype(wanted_trips.unique()),
+        'stop_id': pd.CategoricalDtype(load_gtfs('stops')['stop_id'].unique()),
+        'arrival_time': str,
+        'stop_sequence': np.int32,
+        'shape_dist_traveled': np.float64
+    }
+
+    reader = pd.read_csv(
+        'txt_data/stop_times.txt',
+        usecols=lambda column: column in STOP_TIMES_COLUMNS,
+        dtype=dtypes,
+        chunksize=chunksize
+    )
+
+    chunks = []
+    for chunk in reader:
+        # Trips outside wanted_trips fall outside the categories and read as NaN
+        chunk = chunk[chunk['trip_id'].notna()]
+        chunk['arrival_sec'] = parse_gtfs_times(chunk.pop('arrival_time'))
+        chunks.append(chunk)
+
+    if not chunks:
+        columns = {column: dtype for column, dtype in dtypes.items() if column != 'arrival_time'}
+        columns['arrival_sec'] = np.int32
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in columns.items()})
+
+    stop_times = pd.concat(chunks, ignore_index=True)
+    tracing.current().set(rows=len(stop_times))
+    return stop_times
+
+
+def load_stored_stop_times(service_ids=None):
+    """
+    Same as load_stop_times, from the Parquet store. stop_times there is partitioned
+    by service_id, so only the partitions for service_ids are opened at all.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(
+        f'{GTFS_STORE}/stop_times',
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('service_id', pa.string())]), flavor='hive')
+    )
+
+    columns = ['trip_id', 'stop_id', 'stop_sequence', 'shape_dist_traveled', 'arrival_sec']
+    service_filter = None
+    if service_ids is not None:
+        service_filter = ds.field('service_id').isin([str(s) for s in service_ids])
+
+    table = dataset.to_table(columns=columns, filter=service_filter)
+    tracing.current().set(rows=table.num_rows, store=True)
+    return table.to_pandas(strings_to_categorical=True)
 
 # =========================
 # NETWORK EDGES FILE
 # =========================
 
-# Choose service day
+# Infrastructure toggle combinations, in the dashboard's checkbox order so file names match
+TOGGLE_SETS = [("skytrain", "bridges"), ("skytrain",), ("bridges",), ()]
 
-def process_network(day_id=1, toggles=("bridges", "skytrain")):
 
-    target_service_id = str(day_id)
-    trips['service_id'] = trips['service_id'].astype(str)
+def ordered_toggles(toggles):
+    """toggles in TOGGLE_SETS order, so the same set always names the same files."""
+    order = TOGGLE_SETS[0]
+    return tuple(sorted(set(toggles), key=lambda t: (order.index(t) if t in order else len(order), t)))
 
-    # Filter trips by day
-    active_trips = trips[trips['service_id'] == target_service_id]
-    active_stop_times = stop_times[stop_times['trip_id'].isin(active_trips['trip_id'])]
 
-    print(f"DEBUG: Processing Day {target_service_id}. Found {len(active_trips)} trips.")
+def network_path(day_id, toggles):
+    return f'data/network_edges_{day_id}_{"_".join(ordered_toggles(toggles))}.pkl'
 
-    # Sort values in trip order
-    active_stop_times = active_stop_times.sort_values(['trip_id', 'stop_sequence'])
 
-    # Convert time to seconds
-    def parse_time(t):
-        try:
-            h, m, s = map(int, t.split(':'))
-            return h * 3600 + m * 60 + s
-        except:
-            return None
-        
-    active_stop_times['arrival_sec'] = active_stop_times['arrival_time'].apply(parse_time)
+def build_segments(stop_times):
+    """
+    Consecutive-stop segments of every trip in stop_times, found in one sort and one
+    shift over the whole frame. A trip runs on a single service day, so segments for
+    several days can be derived together and split by service_id afterwards.
+    """
+    trips = load_gtfs('trips')
+    routes = load_gtfs('routes')
 
-    active_stop_times['shape_dist_traveled'] = active_stop_times['shape_dist_traveled'].fillna(0)
+    # Sort values in trip order, skipping stops without a usable arrival time
+    stop_times = stop_times[stop_times['arrival_sec'] >= 0]
+    stop_times = stop_times.sort_values(['trip_id', 'stop_sequence'])
+
+    stop_times['shape_dist_traveled'] = stop_times['shape_dist_traveled'].fillna(0)
 
     # Create next stop columns and filter by rows where trip_id doesn't change
-    active_stop_times['next_stop_id'] = active_stop_times['stop_id'].shift(-1).fillna(0)
-    active_stop_times['next_arrival_sec'] = active_stop_times['arrival_sec'].shift(-1).fillna(0)
-    active_stop_times['next_trip_id'] = active_stop_times['trip_id'].shift(-1).fillna(0)
-    active_stop_times['next_shape_dist_traveled'] = active_stop_times['shape_dist_traveled'].shift(-1)
+    stop_times['next_stop_id'] = stop_times['stop_id'].shift(-1)
+    stop_times['next_arrival_sec'] = stop_times['arrival_sec'].shift(-1).fillna(0)
+    stop_times['next_trip_id'] = stop_times['trip_id'].shift(-1)
+    stop_times['next_shape_dist_traveled'] = stop_times['shape_dist_traveled'].shift(-1)
 
     # duration column
-    edges = active_stop_times[active_stop_times['trip_id'] == active_stop_times['next_trip_id']].copy()
+    edges = stop_times[stop_times['trip_id'] == stop_times['next_trip_id']].copy()
     edges['duration'] = edges['next_arrival_sec'] - edges['arrival_sec']
 
-    # Adds route name columns
-    routes['route_name'] = routes['route_short_name'].fillna("Skytrain") + " " + routes['route_long_name']
-    routes['route_name'] = routes['route_name'].str.replace("Skytrain SeaBus", "SeaBus")
-    edges = edges.merge(trips[['route_id', 'trip_id', 'shape_id']], on='trip_id', how='left')
-    edges = edges.merge(routes[['route_id', 'route_name']], on='route_id', how='left')
+    # Adds route name columns (routes is the cached table, so it is left as loaded)
+    route_name = routes['route_short_name'].fillna("Skytrain") + " " + routes['route_long_name']
+    route_name = route_name.str.replace("Skytrain SeaBus", "SeaBus")
+    edges = edges.merge(trips[['route_id', 'trip_id', 'shape_id', 'service_id']], on='trip_id', how='left')
+    edges = edges.merge(routes[['route_id']].assign(route_name=route_name), on='route_id', how='left')
 
     # Cleans data outputs edge.txt for sanity check 
-    cols_to_remove = ['arrival_time', 'departure_time', 'stop_headsign', 'pickup_type', 'drop_off_type', 'timepoint', 'next_arrival_sec', 'next_trip_id', 'route_id']
-    edges.drop(columns=cols_to_remove, inplace=True)
-    edges = edges[['route_name', 'trip_id', 'stop_id', 'next_stop_id', 'stop_sequence', 'arrival_sec', 'duration', 'shape_id', 'shape_dist_traveled', 'next_shape_dist_traveled']]
+    edges = edges[['route_name', 'trip_id', 'service_id', 'stop_id', 'next_stop_id', 'stop_sequence', 'arrival_sec', 'duration', 'shape_id', 'shape_dist_traveled', 'next_shape_dist_traveled']]
     edges = edges.sort_values(['route_name', 'trip_id', 'stop_sequence'])
     # edges.to_csv('data/edges.csv', index=False)
     # routes.to_csv('data/routes.txt', index=False)
 
+    return edges
+
+
+def bridge_free(edges):
+    """
+    True for segments whose straight stop-to-stop line misses every bridge in bridges.geojson.
+    Segments with an unknown stop are False (they can't be checked). Each distinct stop
+    pair is tested once, however many trips run over it.
+    """
+    stops = load_gtfs('stops')
+    coords = stops.drop_duplicates('stop_id').set_index('stop_id')[['stop_lon', 'stop_lat']]
+
+    pairs = edges[['stop_id', 'next_stop_id']].astype(str).drop_duplicates()
+    pairs = pairs.join(coords.rename(columns={'stop_lon': 'x1', 'stop_lat': 'y1'}), on='stop_id')
+    pairs = pairs.join(coords.rename(columns={'stop_lon': 'x2', 'stop_lat': 'y2'}), on='next_stop_id')
+    pairs = pairs.dropna(subset=['x1', 'y1', 'x2', 'y2'])
+
+    geoms = [LineString([(x1, y1), (x2, y2)])
+        for x1, y1, x2, y2 in zip(pairs['x1'], pairs['y1'], pairs['x2'], pairs['y2'])]
+
+    pairs_gdf = gpd.GeoDataFrame(pairs[['stop_id', 'next_stop_id']], geometry=geoms, crs="EPSG:4326")
+    bridges_gdf = gpd.read_file("data/bridges.geojson")
+    idx_to_remove = gpd.sjoin(pairs_gdf, bridges_gdf, how='inner', predicate='intersects').index
+    pairs_gdf = pairs_gdf.drop(index=idx_to_remove.unique())
+
+    free = pd.MultiIndex.from_frame(pairs_gdf[['stop_id', 'next_stop_id']])
+    keys = pd.MultiIndex.from_arrays([edges['stop_id'].astype(str), edges['next_stop_id'].astype(str)])
+    return pd.Series(keys.isin(free), index=edges.index)
+
+
+def apply_toggles(edges, toggles):
+    """Drops the segments removed by the infrastructure toggles that are switched off."""
+
     # Infrastructure toggles: Bridges
     if "bridges" not in toggles:
-        edges = edges.merge(stops[['stop_id', 'stop_lon', 'stop_lat']], on='stop_id', how='left').rename(columns={'stop_lon': 'x1', 'stop_lat': 'y1'})
-        edges = edges.merge(stops[['stop_id', 'stop_lon', 'stop_lat']], left_on='next_stop_id', right_on='stop_id', how='left', suffixes=('', '_drop')).rename(columns={'stop_lon': 'x2', 'stop_lat': 'y2'})
-        edges = edges.dropna(subset=['x1', 'y1', 'x2', 'y2'])
-
-        geoms = [LineString([(x1, y1), (x2, y2)])
-            for x1, y1, x2, y2 in zip(edges['x1'], edges['y1'], edges['x2'], edges['y2'])]
-        
-        edges_gdf = gpd.GeoDataFrame(edges, geometry = geoms, crs="EPSG:4326")
-        bridges_gdf = gpd.read_file("data/bridges.geojson")
-        idx_to_remove = gpd.sjoin(edges_gdf, bridges_gdf, how='inner', predicate='intersects').index
-        edges_gdf = edges_gdf.drop(index=idx_to_remove).drop(columns=['geometry', 'x1', 'y1', 'x2', 'y2', 'stop_id_drop'])
-        edges = pd.DataFrame(edges_gdf)
+        keep = edges['bridge_free'] if 'bridge_free' in edges else bridge_free(edges)
+        edges = edges[keep]
 
     # Infrastructure toggles: Skytrain
     if "skytrain" not in toggles:
         idx_to_remove = edges[edges['route_name'].str.contains('skytrain', case=False, na=False)].index
         edges = edges.drop(index = idx_to_remove)
 
+    return edges
+
+
+def save_network(edges, path):
+
     # create dictionary with
     # key: ('Stop_A', 'Stop_B', 'Route_Name')x
     # value: {'dept': 28800, 'dur': 300}
@@ -140,40 +288,131 @@ def process_network(day_id=1, toggles=("bridges", "skytrain")):
 
     print(f"Network dictionary complete. Created {len(network_edges)} unique route segments. Saving...")
 
-    # save to pickle file
-    path = f'data/network_edges_{day_id}_{"_".join(toggles)}.pkl'
-    with open(path, 'wb') as f:
+    # save to pickle file, swapped in whole so a process loading it never sees half a file
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
         pickle.dump(dict(network_edges), f)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    # Isochrones cached for the old version of this network are stale now, and so are
+    # graphs other processes published from it
+    network_key = os.path.splitext(os.path.basename(path))[0]
+    isochrone_cache.invalidate(network_key)
+    shared_graph.retire(network_key)
+    drop_built_from(network_key)
 
     return path
 
+
+def drop_built_from(network_key=None, data_dir='data'):
+    """
+    Deletes the hub labels and atlases computed from the network file network_key, or
+    from every network when it is None. Called whenever a file they were computed from
+    is rewritten.
+    """
+    import atlas
+
+    for path in glob.glob(f'{data_dir}/hub_labels_*.pkl'):
+        # Label files are 'hub_labels_{graph key}_{walk speed}.pkl' (see hub_labels.labels_path)
+        graph_key = os.path.basename(path)[len('hub_labels_'):]
+        if network_key is None or graph_builder.built_from(graph_key, network_key):
+            os.remove(path)
+
+    # Atlas folders are '{graph key}_{walk speed}_{max walk}' (see atlas.atlas_path)
+    if os.path.isdir(atlas.ATLAS_DIR):
+        for folder in os.listdir(atlas.ATLAS_DIR):
+            if network_key is None or graph_builder.built_from(folder, network_key):
+                shutil.rmtree(f'{atlas.ATLAS_DIR}/{folder}', ignore_errors=True)
+
+
+# Choose service day
+
+@tracing.traced('network.build')
+def process_network(day_id=1, toggles=TOGGLE_SETS[0], service_ids=None):
+    """
+    Builds and saves the network for one service day. day_id names the file and,
+    unless service_ids is given, is also the service_id to select.
+    """
+    trips = load_gtfs('trips')
+    if service_ids is None:
+        service_ids = {str(day_id)}
+
+    # Filter trips by day (stop_times is filtered while it is read)
+    active_trips = trips[trips['service_id'].isin(service_ids)]
+    edges = build_segments(load_stop_times(service_ids))
+
+    edges = apply_toggles(edges, toggles)
+    tracing.current().set(day=str(day_id), toggles=list(toggles), trips=len(active_trips), segments=len(edges))
+    return save_network(edges, network_path(day_id, toggles))
+
+
+def _save_network_job(job):
+    edges, path = job
+    return save_network(edges, path)
+
+
+def process_all_networks(service_sets=None, toggle_sets=TOGGLE_SETS, workers=None):
+    """
+    Rebuilds the network file for every set of services and toggle combination.
+    service_sets is {name: service_ids}; by default, every distinct set of services that
+    runs together on some date of the feed's calendar (see service_calendar), or each
+    service_id on its own for a feed without one.
+    stop_times is read, sorted and turned into segments once for all of them (and bridge
+    crossings tested once for all segments); only the per-file dictionary building and
+    saving is repeated, spread over a process pool.
+    Returns the saved paths.
+    """
+    import service_calendar
+
+    t0 = time.perf_counter()
+
+    if service_sets is None:
+        service_sets = service_calendar.distinct_service_sets()
+    if not service_sets:
+        trips = load_gtfs('trips')
+        service_sets = {s: {s} for s in sorted(trips['service_id'].dropna().unique())}
+
+    all_services = set().union(*service_sets.values())
+    edges = build_segments(load_stop_times(all_services))
+    if any("bridges" not in toggles for toggles in toggle_sets):
+        edges['bridge_free'] = bridge_free(edges)
+
+    print(f"Segments for {len(service_sets)} service sets built in {time.perf_counter() - t0:.1f} s.")
+
+    jobs = []
+    for day_id, service_ids in service_sets.items():
+        day_edges = edges[edges['service_id'].isin(service_ids)]
+        for toggles in toggle_sets:
+            jobs.append((apply_toggles(day_edges, toggles), network_path(day_id, toggles)))
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        paths = [_save_network_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            paths = list(pool.map(_save_network_job, jobs))
+
+    print(f"Built {len(paths)} networks in {time.perf_counter() - t0:.1f} s.")
+    return paths
+
 # ============================
 #  TRANSFER EDGES FILE
 # ============================
 
 def process_transfers():
 
-    transfers['min_transfer_time'] //= 2
-    # transfers.to_csv('data/transfers_reduced_time.txt')
-
-    transfer_edges = {}
-
-    iterator = zip(
-        transfers['from_stop_id'],
-        transfers['to_stop_id'],
-        transfers['min_transfer_time']
-    )
-
-    for u, v, time in iterator:
-        key = (u, v, "transfer")
+    # Transfer times are halved, and duplicate pairs keep their fastest time.
+    # Works on a copy so repeated calls give the same result.
+    transfers = load_gtfs('transfers')
+    transfer_times = transfers[['from_stop_id', 'to_stop_id', 'min_transfer_time']].copy()
+    transfer_times['min_transfer_time'] = transfer_times['min_transfer_time'].fillna(0) // 2
+    # transfer_times.to_csv('data/transfers_reduced_time.txt')
 
-        if pd.isna(time):
-            time = 0
+    transfer_times = transfer_times.groupby(['from_stop_id', 'to_stop_id'])['min_transfer_time'].min()
 
-        if key in transfer_edges:
-            transfer_edges[key] = min(transfer_edges[key], time)
-        else:
-            transfer_edges[key] = time
+    transfer_edges = {
+        (u, v, "transfer"): time
+        for (u, v), time in transfer_times.items()
+    }
 
     print(f"Transfer dictionary complete. Created {len(transfer_edges)} unique transfer segments. Saving...")
 
@@ -182,26 +421,177 @@ def process_transfers():
 
     return 'data/transfer_edges.pkl'
 
+# ============================
+#  FOOTPATHS FILE
+# ============================
+
+# Stops closer than this are joined by a generated walking edge
+FOOTPATH_RADIUS_M = 250
+
+def process_footpaths(radius_m=FOOTPATH_RADIUS_M):
+    """
+    Generates stop-to-stop walking edges for every pair of stops within radius_m,
+    from one batch neighbour query over all stops. Pairs already in transfer_edges.pkl
+    are skipped. Saved as CSR arrays (row = from stop, distance in metres) so
+    walk times can be worked out per walk speed at query time.
+    """
+    from sklearn.neighbors import BallTree
+
+    stops = load_gtfs('stops')
+    stop_ids = stops['stop_id'].to_numpy(dtype=str)
+    stops_rad = np.deg2rad(stops[['stop_lat', 'stop_lon']].to_numpy())
+
+    tree = BallTree(stops_rad, metric='haversine')
+    indices, distances = tree.query_radius(stops_rad, r=radius_m / 6371000, return_distance=True)
+
+    # Flatten neighbour lists into (from, to, metres)
+    counts = np.fromiter((len(i) for i in indices), dtype=np.int64, count=len(indices))
+    from_idx = np.repeat(np.arange(len(stop_ids)), counts)
+    to_idx = np.concatenate(indices).astype(np.int64)
+    dist_m = np.concatenate(distances) * 6371000
+
+    # Drop self loops and pairs covered by transfers.txt
+    with open('data/transfer_edges.pkl', 'rb') as f:
+        transfer_edges = pickle.load(f)
+
+    stop_index = pd.Index(stop_ids)
+    t_from = stop_index.get_indexer([u for u, v, tag in transfer_edges])
+    t_to = stop_index.get_indexer([v for u, v, tag in transfer_edges])
+    known = (t_from >= 0) & (t_to >= 0)
+    transfer_codes = t_from[known] * len(stop_ids) + t_to[known]
+
+    keep = (from_idx != to_idx) & ~np.isin(from_idx * len(stop_ids) + to_idx, transfer_codes)
+    from_idx, to_idx, dist_m = from_idx[keep], to_idx[keep], dist_m[keep]
+
+    # Compress rows
+    order = np.lexsort((to_idx, from_idx))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(from_idx, minlength=len(stop_ids)))])
+
+    print(f"Footpaths complete. Created {len(order)} walking edges within {radius_m} m. Saving...")
+
+    np.savez_compressed(
+        'data/footpaths.npz',
+        stop_ids=stop_ids,
+        indptr=indptr.astype(np.int32),
+        indices=to_idx[order].astype(np.int32),
+        dist_m=dist_m[order].astype(np.float32)
+    )
+
+    # Every graph walks the footpaths, so labels and atlases computed with the old ones are stale
+    drop_built_from()
+
+    return 'data/footpaths.npz'
+
+# ============================
+#  STOP CLUSTERS FILE (optional)
+# ============================
+
+# Stops closer than this (bays at one exchange, opposite sides of a street) share a node
+CLUSTER_RADIUS_M = 20
+
+def process_clusters(radius_m=CLUSTER_RADIUS_M):
+    """
+    Groups stops into station nodes. Stops with a parent_station join their parent;
+    the rest are linked when within radius_m of each other, found through a spatial
+    grid with cells radius_m wide. Each cluster is named after its parent station, or
+    otherwise its smallest stop ID, so cluster IDs are still valid keys in stops.pkl.
+    Saves {stop_id: cluster_id} for graph_builder to use.
+    """
+    stops = load_gtfs('stops')
+    stop_ids = stops['stop_id'].astype(str).tolist()
+    parent = list(range(len(stop_ids)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    if 'parent_station' in stops.columns:
+        parent_station = stops['parent_station'].fillna('').astype(str).str.strip()
+    else:
+        parent_station = pd.Series('', index=stops.index)
+
+    if 'location_type' in stops.columns:
+        is_platform = stops['location_type'].fillna(0).astype(int) == 0
+    else:
+        is_platform = pd.Series(True, index=stops.index)
+
+    # 1. Stops sharing a parent station (and the station entry itself)
+    stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+    for i in np.flatnonzero((parent_station != '').to_numpy()):
+        station_id = parent_station.iloc[i]
+        union(stop_index.setdefault(station_id, i), i)
+
+    # 2. Everything else: neighbours within radius_m, searched through a grid
+    lat0 = np.deg2rad(stops['stop_lat'].mean())
+    x = stops['stop_lon'].to_numpy() * np.cos(lat0) * 111320
+    y = stops['stop_lat'].to_numpy() * 110540
+    cell_x = np.floor(x / radius_m).astype(np.int64)
+    cell_y = np.floor(y / radius_m).astype(np.int64)
+
+    grid = {}
+    for i in np.flatnonzero(((parent_station == '') & is_platform).to_numpy()):
+        grid.setdefault((cell_x[i], cell_y[i]), []).append(i)
+
+    for (cx, cy), members in grid.items():
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in grid.get((cx + dx, cy + dy), ()):
+                    for i in members:
+                        if i < j and (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 <= radius_m ** 2:
+                            union(i, j)
+
+    # Name clusters
+    components = {}
+    for i in range(len(stop_ids)):
+        components.setdefault(find(i), []).append(i)
+
+    stop_clusters = {}
+    for members in components.values():
+        stations = {parent_station.iloc[i] for i in members} - {''}
+        cluster_id = min(stations) if stations else min(stop_ids[i] for i in members)
+        for i in members:
+            stop_clusters[stop_ids[i]] = cluster_id
+
+    print(f"Stop clusters complete. Merged {len(stop_clusters)} stops into {len(set(stop_clusters.values()))} station nodes. Saving...")
+
+    with open('data/stop_clusters.pkl', 'wb') as f:
+        pickle.dump(stop_clusters, f)
+
+    return 'data/stop_clusters.pkl'
+
 # ====================
 # STOPS FILE
 # ====================
 
 def process_stops():
+    stops = load_gtfs('stops')
     stops_dict = {}
 
+    # Land component each stop sits on, for island filtering in analysis.get_isochrone
+    land_ids = assign_land_components()
+
     iterator = zip(
         stops['stop_id'],
         stops['stop_name'],
         stops['stop_lat'],
-        stops['stop_lon']
+        stops['stop_lon'],
+        land_ids
     )
 
-    for id, name, lat, lon in iterator:
+    for id, name, lat, lon, land_id in iterator:
         key = id
         value = {
             "lat": lat,
             "lon": lon,
-            "name": name
+            "name": name,
+            "land_id": land_id
         }
 
         stops_dict[key] = value
@@ -211,20 +601,82 @@ def process_stops():
     with open('data/stops.pkl', 'wb') as f:
         pickle.dump(stops_dict, f)
 
+    # The same stops as flat arrays, memory-mapped by analysis.MappedStops
+    id_len = max(len(str(stop_id)) for stop_id in stops_dict)
+    name_len = max(len(str(s['name'])) for s in stops_dict.values())
+    stops_table = np.array(
+        [(stop_id, s['name'], s['lat'], s['lon'], -1 if s['land_id'] is None else s['land_id'])
+         for stop_id, s in stops_dict.items()],
+        dtype=[('stop_id', f'U{id_len}'), ('name', f'U{name_len}'), ('lat', 'f8'), ('lon', 'f8'), ('land_id', 'i8')]
+    )
+    np.save('data/stops_table.npy', stops_table)
+
+    # Cached isochrones were drawn around the previous stops
+    isochrone_cache.invalidate()
+
     return 'data/stops.pkl'
 
 
+# ======================
+# LAND COMPONENTS FILE
+# ======================
+
+# Stops on a pier or a float just off the coastline still count as on the nearest land
+LAND_SNAP_M = 100
+
+def process_land_components():
+    """
+    Explodes the land polygon into its separate pieces (mainland, islands),
+    numbers them and saves them in BC Albers, with a spatial index, for analysis to clip against.
+    """
+    land = gpd.read_file("data/metro_vancouver_land_poly.geojson").to_crs("EPSG:3005")
+    components = land[['geometry']].explode(index_parts=False).reset_index(drop=True)
+    components['land_id'] = components.index.astype(int)
+    components.sindex
+
+    print(f"Land components complete. Found {len(components)} separate land pieces. Saving...")
+
+    with open('data/land_components.pkl', 'wb') as f:
+        pickle.dump(components, f)
+
+    return 'data/land_components.pkl'
+
+
+def assign_land_components():
+    """land_id of the land piece under every stop (None when off the coast)."""
+    stops = load_gtfs('stops')
+
+    try:
+        with open('data/land_components.pkl', 'rb') as f:
+            components = pickle.load(f)
+    except FileNotFoundError:
+        with open(process_land_components(), 'rb') as f:
+            components = pickle.load(f)
+
+    stop_points = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy(stops['stop_lon'], stops['stop_lat']),
+        crs="EPSG:4326"
+    ).to_crs("EPSG:3005")
+
+    hits = gpd.sjoin_nearest(stop_points, components, how='left', max_distance=LAND_SNAP_M)
+    hits = hits[~hits.index.duplicated(keep='first')]
+
+    return [None if pd.isna(land_id) else int(land_id) for land_id in hits['land_id']]
+
+
 # ======================
 # SHAPES FILE
 # ======================
 
 def process_shapes():
 
-    global shapes    
+    shapes = load_gtfs('shapes').copy()
     shapes['shape_dist_traveled'] = pd.to_numeric(shapes['shape_dist_traveled'], errors='coerce')
     shapes = shapes.sort_values(['shape_id', 'shape_dist_traveled'])
     
     shape_db = {}
+    shape_index = {}
+    start = 0
     
     for sh_id, group in shapes.groupby('shape_id'):
         
@@ -237,10 +689,18 @@ def process_shapes():
             'distances': dists, 
             'coords': coords
         }
+        shape_index[str(sh_id)] = (start, start + len(group))
+        start += len(group)
         
     print(f"Shape DB built with ({len(shape_db)} shapes). Saving...")
     with open('data/shapes.pkl', 'wb') as f:
         pickle.dump(shape_db, f)
+
+    # The same points as one flat array, which low-memory mode memory-maps (see analysis.MappedShapes)
+    points = shapes[['shape_dist_traveled', 'shape_pt_lon', 'shape_pt_lat']].to_numpy(dtype=np.float64)
+    np.save('data/shapes_points.npy', points)
+    with open('data/shapes_index.pkl', 'wb') as f:
+        pickle.dump(shape_index, f)
     
     return 'data/shapes.pkl'
 
@@ -310,11 +770,14 @@ def str_check():
         print(f"Transfer Nodes: {type(first_key[0])} (Should be str)")
 
 if __name__ == "__main__":
-    # process_network()
+    process_all_networks()
+    process_land_components()
     process_stops()
     process_transfers()
+    process_footpaths()
+    # process_clusters()  # optional: merge stops within a few metres into station nodes
     process_shapes()
-    check_pickle("data/network_edges.pkl")
+    check_pickle(network_path(1, TOGGLE_SETS[0]))
     check_pickle("data/transfer_edges.pkl")
     check_pickle("data/stops.pkl")
     check_pickle("data/shapes.pkl")
\ No newline at end of file
@@ -0,0 +1,344 @@
+import pandas as pd
+import geopandas as gpd
+import os
+from heapq import heappush, heappop
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor
+from shapely.geometry import LineString
+
+import analysis
+import graph_builder
+
+# =============================
+# CLOSURE CANDIDATES
+# =============================
+
+# A closure is a dict:
+# {'kind': 'bridge' | 'route' | 'segment', 'name': str, 'edges': frozenset({(u, v), ...})}
+# where the edges are graph edges that disappear when the closure is applied.
+
+def bridge_closures(G, bridges_path="data/bridges.geojson"):
+    """
+    One closure per bridge polygon: every travel edge whose straight stop-to-stop
+    line crosses it (same test as the bridges toggle in preprocessing.process_network).
+    """
+    rows = []
+    stops = analysis.get_stops()
+
+    for u, v, edge_data in G.edges(data=True):
+        if edge_data.get('type') != 'travel':
+            continue
+
+        stop_u = stops.get(str(u).split('_')[0])
+        stop_v = stops.get(str(v).split('_')[0])
+        if stop_u is None or stop_v is None:
+            continue
+
+        rows.append({
+            'u': u,
+            'v': v,
+            'geometry': LineString([(stop_u['lon'], stop_u['lat']), (stop_v['lon'], stop_v['lat'])])
+        })
+
+    if not rows:
+        return []
+
+    edges_gdf = gpd.GeoDataFrame(rows, crs="EPSG:4326")
+    bridges_gdf = gpd.read_file(bridges_path).to_crs("EPSG:4326")
+    hits = gpd.sjoin(edges_gdf, bridges_gdf, how='inner', predicate='intersects')
+
+    closures = []
+    for bridge_idx, group in hits.groupby('index_right'):
+        bridge_name = f"Bridge {bridges_gdf.loc[bridge_idx].get('fid', bridge_idx)}"
+        closures.append({
+            'kind': 'bridge',
+            'name': bridge_name,
+            'edges': frozenset(zip(group['u'], group['v']))
+        })
+
+    return closures
+
+
+def route_closures(G):
+    """
+    One closure per route: all of its boarding and travel edges.
+    """
+    route_edges = {}
+
+    for u, v, edge_data in G.edges(data=True):
+        if edge_data.get('type') not in ('board', 'travel'):
+            continue
+        route_edges.setdefault(edge_data['route_id'], set()).add((u, v))
+
+    return [
+        {'kind': 'route', 'name': route_id, 'edges': frozenset(edges)}
+        for route_id, edges in route_edges.items()
+    ]
+
+
+def segment_closures(G, dist, pred, top_n=20):
+    """
+    The top_n travel edges carrying the most physical stops in the baseline search tree.
+    Usage = number of reached stops whose best path rides over the segment.
+    dist and pred are as search_tree returns them, with dist in settle order.
+    """
+    stops = analysis.get_stops()
+    usage = {n: (1 if n in stops else 0) for n in dist}
+
+    # Push counts up the tree in reverse settle order (dist is filled as nodes settle), so
+    # children always come before their parents, even across 0-minute deboard edges
+    for node in reversed(list(dist)):
+        parent = pred[node]
+        if parent is not None:
+            usage[parent] += usage[node]
+
+    segments = [
+        (usage[v], u, v) for v, u in pred.items()
+        if u is not None and (graph_builder.get_edge(G, u, v) or {}).get('type') == 'travel'
+    ]
+    segments.sort(key=lambda s: s[0], reverse=True)
+
+    closures = []
+    for used_by, u, v in segments[:top_n]:
+        route_id = G.edges[u, v]['route_id']
+        stop_u = str(u).split('_')[0]
+        stop_v = str(v).split('_')[0]
+        name_u = stops.get(stop_u, {}).get('name', stop_u)
+        name_v = stops.get(stop_v, {}).get('name', stop_v)
+        closures.append({
+            'kind': 'segment',
+            'name': f"{route_id}: {name_u} -> {name_v}",
+            'edges': frozenset({(u, v)})
+        })
+
+    return closures
+
+
+# =============================
+# INCREMENTAL SHORTEST PATHS
+# =============================
+
+def children_of(pred):
+    """Inverts the predecessor map into {node: [children]}."""
+    children = {}
+    for node, parent in pred.items():
+        if parent is not None:
+            children.setdefault(parent, []).append(node)
+    return children
+
+
+def repair_tree(G, dist, pred, children, first_legs, removed_edges, time_budget_mins, walk_speed_mps=None):
+    """
+    Dynamic Dijkstra for edge deletions.
+    Only nodes below a removed tree edge can change, and they can only get worse, so
+    the search is reseeded from their unaffected in-neighbours and kept inside that subtree.
+    Returns (affected, new_dist) where new_dist holds the repaired times of affected nodes
+    (an affected node missing from new_dist is no longer reachable within the budget).
+    """
+    roots = [v for (u, v) in removed_edges if v in pred and pred[v] == u]
+    if not roots:
+        return set(), {}
+
+    # Collect the subtree hanging off the removed tree edges
+    affected = set()
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if node in affected:
+            continue
+        affected.add(node)
+        stack.extend(children.get(node, ()))
+
+    walk_times = {}
+    for stop_id, walk_time in first_legs:
+        if walk_time < time_budget_mins:
+            walk_times[stop_id] = min(walk_time, walk_times.get(stop_id, float('inf')))
+
+    # Seed every affected node from the settled part of the tree
+    best = {}
+    heap = []
+    tie = count()
+    for node in affected:
+        seed = walk_times.get(node, float('inf'))
+
+        for p, weight in graph_builder.out_edges(G, node, walk_speed_mps, direction='pred'):
+            if p in affected or p not in dist or (p, node) in removed_edges:
+                continue
+            seed = min(seed, dist[p] + weight)
+
+        if seed <= time_budget_mins:
+            best[node] = seed
+            heappush(heap, (seed, next(tie), node))
+
+    # Dijkstra restricted to the affected subtree
+    new_dist = {}
+    while heap:
+        d, _, u = heappop(heap)
+        if u in new_dist:
+            continue
+        new_dist[u] = d
+
+        for v, weight in graph_builder.out_edges(G, u, walk_speed_mps):
+            if v not in affected or v in new_dist or (u, v) in removed_edges:
+                continue
+
+            vd = d + weight
+            if vd <= time_budget_mins and vd < best.get(v, float('inf')):
+                best[v] = vd
+                heappush(heap, (vd, next(tie), v))
+
+    return affected, new_dist
+
+
+# =============================
+# SWEEP
+# =============================
+
+# Worker state, set once per process so the graph is not resent with every closure
+_SWEEP = {}
+
+
+def _init_sweep(G, dist, pred, first_legs, time_budget_mins, walk_speed_mps):
+    children = children_of(pred)
+
+    # Physical stop -> the reached nodes that belong to it
+    stops = analysis.get_stops()
+    stop_nodes = {}
+    for node in dist:
+        base_stop_id = str(node).split('_')[0]
+        if base_stop_id in stops:
+            stop_nodes.setdefault(base_stop_id, []).append(node)
+
+    _SWEEP.update({
+        'G': G,
+        'dist': dist,
+        'pred': pred,
+        'children': children,
+        'first_legs': first_legs,
+        'budget': time_budget_mins,
+        'walk_speed': walk_speed_mps,
+        'stop_nodes': stop_nodes,
+        'stop_times': analysis.physical_stop_times(dist, clustered=G.graph.get('clustered', False))
+    })
+
+
+def _score_closure(closure):
+    state = _SWEEP
+    budget = state['budget']
+
+    affected, new_dist = repair_tree(
+        state['G'], state['dist'], state['pred'], state['children'],
+        state['first_legs'], closure['edges'], budget, state['walk_speed']
+    )
+
+    # Only stops owning an affected node can change
+    touched = {str(n).split('_')[0] for n in affected}
+    lost_stops = 0
+    added_mins = 0.0
+    lost_access = 0.0
+
+    for stop_id in touched:
+        if stop_id not in state['stop_times']:
+            continue
+
+        old_time = state['stop_times'][stop_id]
+        new_time = min(
+            (new_dist.get(n, float('inf')) if n in affected else state['dist'][n]
+             for n in state['stop_nodes'][stop_id]),
+            default=float('inf')
+        )
+
+        if new_time == float('inf'):
+            lost_stops += 1
+            lost_access += budget - old_time
+        elif new_time > old_time:
+            added_mins += new_time - old_time
+            lost_access += new_time - old_time
+
+    return {
+        'kind': closure['kind'],
+        'name': closure['name'],
+        'edges_removed': len(closure['edges']),
+        'nodes_affected': len(affected),
+        'stops_lost': lost_stops,
+        'minutes_added': added_mins,
+        'lost_accessibility': lost_access
+    }
+
+
+def run_resilience_sweep(G, start_lat, start_lon, time_budget_mins=30, walk_speed_mps=1.2, max_walk_km=1.0,
+                         kinds=("bridges", "routes", "segments"), top_n=20, workers=None):
+    """
+    Ranks candidate closures by the accessibility they take away from one origin.
+    Lost accessibility is the drop in leftover walking minutes summed over reached stops
+    (a stop that becomes unreachable loses all of its leftover time), which tracks the
+    area of the travel bubble without building any polygons.
+    """
+
+    # 1. BASELINE SEARCH TREE
+    first_legs = graph_builder.to_graph_stops(G, analysis.snap_to_stops(start_lat, start_lon, walk_speed_mps, max_walk_km))
+    if not first_legs:
+        print("Warning: No stops found within walking distance.")
+        return None
+
+    dist, pred = analysis.search_tree(G, first_legs, time_budget_mins, walk_speed_mps=walk_speed_mps)
+
+    # 2. ENUMERATE CLOSURES
+    closures = []
+    if "bridges" in kinds:
+        closures += bridge_closures(G)
+    if "routes" in kinds:
+        closures += route_closures(G)
+    if "segments" in kinds:
+        closures += segment_closures(G, dist, pred, top_n=top_n)
+
+    print(f"Scoring {len(closures)} closures against a baseline of {len(dist)} reached nodes...")
+
+    # 3. SCORE CLOSURES (incremental repair of the baseline tree)
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1 or len(closures) < 2:
+        _init_sweep(G, dist, pred, first_legs, time_budget_mins, walk_speed_mps)
+        results = [_score_closure(c) for c in closures]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_sweep,
+            initargs=(G, dist, pred, first_legs, time_budget_mins, walk_speed_mps)
+        ) as pool:
+            chunksize = max(1, len(closures) // (workers * 4))
+            results = list(pool.map(_score_closure, closures, chunksize=chunksize))
+
+    # 4. RANK
+    ranking = pd.DataFrame(results, columns=[
+        'kind', 'name', 'edges_removed', 'nodes_affected', 'stops_lost', 'minutes_added', 'lost_accessibility'
+    ])
+    ranking = ranking.sort_values(['lost_accessibility', 'stops_lost'], ascending=False).reset_index(drop=True)
+
+    return ranking
+
+
+# ==========================
+# TEST SCRIPT
+# ==========================
+if __name__ == "__main__":
+    import pickle
+    import graph_builder
+    import preprocessing
+
+    TEST_LAT = 49.26259
+    TEST_LON = -123.0768
+    TEST_TIME = "08:00"
+    BUDGET = 30
+
+    print("--- Running Resilience Sweep ---")
+    with open(preprocessing.network_path(1, ("skytrain", "bridges")), 'rb') as f:
+        network_edges = pickle.load(f)
+
+    G = graph_builder.build_graph(network_edges, TEST_TIME, window_mins=60)
+    ranking = run_resilience_sweep(G, TEST_LAT, TEST_LON, time_budget_mins=BUDGET)
+
+    if ranking is not None:
+        print(ranking.head(20).to_string())
+        ranking.to_csv("data/resilience_ranking.csv", index=False)
+        print("Saved 'data/resilience_ranking.csv'.")
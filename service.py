@@ -0,0 +1,529 @@
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from shapely.geometry import mapping
+
+import analysis
+import atlas
+import graph_builder
+import memory
+import service_calendar
+import tracing
+
+# =============================
+# QUERY SERVICE
+# =============================
+
+# A local JSON-over-HTTP service for other programs, standard library only:
+#     python service.py --port 8766 --warm 08:00 17:00
+#
+#   POST /isochrone  {"lat", "lon", "budget": 30, "walk_speed": 1.2, "max_walk": 0.5, "geometry": true}
+#                    -> {"graph", "stops": {stop_id: minutes}, "polygon": GeoJSON geometry or null}
+#   POST /route      {"from": [lat, lon], "to": [lat, lon], "walk_speed": 1.0, "max_walk": 1.0}
+#                    -> {"graph", "minutes", "steps", "path": GeoJSON LineString}, or null fields when unreachable
+#   POST /matrix     {"origins": [[lat, lon], ...], "destinations": [[lat, lon], ...], "walk_speed", "max_walk", "max_minutes"}
+#                    -> {"graph", "minutes": [[...], ...]} (null where unreachable)
+#   GET  /metrics    latency per endpoint, queue and batch counts
+#   GET  /health
+#
+# Every query body may also pick the graph like the dashboard does: "date" (YYYY-MM-DD,
+# default the next weekday), "time" ("08:00"), "toggles" (["skytrain", "bridges"]) and
+# "frequency" (1.0).
+#
+# Queries run in a pool of worker processes, each holding the graphs it has built
+# (with TRANSIT_SHARED_GRAPHS, one shared copy; see shared_graph.py). --warm builds the
+# given graphs in every worker before the service accepts requests. A worker keeps its
+# MAX_GRAPHS most recently used graphs, fewer when they don't fit the memory budget
+# (see memory.py). Requests for the
+# same graph that arrive within BATCH_WINDOW_S of each other go to a worker together,
+# as one task (identical queries in a batch are answered once). When MAX_PENDING
+# requests are already queued or running, new ones get 503 with Retry-After.
+
+DEFAULT_PORT = 8766
+MAX_PENDING = 64
+MAX_BATCH = 16
+BATCH_WINDOW_S = 0.005
+REQUEST_TIMEOUT_S = 120
+# Longest wait for every worker to start and build its warm graphs
+WARM_TIMEOUT_S = 600
+MAX_BODY_BYTES = 1_000_000
+MAX_MATRIX_CELLS = 10_000
+MAX_GRAPHS = 8
+
+ENDPOINTS = ('isochrone', 'route', 'matrix')
+
+# In the dashboard's order, which network file names follow
+TOGGLES = ("skytrain", "bridges")
+
+
+class RequestError(ValueError):
+    """A query the service refuses, answered with HTTP status `status`."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# =============================
+# WORKERS
+# =============================
+
+# Worker state: {graph spec: graph}, least recently used first
+_GRAPHS = OrderedDict()
+
+
+def graph_spec(body):
+    """(date, toggles, time, frequency) of the graph a query asks for."""
+    try:
+        date = datetime.date.fromisoformat(body['date']) if body.get('date') else atlas.next_weekday()
+        given = body.get('toggles', TOGGLES)
+        unknown = set(given) - set(TOGGLES)
+        if unknown:
+            raise ValueError(f"unknown toggles {sorted(unknown)}, choose from {list(TOGGLES)}")
+        toggles = tuple(t for t in TOGGLES if t in given)
+        time_str = body.get('time', "08:00")
+        if not isinstance(time_str, str) or graph_builder.parse_time(time_str) is None:
+            raise ValueError(f"invalid time {time_str!r}, use HH:MM")
+        frequency = float(body.get('frequency', 1.0))
+        if not math.isfinite(frequency) or frequency <= 0:
+            raise ValueError(f"invalid frequency {frequency!r}, use a number above 0")
+        return date.isoformat(), toggles, time_str, frequency
+    except (TypeError, ValueError) as e:
+        raise RequestError(str(e))
+
+
+def _over_budget():
+    budget = memory.budget_mb()
+    return budget is not None and memory.held() > budget * 1e6
+
+
+def _graph(spec):
+    if spec in _GRAPHS:
+        _GRAPHS.move_to_end(spec)
+        return _GRAPHS[spec]
+
+    date, toggles, time_str, frequency = spec
+    _GRAPHS[spec] = service_calendar.graph_for_date(datetime.date.fromisoformat(date), toggles, time_str, frequency)
+
+    # Graphs are accounted for while alive (memory.account), so dropping one frees its share
+    while len(_GRAPHS) > 1 and (len(_GRAPHS) > MAX_GRAPHS or _over_budget()):
+        _GRAPHS.popitem(last=False)
+    return _GRAPHS[spec]
+
+
+_STARTED = {}
+
+
+def _init_worker(specs, started):
+    for spec in specs:
+        _graph(spec)
+    _STARTED['barrier'] = started
+
+
+def _warm():
+    # Blocks until one of these tasks runs in every worker: a busy worker can't take a
+    # second one, so the pool has to start all of them, each running _init_worker first
+    _STARTED['barrier'].wait(timeout=WARM_TIMEOUT_S)
+    return os.getpid(), len(_GRAPHS)
+
+
+def _isochrone(G, q):
+    lat, lon = float(q['lat']), float(q['lon'])
+    budget, speed, max_walk = float(q.get('budget', 30)), float(q.get('walk_speed', 1.2)), float(q.get('max_walk', 0.5))
+
+    # Precomputed origins (see atlas.py) come back without a search
+    hit = atlas.lookup(G, lat, lon, budget, speed, max_walk)
+    if hit is not None:
+        best_times, polygon = hit
+    else:
+        best_times, polygon = analysis.isochrone_stop_times(G, lat, lon, budget, speed, max_walk), None
+
+    if not q.get('geometry', True):
+        polygon = None
+    elif best_times and polygon is None:
+        polygon = analysis.isochrone_polygon(best_times, budget, speed, max_walk)
+
+    return {
+        'stops': {str(s): float(t) for s, t in (best_times or {}).items()},
+        'polygon': None if polygon is None or polygon.empty else mapping(polygon.geometry.iloc[0])
+    }
+
+
+def _route(G, q):
+    (o_lat, o_lon), (d_lat, d_lon) = q['from'], q['to']
+    result = analysis.get_route(G, float(o_lat), float(o_lon), float(d_lat), float(d_lon),
+                                float(q.get('walk_speed', 1.0)), float(q.get('max_walk', 1.0)))
+    if result is None:
+        return {'minutes': None, 'steps': None, 'path': None}
+
+    gdf, steps = result
+    return {'minutes': float(gdf['time_min'].iloc[0]), 'steps': steps, 'path': mapping(gdf.geometry.iloc[0])}
+
+
+def _matrix(G, q):
+    rows = analysis.travel_time_matrix(
+        G, [tuple(map(float, p)) for p in q['origins']], [tuple(map(float, p)) for p in q['destinations']],
+        float(q.get('walk_speed', 1.0)), float(q.get('max_walk', 1.0)), q.get('max_minutes')
+    )
+    return {'minutes': rows}
+
+
+_HANDLERS = {'isochrone': _isochrone, 'route': _route, 'matrix': _matrix}
+
+
+def _run_batch(spec, queries):
+    """
+    Answers [(endpoint, query)] on the graph for spec, in a worker. Returns one
+    (status, payload, compute_ms) per query.
+    """
+    try:
+        G = _graph(spec)
+    except Exception as e:
+        return [(500, {'error': f"graph build failed: {e}"}, 0.0)] * len(queries)
+    if G is None:
+        return [(404, {'error': f"no transit service on {spec[0]}"}, 0.0)] * len(queries)
+
+    answers = {}
+    results = []
+    for endpoint, q in queries:
+        key = (endpoint, json.dumps(q, sort_keys=True))
+        if key not in answers:
+            t0 = time.perf_counter()
+            try:
+                payload = dict(_HANDLERS[endpoint](G, q), graph=G.graph.get('key'))
+                status = 200
+            except (KeyError, TypeError, ValueError) as e:
+                payload, status = {'error': f"bad {endpoint} query: {e!r}"}, 400
+            except Exception as e:
+                payload, status = {'error': repr(e)}, 500
+            answers[key] = (status, payload, (time.perf_counter() - t0) * 1000)
+        results.append(answers[key])
+    return results
+
+
+# =============================
+# BATCHING & BACKPRESSURE
+# =============================
+
+class Dispatcher:
+    """
+    Queues queries per graph and sends each group to the pool as one task, once it has
+    MAX_BATCH queries or its oldest query has waited BATCH_WINDOW_S.
+    """
+
+    def __init__(self, pool, max_pending=MAX_PENDING, max_batch=MAX_BATCH, window_s=BATCH_WINDOW_S):
+        self.pool = pool
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.window_s = window_s
+        self.pending = 0
+        self.batches = 0
+        self.batched = 0
+        self._queues = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name='dispatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, endpoint, spec, query):
+        """Future of (status, payload, compute_ms), or None when the service is saturated."""
+        future = Future()
+        with self._cond:
+            if self.pending >= self.max_pending:
+                return None
+            self.pending += 1
+            queue = self._queues.setdefault(spec, {'since': time.monotonic(), 'items': []})
+            queue['items'].append((endpoint, query, future))
+            self._cond.notify()
+        return future
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._ready():
+                    waits = [q['since'] + self.window_s - time.monotonic() for q in self._queues.values()]
+                    self._cond.wait(timeout=max(0.0, min(waits)) if waits else None)
+                if self._closed:
+                    return
+                ready = self._ready()
+                batches = [(spec, self._queues.pop(spec)['items']) for spec in ready]
+
+            for spec, items in batches:
+                for start in range(0, len(items), self.max_batch):
+                    self._send(spec, items[start:start + self.max_batch])
+
+    def _ready(self):
+        now = time.monotonic()
+        return [
+            spec for spec, q in self._queues.items()
+            if len(q['items']) >= self.max_batch or now - q['since'] >= self.window_s
+        ]
+
+    def _send(self, spec, items):
+        self.batches += 1
+        self.batched += len(items)
+        try:
+            task = self.pool.submit(_run_batch, spec, [(endpoint, query) for endpoint, query, _ in items])
+        except Exception as e:
+            # A broken or shut down pool: answer now rather than leave the queries to time out
+            self._deliver(items, [(500, {'error': f"worker pool unavailable: {e!r}"}, 0.0)] * len(items))
+            return
+
+        def deliver(task):
+            try:
+                results = task.result()
+            except Exception as e:
+                results = [(500, {'error': f"worker failed: {e!r}"}, 0.0)] * len(items)
+            self._deliver(items, results)
+
+        task.add_done_callback(deliver)
+
+    def _deliver(self, items, results):
+        with self._cond:
+            self.pending -= len(items)
+        for (_, _, future), result in zip(items, results):
+            future.set_result(result)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+
+# =============================
+# METRICS
+# =============================
+
+class Metrics:
+    """Requests, errors and rejections per endpoint, with end-to-end and compute latencies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = tracing.LatencySummary(keep=1000)
+        self.compute = tracing.LatencySummary(keep=1000)
+        self.counts = {endpoint: {'requests': 0, 'errors': 0, 'rejected': 0} for endpoint in ENDPOINTS}
+
+    def record(self, endpoint, status, total_ms, compute_ms=None):
+        with self._lock:
+            counts = self.counts[endpoint]
+            counts['requests'] += 1
+            if status == 503:
+                counts['rejected'] += 1
+            elif status >= 400:
+                counts['errors'] += 1
+        if status == 200:
+            self.latency.add({'name': endpoint, 'ms': total_ms})
+            self.compute.add({'name': endpoint, 'ms': compute_ms})
+
+    def snapshot(self, dispatcher):
+        with self._lock:
+            endpoints = {endpoint: dict(counts) for endpoint, counts in self.counts.items()}
+        for kind, summary in (('latency', self.latency), ('compute', self.compute)):
+            for row in summary.rows():
+                endpoints[row['name']][kind] = {k: row[k] for k in ('last_ms', 'p50_ms', 'p95_ms')}
+        return {
+            'endpoints': endpoints,
+            'pending': dispatcher.pending,
+            'batches': dispatcher.batches,
+            'mean_batch': dispatcher.batched / dispatcher.batches if dispatcher.batches else 0.0
+        }
+
+
+# =============================
+# HTTP SERVER
+# =============================
+
+class QueryHandler(BaseHTTPRequestHandler):
+    server_version = "TransitQuery/1.0"
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._reply(200, self.server.metrics.snapshot(self.server.dispatcher))
+        else:
+            self._reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        endpoint = self.path.strip('/')
+        if endpoint not in ENDPOINTS:
+            self._reply(404, {'error': f"unknown path {self.path}"})
+            return
+
+        t0 = time.perf_counter()
+        try:
+            query = self._read_query(endpoint)
+            spec = graph_spec(query)
+        except RequestError as e:
+            self.server.metrics.record(endpoint, e.status, 0.0)
+            self._reply(e.status, {'error': str(e)})
+            return
+
+        future = self.server.dispatcher.submit(endpoint, spec, query)
+        if future is None:
+            self.server.metrics.record(endpoint, 503, 0.0)
+            self._reply(503, {'error': "too many queries in progress, retry shortly"}, {'Retry-After': '1'})
+            return
+
+        try:
+            status, payload, compute_ms = future.result(timeout=REQUEST_TIMEOUT_S)
+        except TimeoutError:
+            status, payload, compute_ms = 504, {'error': "query timed out"}, 0.0
+
+        total_ms = (time.perf_counter() - t0) * 1000
+        self.server.metrics.record(endpoint, status, total_ms, compute_ms)
+        self._reply(status, payload)
+
+    def _read_query(self, endpoint):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise RequestError(f"body over {MAX_BODY_BYTES} bytes", 413)
+        try:
+            query = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as e:
+            raise RequestError(f"invalid JSON: {e}")
+        if not isinstance(query, dict):
+            raise RequestError("the body must be a JSON object")
+
+        if endpoint == 'matrix':
+            cells = len(query.get('origins', [])) * len(query.get('destinations', []))
+            if cells > MAX_MATRIX_CELLS:
+                raise RequestError(f"matrix of {cells} cells is over the limit of {MAX_MATRIX_CELLS}", 413)
+        return query
+
+    def _reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def start(port=DEFAULT_PORT, workers=None, warm=(), host='127.0.0.1', max_pending=MAX_PENDING):
+    """
+    Starts the pool (building the graphs in warm, a list of graph specs, in every
+    worker) and then the HTTP server in a background thread. Returns the server;
+    call stop(server) to shut both down.
+    """
+    workers = workers or os.cpu_count() or 1
+    warm = [graph_spec(body) for body in warm]
+
+    # Networks missing on disk are built here once, not by every worker at the same time
+    for date, toggles, _, _ in warm:
+        service_calendar.network_for_date(datetime.date.fromisoformat(date), toggles)
+    context = multiprocessing.get_context()
+    started = context.Barrier(workers)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(warm, started))
+
+    # One task per worker, so every worker starts (and builds its graphs) before serving
+    t0 = time.perf_counter()
+    pids = {task.result()[0] for task in [pool.submit(_warm) for _ in range(workers)]}
+    print(f"{len(pids)} workers ready with {len(warm)} graphs in {time.perf_counter() - t0:.1f} s.")
+
+    server = QueryServer((host, port), QueryHandler)
+    server.pool = pool
+    server.dispatcher = Dispatcher(pool, max_pending)
+    server.metrics = Metrics()
+    threading.Thread(target=server.serve_forever, name='query-server', daemon=True).start()
+    print(f"Query service listening on http://{host}:{server.server_address[1]}")
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    server.dispatcher.close()
+    server.pool.shutdown(cancel_futures=True)
+
+
+# =============================
+# CLIENT
+# =============================
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class Client:
+    """
+    Talks to a running service:
+        client = service.Client("http://127.0.0.1:8766")
+        client.isochrone(49.2827, -123.1207, budget=30, time="17:00")
+    Graph fields (date, time, toggles, frequency) can be passed with any query.
+    """
+
+    def __init__(self, url=f"http://127.0.0.1:{DEFAULT_PORT}", timeout=REQUEST_TIMEOUT_S):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise ServiceError(e.code, json.loads(e.read() or b'{}').get('error', e.reason)) from None
+
+    def isochrone(self, lat, lon, **fields):
+        return self._call('/isochrone', dict(fields, lat=lat, lon=lon))
+
+    def route(self, origin, destination, **fields):
+        return self._call('/route', dict(fields, **{'from': list(origin), 'to': list(destination)}))
+
+    def matrix(self, origins, destinations, **fields):
+        return self._call('/matrix', dict(fields, origins=[list(p) for p in origins], destinations=[list(p) for p in destinations]))
+
+    def metrics(self):
+        return self._call('/metrics')
+
+    def health(self):
+        return self._call('/health')
+
+
+# ==========================
+# COMMAND LINE
+# ==========================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve isochrone, route and travel time matrix queries as JSON over HTTP.")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--date', help="service date of the warmed graphs (default: the next weekday)")
+    parser.add_argument('--warm', nargs='*', default=["08:00"], metavar='HH:MM', help="times whose graphs every worker builds at startup")
+    parser.add_argument('--toggles', nargs='*', default=list(TOGGLES))
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING)
+    args = parser.parse_args()
+
+    warm = [{'date': args.date, 'time': t, 'toggles': args.toggles} for t in args.warm]
+    server = start(args.port, args.workers, warm, args.host, args.max_pending)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print("Shutting down...")
+        stop(server)
@@ -0,0 +1,167 @@
+import pandas as pd
+import hashlib
+import os
+import pickle
+from functools import lru_cache, partial
+
+import graph_builder
+import preprocessing
+import shared_graph
+import tracing
+
+# =============================
+# SERVICE CALENDAR
+# =============================
+
+# Which service_ids run on a date comes from calendar.txt (weekly pattern between
+# start_date and end_date) corrected by calendar_dates.txt (exception_type 1 adds a
+# service on a date, 2 removes it). Many dates share the same set of services
+# (every ordinary weekday, say), so networks are built once per distinct set and
+# any date running that set reuses them.
+
+# Graphs merge stops into the station clusters of preprocessing.process_clusters only
+# when TRANSIT_STOP_CLUSTERS is set
+STOP_CLUSTERS = os.environ.get('TRANSIT_STOP_CLUSTERS', '0') not in ('', '0')
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def _load_optional(name):
+    try:
+        return preprocessing.load_gtfs(name)
+    except FileNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_service_index():
+    """{datetime.date: frozenset(service_ids)} for every date the feed mentions."""
+    services = {}
+
+    calendar = _load_optional('calendar')
+    if calendar is not None:
+        for row in calendar.itertuples(index=False):
+            start = pd.to_datetime(row.start_date, format='%Y%m%d')
+            end = pd.to_datetime(row.end_date, format='%Y%m%d')
+            runs_on = [int(getattr(row, day)) == 1 for day in WEEKDAYS]
+
+            for day in pd.date_range(start, end):
+                if runs_on[day.weekday()]:
+                    services.setdefault(day.date(), set()).add(str(row.service_id))
+
+    calendar_dates = _load_optional('calendar_dates')
+    if calendar_dates is not None:
+        for row in calendar_dates.itertuples(index=False):
+            day = pd.to_datetime(row.date, format='%Y%m%d').date()
+            if int(row.exception_type) == 1:
+                services.setdefault(day, set()).add(str(row.service_id))
+            else:
+                services.setdefault(day, set()).discard(str(row.service_id))
+
+    return {day: frozenset(service_ids) for day, service_ids in services.items()}
+
+
+def services_on(date):
+    """Service_ids running on date (a datetime.date or anything pd.Timestamp accepts)."""
+    return get_service_index().get(pd.Timestamp(date).date(), frozenset())
+
+
+def feed_dates():
+    """(first, last) date with any service, or None for a feed without a calendar."""
+    days = [day for day, service_ids in get_service_index().items() if service_ids]
+    if not days:
+        return None
+    return min(days), max(days)
+
+
+def service_set_key(service_ids):
+    """
+    Stable name for a set of services, used in network file names: the IDs joined
+    with '+' ("1", "1+7"), or a short hash when that would get unwieldy.
+    """
+    key = "+".join(sorted(service_ids))
+    if len(key) > 40:
+        key = "s" + hashlib.sha1(key.encode()).hexdigest()[:12]
+    return key
+
+
+def distinct_service_sets():
+    """{service_set_key: frozenset(service_ids)} over every date in the feed."""
+    return {
+        service_set_key(service_ids): service_ids
+        for service_ids in set(get_service_index().values()) if service_ids
+    }
+
+
+def network_for_date(date, toggles=("skytrain", "bridges")):
+    """
+    (network_key, path) of the network running on date, building it on first request
+    for that date's set of services. Returns None when nothing runs on date.
+    """
+    service_ids = services_on(date)
+    if not service_ids:
+        return None
+
+    path = preprocessing.network_path(service_set_key(service_ids), toggles)
+    if not os.path.exists(path):
+        preprocessing.process_network(day_id=service_set_key(service_ids), toggles=toggles, service_ids=service_ids)
+
+    network_key = os.path.splitext(os.path.basename(path))[0]
+    return network_key, path
+
+
+def graph_for_date(date, toggles=("skytrain", "bridges"), time_str="08:00", freq_mod=1.0):
+    """
+    Graph of the network running on date at time_str (None when nothing runs), built
+    the same way by the dashboard, the query service and the command line tools.
+    """
+    network = network_for_date(date, toggles=toggles)
+    if network is None:
+        return None
+
+    network_key, path = network
+    tracing.current().set(network=network_key, date=str(date), toggles=list(toggles))
+    return graph_for_network(network_key, path, time_str, freq_mod)
+
+
+def graph_for_network(network_key, path, time_str="08:00", freq_mod=1.0):
+    """
+    Graph of the network file at path. With shared graphs on, it is published once
+    and attached (see shared_graph.py).
+    """
+    build = partial(_build_graph, path, network_key, time_str, freq_mod)
+
+    if shared_graph.enabled():
+        clustered = graph_builder.get_stop_clusters() is not None
+        key = graph_builder.graph_key(network_key, time_str, 60, freq_mod, clustered)
+        return shared_graph.load(key, shared_graph.network_version(path), build)
+
+    return build()
+
+
+def _build_graph(path, network_key, time_str, freq_mod):
+    with open(path, 'rb') as f:
+        network_edges = pickle.load(f)
+
+    return graph_builder.build_graph(
+        network_edges=network_edges,
+        current_time_str=time_str,
+        window_mins=60,
+        frequency_modifier=freq_mod,
+        use_clusters=STOP_CLUSTERS,
+        network_key=network_key
+    )
+
+
+# ==========================
+# TEST SCRIPT
+# ==========================
+if __name__ == "__main__":
+    index = get_service_index()
+    print(f"Feed runs from {feed_dates()} across {len(index)} dates.")
+
+    sets = distinct_service_sets()
+    print(f"{len(sets)} distinct service sets:")
+    for key, service_ids in sorted(sets.items()):
+        days = sum(1 for s in index.values() if s == service_ids)
+        print(f"  {key}: {days} dates")
@@ -0,0 +1,487 @@
+import itertools
+import json
+import os
+import shutil
+import threading
+import weakref
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import numpy as np
+
+import graph_builder
+import memory
+import tracing
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# =============================
+# SHARED GRAPHS
+# =============================
+
+# Under several app worker processes, every worker used to build its own networkx
+# graph for each network, so RAM grew with the number of workers. With sharing on
+# (shared_graph.enable() or TRANSIT_SHARED_GRAPHS=1), the first worker to need a graph
+# builds it once and publishes it as flat, read-only NumPy arrays:
+#
+#   nodes                       node ids
+#   succ_indptr, succ_nodes     out-edges of each node (CSR), in edge order
+#   pred_indptr, pred_nodes,    in-edges of each node (CSR) and the edge each one is
+#   pred_edges
+#   weight, type, route,        one row per edge; route and shape index routes.npy and
+#   shape, dist_u, dist_v       shapes.npy, dist_u/dist_v are NaN where missing
+#   meta.json                   G.graph and the array sizes
+#
+# Every worker (the first one included) then memory-maps the same files through a
+# SharedGraph, so the pages are held once by the OS page cache. The files live under
+# /dev/shm where it exists (shared memory), else under data/shared_graphs.
+#
+# Each published graph is a folder named '{graph key}@{network version}', the version
+# being the network file's mtime and size, so a rebuilt network publishes a new folder.
+# Every attached SharedGraph holds a reference file ('refs/{pid}-{n}'), removed when it
+# is garbage collected or its process exits. Older versions of a graph, and graphs of
+# a network rebuilt by preprocessing.save_network, are retired, and a retired folder
+# is deleted as soon as its last reference goes (references of dead processes don't
+# count). cleanup() does the same for everything under the root.
+
+EDGE_TYPES = ('board', 'travel', 'deboard')
+
+_root = None
+_attach_ids = itertools.count()
+_thread_lock = threading.RLock()
+_lock_depth = 0
+
+
+def default_root():
+    return '/dev/shm/transit_graphs' if os.path.isdir('/dev/shm') else 'data/shared_graphs'
+
+
+def enable(root=None):
+    """Shares graphs between processes through root (default: default_root())."""
+    global _root
+    _root = root or default_root()
+    os.makedirs(_root, exist_ok=True)
+
+
+def disable():
+    global _root
+    _root = None
+
+
+def enabled():
+    return _root is not None
+
+
+def network_version(path):
+    """Changes whenever the network file at path is rewritten."""
+    st = os.stat(path)
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def graph_dir(graph_key, version):
+    return f"{_root}/{graph_key}@{version}"
+
+
+@contextmanager
+def _locked():
+    # Serializes publishing, attaching and deleting between processes. Re-entrant within
+    # a process, since a SharedGraph can be collected (and detach) while the lock is held.
+    global _lock_depth
+    with _thread_lock:
+        if _lock_depth or fcntl is None:
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+            return
+        with open(f"{_root}/.lock", 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# =============================
+# PUBLISHING
+# =============================
+
+@tracing.traced('shared_graph.publish')
+def publish(G, version):
+    """
+    Writes G (a graph from graph_builder.build_graph, with a key) under the shared root
+    and retires older versions of it. Returns its folder. Contracted graphs can't be
+    shared, since their shortcut edges carry whole paths.
+    """
+    graph_key = G.graph.get('key')
+    if graph_key is None:
+        raise ValueError("Only graphs built with a network_key can be shared.")
+
+    path = graph_dir(graph_key, version)
+    if os.path.exists(f"{path}/meta.json"):
+        return path
+
+    nodes = list(G.nodes)
+    index = {n: i for i, n in enumerate(nodes)}
+    routes, shapes = {}, {}
+
+    succ_counts = np.zeros(len(nodes), dtype=np.int64)
+    targets, weights, types, route_ids, shape_ids, dist_u, dist_v = [], [], [], [], [], [], []
+
+    # Edges are numbered in out-edge order, so the succ CSR needs no edge ids
+    for i, u in enumerate(nodes):
+        for v, edge_data in G.succ[u].items():
+            if 'path' in edge_data:
+                raise ValueError("Contracted graphs can't be shared.")
+            succ_counts[i] += 1
+            targets.append(index[v])
+            weights.append(edge_data['weight'])
+            types.append(EDGE_TYPES.index(edge_data['type']))
+            route_ids.append(routes.setdefault(edge_data['route_id'], len(routes)))
+            shape_id = edge_data.get('shape_id')
+            shape_ids.append(-1 if shape_id is None else shapes.setdefault(shape_id, len(shapes)))
+            dist_u.append(np.nan if edge_data.get('dist_u') is None else edge_data['dist_u'])
+            dist_v.append(np.nan if edge_data.get('dist_v') is None else edge_data['dist_v'])
+
+    succ_nodes = np.array(targets, dtype=np.int32)
+    sources = np.repeat(np.arange(len(nodes), dtype=np.int32), succ_counts)
+
+    # In-edges: the same edges sorted by target
+    pred_edges = np.argsort(succ_nodes, kind='stable').astype(np.int32)
+    pred_counts = np.bincount(succ_nodes, minlength=len(nodes))
+
+    arrays = {
+        'nodes': np.array(nodes, dtype=str),
+        'succ_indptr': np.concatenate([[0], np.cumsum(succ_counts)]),
+        'succ_nodes': succ_nodes,
+        'pred_indptr': np.concatenate([[0], np.cumsum(pred_counts)]),
+        'pred_nodes': sources[pred_edges],
+        'pred_edges': pred_edges,
+        'weight': np.array(weights, dtype=np.float64),
+        'type': np.array(types, dtype=np.uint8),
+        'route': np.array(route_ids, dtype=np.int32),
+        'shape': np.array(shape_ids, dtype=np.int32),
+        'dist_u': np.array(dist_u, dtype=np.float64),
+        'dist_v': np.array(dist_v, dtype=np.float64),
+        'routes': np.array(list(routes), dtype=str),
+        'shapes': np.array(list(shapes), dtype=str),
+    }
+
+    # Written aside and renamed, so other processes never attach half a graph
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(f"{temp_path}/refs", exist_ok=True)
+    for name, array in arrays.items():
+        np.save(f"{temp_path}/{name}.npy", array)
+    with open(f"{temp_path}/meta.json", 'w') as f:
+        json.dump({'graph': dict(G.graph), 'nodes': len(nodes), 'edges': len(targets)}, f)
+
+    with _locked():
+        if os.path.exists(path):
+            # Another worker published it first
+            shutil.rmtree(temp_path, ignore_errors=True)
+        else:
+            os.rename(temp_path, path)
+        for folder in os.listdir(_root):
+            if folder.startswith(f"{graph_key}@") and f"{_root}/{folder}" != path and not folder.endswith('.tmp'):
+                _retire(f"{_root}/{folder}")
+
+    tracing.current().set(graph=graph_key, nodes=len(nodes), edges=len(targets))
+    print(f"Published shared graph {graph_key} ({len(nodes)} nodes, {len(targets)} edges).")
+    return path
+
+
+def attach(graph_key, version):
+    """SharedGraph for a published graph, or None if it hasn't been published (or was retired)."""
+    if _root is None:
+        return None
+    path = graph_dir(graph_key, version)
+    with _locked():
+        if not os.path.exists(f"{path}/meta.json") or os.path.exists(f"{path}/retired"):
+            return None
+        ref_path = f"{path}/refs/{os.getpid()}-{next(_attach_ids)}"
+        open(ref_path, 'w').close()
+    return memory.account('graphs', SharedGraph(path, ref_path))
+
+
+def load(graph_key, version, build):
+    """The shared graph graph_key, publishing build() first if no worker has yet."""
+    G = attach(graph_key, version)
+    if G is None:
+        publish(build(), version)
+        G = attach(graph_key, version)
+    return G
+
+
+def _reattach(path):
+    # Unpickling a SharedGraph (e.g. in a process pool) attaches again instead of copying
+    ref_path = f"{path}/refs/{os.getpid()}-{next(_attach_ids)}"
+    with _locked():
+        open(ref_path, 'w').close()
+    return SharedGraph(path, ref_path)
+
+
+# =============================
+# REFERENCES & CLEANUP
+# =============================
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def references(path):
+    """Live references to the graph folder at path. References of dead processes are removed."""
+    live = 0
+    for name in os.listdir(f"{path}/refs"):
+        if _pid_alive(int(name.split('-')[0])):
+            live += 1
+        else:
+            os.remove(f"{path}/refs/{name}")
+    return live
+
+
+def _retire(path):
+    open(f"{path}/retired", 'w').close()
+    _sweep(path)
+
+
+def _sweep(path):
+    if os.path.exists(f"{path}/retired") and references(path) == 0:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _detach(path, ref_path):
+    if _root is None or not os.path.exists(path):
+        return
+    with _locked():
+        try:
+            os.remove(ref_path)
+        except FileNotFoundError:
+            pass
+        _sweep(path)
+
+
+def retire(network_key=None):
+    """
+    Retires the shared graphs built from network_key (a network file name such as
+    'network_edges_1_skytrain_bridges'), or all of them when it is None. Each folder
+    is deleted once no process references it.
+    """
+    if _root is None or not os.path.isdir(_root):
+        return
+    with _locked():
+        for folder in os.listdir(_root):
+            graph_key = folder.split('@')[0]
+            if '@' in folder and (network_key is None or graph_builder.built_from(graph_key, network_key)):
+                _retire(f"{_root}/{folder}")
+
+
+def cleanup():
+    """Deletes retired graphs nobody references and leftovers of interrupted publishes."""
+    if _root is None or not os.path.isdir(_root):
+        return
+    with _locked():
+        for folder in os.listdir(_root):
+            path = f"{_root}/{folder}"
+            if folder.endswith('.tmp'):
+                if not _pid_alive(int(folder.rsplit('.', 2)[1])):
+                    shutil.rmtree(path, ignore_errors=True)
+            elif os.path.isdir(path):
+                _sweep(path)
+
+
+# =============================
+# READ-ONLY GRAPH VIEW
+# =============================
+
+class SharedGraph:
+    """
+    A published graph, memory-mapped. It answers the parts of the networkx DiGraph API
+    the searches use (graph, succ, pred, get_edge_data, has_edge, nodes, edges) without
+    copying the arrays; only the node id lookup is built per process. It can't be changed.
+    """
+    mapped = True
+
+    def __init__(self, path, ref_path):
+        self.path = path
+        with open(f"{path}/meta.json") as f:
+            meta = json.load(f)
+        self.graph = dict(meta['graph'], shared=True)
+
+        self.arrays = {
+            name[:-4]: np.load(f"{path}/{name}", mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')
+        }
+        self._nodes = self.arrays['nodes'].tolist()
+        self._index = {n: i for i, n in enumerate(self._nodes)}
+        self._routes = self.arrays['routes'].tolist()
+        self._shapes = self.arrays['shapes'].tolist()
+
+        # Looked up on every expansion (see weighted_edges)
+        self._succ_indptr, self._succ_nodes = self.arrays['succ_indptr'], self.arrays['succ_nodes']
+        self._pred_indptr, self._pred_nodes = self.arrays['pred_indptr'], self.arrays['pred_nodes']
+        self._weight = self.arrays['weight']
+
+        weakref.finalize(self, _detach, path, ref_path)
+
+    def __reduce__(self):
+        return _reattach, (self.path,)
+
+    # --- Nodes ---
+
+    def __contains__(self, n):
+        return n in self._index
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    def number_of_nodes(self):
+        return len(self._nodes)
+
+    def number_of_edges(self):
+        return len(self.arrays['weight'])
+
+    # --- Edges ---
+
+    def _edge_ids(self, i, direction):
+        a = self.arrays
+        start, end = a[f'{direction}_indptr'][i:i + 2].tolist()
+        if direction == 'succ':
+            return a['succ_nodes'][start:end].tolist(), range(start, end)
+        return a['pred_nodes'][start:end].tolist(), a['pred_edges'][start:end].tolist()
+
+    def weighted_edges(self, u, direction='succ'):
+        """(v, weight) for the edges leaving u (entering u for direction='pred'): the search hot path."""
+        i = self._index.get(u)
+        if i is None:
+            return ()
+        a = self.arrays
+        nodes = self._nodes
+        if direction == 'succ':
+            start, end = self._succ_indptr[i:i + 2].tolist()
+            neighbours = self._succ_nodes[start:end].tolist()
+            weights = self._weight[start:end].tolist()
+        else:
+            start, end = self._pred_indptr[i:i + 2].tolist()
+            neighbours = self._pred_nodes[start:end].tolist()
+            weights = self._weight[a['pred_edges'][start:end]].tolist()
+        return [(nodes[j], w) for j, w in zip(neighbours, weights)]
+
+    def edge_attrs(self, e):
+        """The attribute dict build_graph gave edge number e."""
+        a = self.arrays
+        edge_type = EDGE_TYPES[int(a['type'][e])]
+        edge_data = {'weight': float(a['weight'][e]), 'type': edge_type, 'route_id': self._routes[int(a['route'][e])]}
+        if edge_type == 'travel':
+            shape = int(a['shape'][e])
+            dist_u, dist_v = float(a['dist_u'][e]), float(a['dist_v'][e])
+            edge_data.update(
+                shape_id=None if shape < 0 else self._shapes[shape],
+                dist_u=None if np.isnan(dist_u) else dist_u,
+                dist_v=None if np.isnan(dist_v) else dist_v,
+            )
+        return edge_data
+
+    def adjacency(self, u, direction='succ'):
+        """{v: edge attributes} for the edges leaving (or entering) u."""
+        neighbours, edge_ids = self._edge_ids(self._index[u], direction)
+        return {self._nodes[j]: self.edge_attrs(e) for j, e in zip(neighbours, edge_ids)}
+
+    @property
+    def succ(self):
+        return _Adjacency(self, 'succ')
+
+    @property
+    def pred(self):
+        return _Adjacency(self, 'pred')
+
+    def _edge_id(self, u, v):
+        i, j = self._index.get(u), self._index.get(v)
+        if i is None or j is None:
+            return None
+        neighbours, edge_ids = self._edge_ids(i, 'succ')
+        for k, e in zip(neighbours, edge_ids):
+            if k == j:
+                return e
+        return None
+
+    def get_edge_data(self, u, v, default=None):
+        e = self._edge_id(u, v)
+        return default if e is None else self.edge_attrs(e)
+
+    def has_edge(self, u, v):
+        return self._edge_id(u, v) is not None
+
+    @property
+    def edges(self):
+        return _EdgeView(self)
+
+
+class _Adjacency(Mapping):
+    """G.succ / G.pred of a SharedGraph: {u: {v: edge attributes}}, built on access."""
+
+    def __init__(self, G, direction):
+        self.G = G
+        self.direction = direction
+
+    def __getitem__(self, u):
+        return self.G.adjacency(u, self.direction)
+
+    def __contains__(self, u):
+        return u in self.G._index
+
+    def __iter__(self):
+        return iter(self.G._nodes)
+
+    def __len__(self):
+        return len(self.G._nodes)
+
+
+class _EdgeView:
+    """G.edges of a SharedGraph: iterable, callable with data=True, and indexable by (u, v)."""
+
+    def __init__(self, G):
+        self.G = G
+
+    def __call__(self, data=False):
+        G = self.G
+        indptr = G.arrays['succ_indptr'].tolist()
+        targets = G.arrays['succ_nodes'].tolist()
+        for i, u in enumerate(G._nodes):
+            for e in range(indptr[i], indptr[i + 1]):
+                v = G._nodes[targets[e]]
+                yield (u, v, G.edge_attrs(e)) if data else (u, v)
+
+    def __iter__(self):
+        return self()
+
+    def __len__(self):
+        return self.G.number_of_edges()
+
+    def __getitem__(self, uv):
+        edge_data = self.G.get_edge_data(*uv)
+        if edge_data is None:
+            raise KeyError(uv)
+        return edge_data
+
+
+if os.environ.get('TRANSIT_SHARED_GRAPHS', '0') not in ('', '0'):
+    enable(None if os.environ['TRANSIT_SHARED_GRAPHS'] == '1' else os.environ['TRANSIT_SHARED_GRAPHS'])
@@ -0,0 +1,42 @@
+import contextlib
+import io
+import os
+import pickle
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'benchmarks'))
+
+import bench_pipeline
+import memory
+import preprocessing
+
+
+@pytest.fixture(scope='session')
+def synthetic_network(tmp_path_factory):
+    """
+    Network edges of service day 1 on the small synthetic feed, with its stops,
+    transfers, footpaths and land preprocessed. data/ is read from the feed's
+    folder until the session ends.
+    """
+    work_dir = tmp_path_factory.mktemp('synthetic_feed')
+    start_dir = os.getcwd()
+    bench_pipeline.prepare_workspace(str(work_dir), 'small')
+    os.chdir(work_dir)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            preprocessing.process_land_components()
+            preprocessing.process_stops()
+            preprocessing.process_transfers()
+            preprocessing.process_footpaths()
+            path = preprocessing.process_network(day_id=1)
+        with open(path, 'rb') as f:
+            yield pickle.load(f)
+    finally:
+        os.chdir(start_dir)
+        memory.clear_all()
+        preprocessing.load_gtfs.cache_clear()
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import geopandas as gpd
+import shapely
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+
+
+def albers(lat, lon):
+    point = gpd.GeoSeries([shapely.Point(lon, lat)], crs="EPSG:4326").to_crs("EPSG:3005").iloc[0]
+    return point.x, point.y
+
+
+def test_stop_off_the_coastline_keeps_its_walk_circle(monkeypatch):
+    # A square of land whose east shore is 50 m west of the stop, and an island 3 km away
+    x, y = albers(49.28, -123.12)
+    mainland = shapely.box(x - 2000, y - 1000, x - 50, y + 1000)
+    island = shapely.box(x + 3000, y - 500, x + 4000, y + 500)
+    land = gpd.GeoDataFrame({'land_id': [0, 1]}, geometry=[mainland, island], crs="EPSG:3005").set_index('land_id', drop=False)
+    stops = {'pier': {'name': 'Pier', 'lat': 49.28, 'lon': -123.12, 'land_id': None}}
+    monkeypatch.setattr(analysis, 'get_stops', lambda: stops)
+    monkeypatch.setattr(analysis, 'get_land_components', lambda: land)
+
+    # 10 minutes left at 1.2 m/s, capped at 500 m
+    area = analysis.isochrone_area({'pier': 20.0}, 30, 1.2, 0.5)
+
+    assert area is not None and not area.is_empty
+    assert mainland.buffer(1e-6).contains(area)
+    # The land part of a 500 m circle whose centre is 50 m offshore
+    expected = mainland.intersection(shapely.Point(x, y).buffer(500, quad_segs=16)).area
+    assert abs(area.area - expected) < 1e-6 * expected
+
+    # Same result from stops projected up front, as comparison.py draws them
+    assert analysis.isochrone_area({'pier': 20.0}, 30, 1.2, 0.5, projected={'pier': (x, y)}).equals_exact(area, 1e-6)
+
+
+def test_stop_far_offshore_reaches_no_land(monkeypatch):
+    # The nearest shore is 300 m away, beyond preprocessing.LAND_SNAP_M
+    x, y = albers(49.28, -123.12)
+    mainland = shapely.box(x - 2000, y - 1000, x - 300, y + 1000)
+    land = gpd.GeoDataFrame({'land_id': [0]}, geometry=[mainland], crs="EPSG:3005").set_index('land_id', drop=False)
+    stops = {'buoy': {'name': 'Buoy', 'lat': 49.28, 'lon': -123.12, 'land_id': None}}
+    monkeypatch.setattr(analysis, 'get_stops', lambda: stops)
+    monkeypatch.setattr(analysis, 'get_land_components', lambda: land)
+
+    area = analysis.isochrone_area({'buoy': 20.0}, 30, 1.2, 0.5)
+
+    assert area is None or area.is_empty
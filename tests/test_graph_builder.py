@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+import graph_builder
+
+
+def test_contracted_graph_reaches_stops_at_the_same_times(synthetic_network):
+    G = graph_builder.build_graph(synthetic_network, "08:00")
+    H = graph_builder.build_graph(synthetic_network, "08:00", contract=True)
+    assert H.number_of_nodes() < G.number_of_nodes()
+
+    stops = analysis.get_stops()
+    for info in list(stops.values())[::max(1, len(stops) // 20)]:
+        first_legs = analysis.snap_to_stops(info['lat'], info['lon'], 1.2, 0.5)
+        plain = analysis.stop_times_from_legs(G, first_legs, 15, 1.2, 0.5)
+        contracted = analysis.stop_times_from_legs(H, first_legs, 15, 1.2, 0.5)
+
+        assert plain.keys() == contracted.keys()
+        assert all(abs(plain[s] - contracted[s]) < 1e-6 for s in plain)
@@ -0,0 +1,27 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+import graph_builder
+import hub_labels
+
+
+def test_label_queries_match_search(synthetic_network):
+    G = graph_builder.build_graph(synthetic_network, "08:00")
+    labels, _ = hub_labels.build_hub_labels(G, 1.2)
+
+    random.seed(0)
+    stops = list(analysis.get_stops().values())
+    for _ in range(30):
+        a, b = random.choice(stops), random.choice(stops)
+        first_legs = analysis.snap_to_stops(a['lat'], a['lon'], 1.2, 0.5)
+        last_legs = dict(analysis.snap_to_stops(b['lat'], b['lon'], 1.2, 0.5))
+
+        dist, _ = analysis.search_tree(G, first_legs, float('inf'), last_legs=last_legs, walk_speed_mps=1.2)
+        searched = min((dist[n] + w for n, w in last_legs.items() if n in dist), default=float('inf'))
+        labeled = hub_labels.label_travel_time(labels, first_legs, list(last_legs.items()))
+
+        assert labeled == searched or abs(labeled - searched) < 1e-3
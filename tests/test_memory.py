@@ -0,0 +1,17 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench_memory
+import memory
+
+
+def test_small_workload_fits_its_budget(tmp_path):
+    try:
+        peak_mb = bench_memory.run('small', work_dir=str(tmp_path))
+    finally:
+        memory.set_budget(None)
+        memory.clear_all()
+
+    assert peak_mb <= bench_memory.BUDGETS['small']
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import networkx as nx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+import resilience
+
+
+def stop(name):
+    return {'name': f"Stop {name}", 'lat': 49.2, 'lon': -123.1}
+
+
+def test_segment_usage_crosses_deboard_edges(monkeypatch):
+    # Route 1 rides A -> B -> C -> D, getting off at each stop over a 0-minute deboard edge.
+    # Route 2 rides A -> E, and F is a walk from E.
+    G = nx.DiGraph()
+    G.add_edge('A', 'A_1', weight=1, type='board', route_id='1')
+    for u, v in [('A', 'B'), ('B', 'C'), ('C', 'D')]:
+        G.add_edge(f"{u}_1", f"{v}_1", weight=3, type='travel', route_id='1')
+        G.add_edge(f"{v}_1", v, weight=0, type='deboard', route_id='1')
+    G.add_edge('A', 'A_2', weight=1, type='board', route_id='2')
+    G.add_edge('A_2', 'E_2', weight=2, type='travel', route_id='2')
+    G.add_edge('E_2', 'E', weight=0, type='deboard', route_id='2')
+    G.add_edge('E', 'F', weight=2, type='walk', route_id='walk')
+    monkeypatch.setattr(analysis, 'get_stops', lambda: {s: stop(s) for s in 'ABCDEF'})
+
+    # In settle order, as search_tree returns them: each route node ties with the
+    # street stop it deboards to, and settles first
+    dist = {'A': 0, 'A_1': 1, 'A_2': 1, 'E_2': 3, 'E': 3, 'B_1': 4, 'B': 4,
+            'F': 5, 'C_1': 7, 'C': 7, 'D_1': 10, 'D': 10}
+    pred = {'A': None, 'A_1': 'A', 'A_2': 'A', 'E_2': 'A_2', 'E': 'E_2', 'B_1': 'A_1', 'B': 'B_1',
+            'F': 'E', 'C_1': 'B_1', 'C': 'C_1', 'D_1': 'C_1', 'D': 'D_1'}
+
+    closures = resilience.segment_closures(G, dist, pred)
+
+    # A -> B carries B, C and D; A -> E carries E and F; B -> C carries C and D
+    assert [c['name'] for c in closures[:3]] == ["1: Stop A -> Stop B", "2: Stop A -> Stop E", "1: Stop B -> Stop C"]
+    assert closures[0]['edges'] == frozenset({('A_1', 'B_1')})
@@ -0,0 +1,289 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+# =============================
+# TRACING
+# =============================
+
+# Named, nested spans around the steps of a request (loading, building, searching,
+# drawing), each with its duration and a few attributes such as node counts:
+#
+#     with tracing.span("isochrone.search", origins=3) as s:
+#         dist = ...
+#         s.set(settled=len(dist))
+#
+# Tracing is off unless enabled (tracing.enable() or TRANSIT_TRACE=1). While off,
+# span() hands back one shared do-nothing span, so instrumented code costs a function
+# call per span. Finished spans go to every sink: a JSON-lines log
+# (TRANSIT_TRACE_LOG=path), and any LatencySummary collecting for the current
+# context, which is how the dashboard shows per-session timings.
+
+_enabled = False
+_sinks = []
+_ids = itertools.count(1)
+
+_current_span = contextvars.ContextVar('tracing_span', default=None)
+_collectors = contextvars.ContextVar('tracing_collectors', default=())
+
+_profile_lock = threading.Lock()
+_profile_request = None
+
+
+class Span:
+    recording = True
+
+    def __init__(self, name, attrs, profile=True):
+        self.name = name
+        self.attrs = attrs
+        self.profile = profile
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self._token = _current_span.set(self)
+        self._profiler = _start_profile() if parent is None and self.profile else None
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ms = 1000 * (time.perf_counter() - self._t0)
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        if self._profiler is not None:
+            self.attrs['profile'] = _finish_profile(self._profiler, self.name)
+
+        record = {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'ms': ms,
+            'thread': threading.current_thread().name,
+            'attrs': self.attrs
+        }
+        for sink in _sinks:
+            sink(record)
+        for collector in _collectors.get():
+            collector.add(record)
+        return False
+
+
+class _NoopSpan:
+    recording = False
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attrs):
+    """Context manager timing the enclosed block as span `name` (a no-op while tracing is off)."""
+    if not _enabled:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+
+def traced(name):
+    """Decorator running every call of the function inside span(name)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current():
+    """The innermost open span, to attach attributes to (a no-op span while tracing is off)."""
+    active = _current_span.get()
+    return active if _enabled and active is not None else _NOOP_SPAN
+
+
+def event(name, **attrs):
+    """A zero-length span marking that something happened (a click, a cache miss)."""
+    if _enabled:
+        with Span(name, attrs, profile=False):
+            pass
+
+
+def enabled():
+    return _enabled
+
+
+def enable(log_path=None):
+    """Turns tracing on, appending finished spans to the JSON-lines file log_path if given."""
+    global _enabled
+    _enabled = True
+    if log_path and not any(isinstance(s, JsonLinesSink) and s.path == log_path for s in _sinks):
+        _sinks.append(JsonLinesSink(log_path))
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    for sink in _sinks:
+        if isinstance(sink, JsonLinesSink):
+            sink.close()
+    _sinks.clear()
+
+
+# =============================
+# SINKS
+# =============================
+
+class JsonLinesSink:
+    """Appends one JSON object per finished span to path."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class LatencySummary:
+    """Count and recent durations per span name, for spans finished inside collect(self)."""
+
+    def __init__(self, keep=200):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._durations = defaultdict(lambda: deque(maxlen=keep))
+
+    def add(self, record):
+        with self._lock:
+            self._counts[record['name']] += 1
+            self._durations[record['name']].append(record['ms'])
+
+    def rows(self):
+        """[{'name', 'count', 'last_ms', 'p50_ms', 'p95_ms'}] sorted by span name."""
+        with self._lock:
+            snapshot = {name: list(durations) for name, durations in self._durations.items()}
+            counts = dict(self._counts)
+
+        rows = []
+        for name, durations in sorted(snapshot.items()):
+            ordered = sorted(durations)
+            rows.append({
+                'name': name,
+                'count': counts[name],
+                'last_ms': durations[-1],
+                'p50_ms': ordered[len(ordered) // 2],
+                'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            })
+        return rows
+
+
+class collect:
+    """
+    Context manager sending every span finished in this context (including work
+    handed to threads with a copied context) to the given collectors as well.
+    """
+
+    def __init__(self, *collectors):
+        self.collectors = collectors
+
+    def __enter__(self):
+        self._token = _collectors.set(_collectors.get() + self.collectors)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _collectors.reset(self._token)
+        return False
+
+
+# =============================
+# PROFILING HOOK
+# =============================
+
+def profile_next(engine='cprofile', out_dir='profiles'):
+    """
+    Profiles the next top-level span (one request) with cProfile or pyinstrument and
+    writes the result to out_dir; its path is added to the span as 'profile'.
+    Only takes effect while tracing is enabled.
+    """
+    global _profile_request
+    if engine not in ('cprofile', 'pyinstrument'):
+        raise ValueError(f"Unknown profiler '{engine}'. Use 'cprofile' or 'pyinstrument'.")
+    if engine == 'pyinstrument':
+        import pyinstrument  # fail now rather than in the middle of a request
+
+    with _profile_lock:
+        _profile_request = (engine, out_dir)
+
+
+def _start_profile():
+    global _profile_request
+    if _profile_request is None:
+        return None
+    with _profile_lock:
+        request, _profile_request = _profile_request, None
+    if request is None:
+        return None
+
+    engine, out_dir = request
+    if engine == 'pyinstrument':
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return engine, out_dir, profiler
+
+
+def _finish_profile(profile, span_name):
+    engine, out_dir, profiler = profile
+    os.makedirs(out_dir, exist_ok=True)
+    stem = f"{out_dir}/{span_name}-{time.strftime('%Y%m%d-%H%M%S')}"
+
+    if engine == 'pyinstrument':
+        profiler.stop()
+        path = f"{stem}.html"
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        path = f"{stem}.prof"
+        profiler.dump_stats(path)
+
+    print(f"Profile of '{span_name}' written to '{path}'.")
+    return path
+
+
+if os.environ.get('TRANSIT_TRACE', '') not in ('', '0'):
+    enable(os.environ.get('TRANSIT_TRACE_LOG'))